@@ -11,6 +11,17 @@ import argparse
 import numpy as np
 from os.path import splitext
 
+# number of set bits for every byte value
+BIT_COUNTS = np.unpackbits(
+    np.arange(256, dtype=np.uint8).reshape(-1, 1), axis=1).sum(axis=1)
+
+# layout of the 80 byte .vol header
+HEADER_DTYPE = np.dtype([
+    ('headersize', '<u4'), ('version', '<u2'), ('mode', 'u1'),
+    ('depth', 'u1'), ('nbits', '<u4'), ('crs', '<u4'), ('lat', '<f8'),
+    ('lon', '<f8'), ('minx', '<f8'), ('miny', '<f8'), ('minz', '<f8'),
+    ('maxx', '<f8'), ('maxy', '<f8'), ('maxz', '<f8')])
+
 def normalize(val, minval, maxval):
     """Scale a value between 0 and 1."""
     if val >= maxval:
@@ -77,6 +88,132 @@ def print_binary(np64):
     print("{0:064b}".format(np64))
 
 
+def count_bits_np(vols):
+    """Count the bits set to 1 in each element of a uint64 numpy array."""
+    vols = np.ascontiguousarray(vols, dtype=np.uint64)
+    bytevals = vols.view(np.uint8).reshape(vols.shape + (8,))
+    return BIT_COUNTS[bytevals].sum(axis=-1, dtype=np.int64)
+
+
+def unpack_bits_np(vols):
+    """Unpack uint64 values into an (n, 64) bool array indexed by bit."""
+    vols = np.ascontiguousarray(vols, dtype='<u8').reshape(-1)
+    bits = np.unpackbits(vols.view(np.uint8).reshape(-1, 8, 1), axis=2)
+    # unpackbits is msb first within each byte
+    return bits[:, :, ::-1].reshape(-1, 64).astype(np.bool_)
+
+
+def morton_codes(keys, depth):
+    """
+    Depth first order code of integer voxel coordinates.
+
+    Each level adds the 6 bit index x%4 + 4*(y%4) + 16*(z%4) of the voxel
+    within its block, from the top level down, so sorting the codes gives
+    the order of the blocks and bits in a sparse vola file.
+    """
+    keys = np.asarray(keys, dtype=np.uint64).reshape(-1, 3)
+    codes = np.zeros(len(keys), dtype=np.uint64)
+    three = np.uint64(3)
+    for level in range(depth):
+        shift = np.uint64(2 * (depth - level - 1))
+        index = ((keys[:, 0] >> shift) & three) + \
+            (((keys[:, 1] >> shift) & three) << np.uint64(2)) + \
+            (((keys[:, 2] >> shift) & three) << np.uint64(4))
+        codes = (codes << np.uint64(6)) | index
+    return codes
+
+
+def morton_keys(codes, depth):
+    """Integer voxel coordinates of morton codes, see morton_codes."""
+    codes = np.asarray(codes, dtype=np.uint64)
+    keys = np.zeros((len(codes), 3), dtype=np.int64)
+    three = np.uint64(3)
+    for level in range(depth):
+        index = codes >> np.uint64(6 * (depth - level - 1))
+        for axis in range(3):
+            digit = (index >> np.uint64(2 * axis)) & three
+            keys[:, axis] = keys[:, axis] * 4 + digit.astype(np.int64)
+    return keys
+
+
+def pack_payloads(vals):
+    """Pack rows of byte values into uint64 payloads, first byte lowest."""
+    vals = np.asarray(vals, dtype=np.int64).reshape(len(vals), -1)
+    if np.any(vals > 255):
+        raise ValueError("byte payload must be less than 255")
+    payloads = np.zeros(len(vals), dtype=np.uint64)
+    for offset in range(vals.shape[1]):
+        payloads |= vals[:, offset].astype(np.uint64) << np.uint64(8 * offset)
+    return payloads
+
+
+def read_text(filename, skiprows=0, blocksize=64 * 1024 * 1024):
+    """
+    Read the rows of a text point file in chunks.
+
+    Values may be separated by spaces, tabs or commas. Lines starting with
+    # and blank lines are skipped, as are the first skiprows lines. Blocks
+    of about blocksize bytes are converted at once with np.fromstring and
+    yielded as (rows, columns) float64 arrays.
+    """
+    ncols = None
+    with open(filename, 'rb') as textfile:
+        for _ in range(skiprows):
+            textfile.readline()
+        rest = b''
+        while True:
+            block = textfile.read(blocksize)
+            more = len(block) > 0
+            block = rest + block
+            rest = b''
+            if more:
+                # only whole lines, the rest goes into the next block
+                cut = block.rfind(b'\n') + 1
+                block, rest = block[:cut], block[cut:]
+            if b'#' in block:
+                block = b'\n'.join(line for line in block.split(b'\n')
+                                   if not line.startswith(b'#'))
+            block = block.replace(b',', b' ')
+            if ncols is None and block.strip():
+                ncols = len(block.lstrip().split(b'\n', 1)[0].split())
+            # fromstring reads a block of only whitespace as [-1]
+            if ncols and block.strip():
+                vals = np.fromstring(block.decode('ascii'), sep=' ')
+                if len(vals) % ncols:
+                    raise ValueError(filename + " has rows without " +
+                                     str(ncols) + " values")
+                if len(vals):
+                    yield vals.reshape(-1, ncols)
+            if not more:
+                break
+
+
+def text_bbox(filename, skiprows=0):
+    """
+    Bounding box of the x, y, z columns of a text point file.
+
+    Returns the bbox and the number of columns, or None, 0 if it is empty.
+    """
+    low, high = [], []
+    ncols = 0
+    for rows in read_text(filename, skiprows):
+        low.append(rows[:, :3].min(axis=0))
+        high.append(rows[:, :3].max(axis=0))
+        ncols = rows.shape[1]
+    if not low:
+        return None, 0
+    return [np.min(low, axis=0).tolist(), np.max(high, axis=0).tolist()], ncols
+
+
+def read_header(filereader):
+    """Read the .vol header fields into a dictionary."""
+    hdrbytes = filereader.read(HEADER_DTYPE.itemsize)
+    if len(hdrbytes) < HEADER_DTYPE.itemsize:
+        raise ValueError("file is too short to hold a vola header")
+    hdr = np.frombuffer(hdrbytes, dtype=HEADER_DTYPE)[0]
+    return {name: hdr[name].item() for name in HEADER_DTYPE.names}
+
+
 def get_indexes(vol):
     """Return all the indices in a given vol."""
     indices = []
@@ -183,6 +320,40 @@ def add_reverse(parser):
 
     return parser
 
+def add_grid(parser):
+    """ adds arguments for snapping the voxels to a shared global grid """
+    parser.add_argument(
+        "--cubesize",
+        help="snap the voxels to a global grid of cubes of this size (in crs\
+              units) so that volumes made on the same grid line up",
+        type=float)
+
+    parser.add_argument(
+        "--gridorigin",
+        help="origin of the global grid, defaults to 0 0 0",
+        type=float, nargs=3, metavar=('X', 'Y', 'Z'))
+
+    return parser
+
+def check_grid(parser, args):
+    """ rejects --gridorigin without the --cubesize of the grid """
+    if args.gridorigin is not None and args.cubesize is None:
+        parser.error("--gridorigin needs --cubesize")
+
+def add_mesh(parser):
+    """ adds arguments for how triangle meshes are voxelized """
+    parser.add_argument(
+        "--fill",
+        help="also fill the inside of closed meshes",
+        action='store_true')
+
+    parser.add_argument(
+        "--vertices",
+        help="only use the vertices of the mesh, not the triangle surfaces",
+        action='store_true')
+
+    return parser
+
 def sub(filepath, new_ext):
     """ replacement for re.sub that only modifies the extension """
     bare_file = splitext(filepath)[0]
@@ -6,7 +6,9 @@ Binvox is a very popular volumetric representation that uses run
 length encoding to achieve significant compression. It is included
 as there are many datasets that are stored in binvox format.
 There is no information other than voxels so the occupancy information
-is only available for this format.
+is only available for this format. The grid is made into the vola levels
+directly, unless --cubesize is given, in which case the voxel centres are
+snapped to the global grid.
 @author Jonathan Byrne
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
@@ -22,7 +24,9 @@ def main():
     """Read the file, build the tree. Write a Binary."""
     start_time = bu.timer()
     parser = bu.parser_args("*.binvox")
+    parser = bu.add_grid(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -41,26 +45,46 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_binvox(filename)
+        header, grid = parse_binvox(filename)
 
         print("binvox only has occupancy data," +
               " no additional data is being added")
         nbits = 0
 
-        if len(points) > 0:
+        if not grid.any():
+            print("The points file is empty!")
+            continue
+
+        voxelsize = header['scale'] / max(header['dims'])
+        translate = np.array(header['translate'])
+        if args.cubesize:
+            # resample the voxel centres onto the global grid
+            points = (np.argwhere(grid) + 0.5) * voxelsize + translate
+            bbox = [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+            volatree = VolaTree(args.depth, bbox, args.crs,
+                                args.dense, nbits,
+                                args.gridorigin, args.cubesize)
+            volatree.cubify(points)
+        else:
+            # the grid goes straight into the levels, padded to a power of 4
+            griddepth = int(np.ceil(np.log(max(header['dims'])) / np.log(4) -
+                                    1e-9))
+            side = pow(4, max(args.depth, griddepth))
+            print("binvox grid of side", max(header['dims']),
+                  "is padded to", side)
+            bbox = [translate.tolist(),
+                    (translate + side * voxelsize).tolist()]
             volatree = VolaTree(args.depth, bbox, args.crs,
                                 args.dense, nbits)
-            volatree.cubify(points, pointsdata)
-            volatree.writebin(outfilename)
+            volatree.set_grid(grid)
+        volatree.writebin(outfilename)
 
-            bu.print_ratio(filename, outfilename)
-        else:
-            print("The points file is empty!")
+        bu.print_ratio(filename, outfilename)
     bu.timer(start_time)
 
 
 def parse_binvox(filename):
-    """Read xyz format point data and return header, points and points data."""
+    """Read a binvox file and return its header and occupancy grid."""
     header = {}
     with open(filename, 'rb') as infile:
         # read header info
@@ -77,52 +101,22 @@ def parse_binvox(filename):
             exit()
         bytevals = np.frombuffer(infile.read(), dtype=np.uint8)
 
-    points = runlength_to_xyz(bytevals, header)
-    # show everything
-    # np.set_printoptions(threshold=np.inf)
-    # supress scientific notation
-    np.set_printoptions(suppress=True)
-    minvals = points.min(axis=0).tolist()
-    maxvals = points.max(axis=0).tolist()
-
-    if header['dims'][0] == 32:
-        maxvals = [64, 64, 64]
-    elif header['dims'][0] == 128:
-        maxvals = [256, 256, 256]
-    elif header['dims'][0] == 512:
-        maxvals = [1024, 1024, 1024]
-    else:
-        maxvals = header['dims']
-    bbox = [minvals, maxvals]
-    return bbox, points, None
+    return header, runlength_to_grid(bytevals, header)
 
 
-def runlength_to_xyz(bytevals, header):
-    """Binvox uses a binary runlength encoding (valuebyte, countbyte)."""
+def runlength_to_grid(bytevals, header):
+    """
+    Binvox uses a binary runlength encoding (valuebyte, countbyte).
+
+    The runs are expanded with np.repeat into the grid, which is stored x,
+    then z, then y (fastest) and is returned indexed [x, y, z].
+    """
     # odds and evens, the value and then the count is specified
     values, counts = bytevals[::2], bytevals[1::2]
-
-    # Make a list of start/end indexes for each run.
-    start, end = 0, 0
-    end_indexes = np.cumsum(counts)
-    indexes = np.concatenate(([0], end_indexes[:-1])).astype(np.int)
-
-    # use the values as booleans to remove empty points from the array
-    values = values.astype(np.bool)
-    indexes = indexes[values]
-    end_indexes = end_indexes[values]
-
-    occupied_voxels = []
-    for start, end in zip(indexes, end_indexes):
-        occupied_voxels.extend(range(start, end))
-    occupied_voxels = np.array(occupied_voxels)
-
-    x = occupied_voxels / (header['dims'][0] * header['dims'][1])
-    zwpy = occupied_voxels % (header['dims'][0] * header['dims'][1])  # z*w + y
-    z = zwpy / header['dims'][0]
-    y = zwpy % header['dims'][0]
-    points = np.vstack((x, y, z)).T
-    return points
+    cells = np.repeat(values, counts)
+    if len(cells) != np.prod(header['dims']):
+        raise ValueError("the binvox data does not fill its grid")
+    return cells.reshape(header['dims']).transpose(0, 2, 1)
 
 
 if __name__ == '__main__':
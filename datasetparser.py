@@ -1,5 +1,12 @@
 #!/usr/bin/env python3
 """Reads all the headers in a folder and creates a vola index.
+
+Headers are read by a pool of threads. With --incremental the entries of
+an existing .vola index are reused for files whose size and modification
+time are unchanged, so only new or modified files are read. A spatial
+index of the tile bboxes is written next to the .vola file (.volaidx).
+The overviews listed in an existing index are kept while its tiles are
+unchanged.
 @author Jonathan Byrne
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
@@ -7,8 +14,14 @@ from __future__ import print_function
 import argparse
 import glob
 import os
-import struct
 import json
+from concurrent.futures import ThreadPoolExecutor
+import binutils as bu
+import volaindex
+
+# attribution fields copied from info.json
+INFO_KEYS = ['dataset', 'info', 'url', 'author', 'authorurl', 'license',
+             'licenseurl']
 
 
 def main():
@@ -16,6 +29,13 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("pathname",
                         help="the path containing volume files", type=str)
+    parser.add_argument("-i", "--incremental",
+                        help="only read the files that are new or changed\
+                              since the existing .vola index was written",
+                        action='store_true')
+    parser.add_argument("--workers",
+                        help="number of threads reading headers",
+                        type=int, default=16)
     args = parser.parse_args()
     dirname = args.pathname.rstrip('/')
     dataset = os.path.basename(dirname)
@@ -25,57 +45,6 @@ def main():
 
     print("Processing folder:", dirname, " output:", volaname)
 
-    files = []
-    tminx, tminy, tminz = float('inf'), float('inf'), float('inf')
-    tmaxx, tmaxy, tmaxz = float('-inf'), float('-inf'), float('-inf')
-
-    filenames = glob.glob(vol)
-    hdr = {}
-    for filename in filenames:
-        with open(filename, "rb") as f:
-            hdr['headersize'] = struct.unpack('I', f.read(4))[0]
-            hdr['version'] = struct.unpack('H', f.read(2))[0]
-            hdr['mode'] = struct.unpack('B', f.read(1))[0]
-            hdr['depth'] = struct.unpack('B', f.read(1))[0]
-            hdr['nbits'] = struct.unpack('I', f.read(4))[0]
-            hdr['crs'] = struct.unpack('I', f.read(4))[0]
-            hdr['lat'] = struct.unpack('d', f.read(8))[0]
-            hdr['lon'] = struct.unpack('d', f.read(8))[0]
-            minx = struct.unpack('d', f.read(8))[0]
-            miny = struct.unpack('d', f.read(8))[0]
-            minz = struct.unpack('d', f.read(8))[0]
-            maxx = struct.unpack('d', f.read(8))[0]
-            maxy = struct.unpack('d', f.read(8))[0]
-            maxz = struct.unpack('d', f.read(8))[0]
-
-        if minx < tminx:
-            tminx = minx
-        if miny < tminy:
-            tminy = miny
-        if minz < tminz:
-            tminz = minz
-
-        if maxx > tmaxx:
-            tmaxx = maxx
-        if maxy > tmaxy:
-            tmaxy = maxy
-        if maxz > tmaxz:
-            tmaxz = maxz
-
-        bbox = [minx, miny, minz, maxx, maxy, maxz]
-        sides = [maxx - minx, maxy - miny, maxz - minz]
-        centroid = ((minx + maxx) / 2, (miny + maxy) / 2, (minz + maxz) / 2)
-
-        files.append({
-            'filename': filename,
-            'bbox': bbox,
-            'centroid': centroid,
-            'sides': sides,
-            'crs': hdr['crs'],
-            'lat': hdr['lat'],
-            'lon': hdr['lon']
-        })
-
     if not os.path.isfile(infofile):
         print("Missing attribution info file!! Attribution is required")
         exit()
@@ -86,15 +55,50 @@ def main():
                 print("No license information!! License is required")
                 exit()
 
+    previous = {}
+    if args.incremental and os.path.isfile(volaname):
+        with open(volaname) as old_file:
+            for entry in json.load(old_file)['files']:
+                previous[entry['filename']] = entry
+
+    filenames = sorted(glob.glob(vol))
+    stats = [os.stat(filename) for filename in filenames]
+    files = [None] * len(filenames)
+    toread = []
+    for idx, (filename, stat) in enumerate(zip(filenames, stats)):
+        entry = previous.get(filename)
+        if entry is not None and entry.get('size') == stat.st_size and \
+                entry.get('mtime') == stat.st_mtime_ns:
+            files[idx] = entry
+        else:
+            toread.append(idx)
+
+    print("Reading", len(toread), "of", len(filenames), "headers")
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        entries = pool.map(read_entry, [filenames[idx] for idx in toread],
+                           [stats[idx] for idx in toread])
+        for idx, entry in zip(toread, entries):
+            files[idx] = entry
+
+    if not files:
+        print("No .vol files found!")
+        exit()
+
+    write_vola(volaname, files, infodata)
+
+
+def write_vola(volaname, files, infodata):
+    """Write the .vola index of the file entries and its spatial index."""
+    bboxes = [entry['bbox'] for entry in files]
+    tminx, tminy, tminz = [min(bbox[i] for bbox in bboxes) for i in range(3)]
+    tmaxx, tmaxy, tmaxz = [max(bbox[i] for bbox in bboxes)
+                           for i in range(3, 6)]
+    hdr = files[-1]
+
     vola = {}
     print("Depth:", hdr['depth'])
-    vola['dataset'] = infodata['dataset']
-    vola['info'] = infodata['info']
-    vola['url'] = infodata['url']
-    vola['author'] = infodata['author']
-    vola['authorurl'] = infodata['authorurl']
-    vola['license'] = infodata['license']
-    vola['licenseurl'] = infodata['licenseurl']
+    for key in INFO_KEYS:
+        vola[key] = infodata.get(key, "")
     vola['files'] = files
     vola['depth'] = hdr['depth']
     vola['nbits'] = hdr['nbits']
@@ -104,11 +108,70 @@ def main():
     vola['sides'] = [tmaxx - tminx, tmaxy - tminy, tmaxz - tminz]
     vola['centroid'] = ((tminx + tmaxx) / 2, (tminy + tmaxy) / 2,
                         (tminz + tmaxz) / 2)
+    carry_overviews(volaname, vola)
+
+    indexname = bu.sub(volaname, "volaidx")
+    print("writing spatial index:", indexname)
+    volaindex.build_index(bboxes).write(indexname)
+    vola['index'] = os.path.basename(indexname)
 
     volafile = open(volaname, 'w')
     volafile.write(json.dumps(vola, sort_keys=True, indent=2))
     volafile.close()
 
 
+def carry_overviews(volaname, vola):
+    """
+    Keep the overviews listed in an existing .vola index.
+
+    The overviews are only kept if the tiles are the ones they were made
+    from, the same files with the same size and modification time.
+    """
+    if not os.path.isfile(volaname):
+        return
+    with open(volaname) as old_file:
+        old = json.load(old_file)
+    if 'overviews' not in old:
+        return
+
+    def tiles(files):
+        """The identity of the tiles of an index."""
+        return [(entry['filename'], entry.get('size'), entry.get('mtime'))
+                for entry in files]
+
+    if tiles(old['files']) == tiles(vola['files']):
+        vola['overviews'] = old['overviews']
+    else:
+        print("Warning: the tiles have changed, dropping the overviews,",
+              "run volaoverview.py again")
+
+
+def read_entry(filename, stat):
+    """Read the header of a .vol file and build its index entry."""
+    with open(filename, "rb") as f:
+        hdr = bu.read_header(f)
+
+    minx, miny, minz = hdr['minx'], hdr['miny'], hdr['minz']
+    maxx, maxy, maxz = hdr['maxx'], hdr['maxy'], hdr['maxz']
+    bbox = [minx, miny, minz, maxx, maxy, maxz]
+    sides = [maxx - minx, maxy - miny, maxz - minz]
+    centroid = ((minx + maxx) / 2, (miny + maxy) / 2, (minz + maxz) / 2)
+
+    return {
+        'filename': filename,
+        'bbox': bbox,
+        'centroid': centroid,
+        'sides': sides,
+        'crs': hdr['crs'],
+        'lat': hdr['lat'],
+        'lon': hdr['lon'],
+        'depth': hdr['depth'],
+        'nbits': hdr['nbits'],
+        'mode': hdr['mode'],
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns
+    }
+
+
 if __name__ == '__main__':
     main()
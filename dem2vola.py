@@ -1,123 +1,238 @@
 #!/usr/bin/env python3
 """
-Reads data from ESRI ascii Grids
-@deprecated This has not been used since version 0.9
+Converts ESRI ascii grids (digital elevation models) into VOLA format.
+
+The grid is read in bulk with numpy and the cell centres are reprojected
+from --srccrs to --crs in one batched transform. Each cell sets the
+voxels of its column from its own height down to just above its lowest
+neighbour, so steep slopes have no holes, and with --base the columns
+are filled down to a base height. The columns are made as integer voxel
+keys, without a point per voxel. Choose a depth that gives voxels no
+smaller than the cells, finer voxels leave gaps between the columns.
+There is no information other than heights so the occupancy information
+is only available for this format.
 @author Jonathan Byrne & Anton Shmatov
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
 from __future__ import print_function
-from collections import namedtuple
-import sys
 import glob
+import os
+import numpy as np
 import pyproj
+import binutils as bu
+import volaraster
 from volatree import VolaTree
 
+# header keys of an ESRI ascii grid
+HEADER_KEYS = ['ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter',
+               'yllcenter', 'cellsize', 'nodata_value']
 
-def main(filestring, depth):
-    """Read the file, build the tree. Write a Binary."""
-    for filename in glob.glob(filestring):
-        outfilename = filename.replace('aaigrid', 'vol')
-
-        print("converting", filename, "to", outfilename)
-        header = parse_grid_header(filename)
-        bbox = [header['min'], header['max']]
-        data = parse_grid_data(filename, header)
-        volatree = VolaTree(depth, bbox, 2000, False, 0)
-        volatree.cubify(data)
-        volatree.writebin(outfilename)
+# most column voxels made at a time
+BATCHSIZE = 4 * 1024 * 1024
 
-        bu.print_ratio(filename, outfilename)
-        # volatree.printlevel(depth, True)
 
+def main():
+    """Read the file, build the tree. Write a Binary."""
+    start_time = bu.timer()
+    parser = bu.parser_args("*.asc / *.aaigrid")
+    parser.add_argument(
+        "--srccrs",
+        help="the coordinate system of the grid, the cells are reprojected\
+              from it to --crs, e.g., 4326 (wgs84 epsg code)",
+        type=int)
+    parser.add_argument(
+        "--base",
+        help="fill the columns under the surface down to this height",
+        type=float)
+    parser = bu.add_grid(parser)
+    args = parser.parse_args()
+    bu.check_grid(parser, args)
+
+    # Parse directories or filenames, whichever you want!
+    if os.path.isdir(args.input):
+        filenames = glob.glob(os.path.join(args.input, '*.asc'))
+        filenames.extend(glob.glob(os.path.join(args.input, '*.aaigrid')))
+    else:
+        filenames = glob.glob(args.input)
+
+    print("processing: ", ' '.join(filenames))
+    for filename in filenames:
+        if args.dense:
+            outfilename = bu.sub(filename, "dvol")
+        else:
+            outfilename = bu.sub(filename, "vol")
+        if os.path.isfile(outfilename):
+            print("File already exists!")
+            continue
 
-def parse_grid_header(filename):
-    """Read ESRI Grid format point data and return header and points."""
-    infile = open(filename, 'r')
+        print("converting", filename, "to", outfilename)
+        print("DEM only has occupancy data," +
+              " no additional data is being added")
+        if convert_grid(filename, outfilename, args):
+            bu.print_ratio(filename, outfilename)
+        else:
+            print("The grid has no data!")
+    bu.timer(start_time)
+
+
+def convert_grid(filename, outfilename, args):
+    """
+    Add the columns of the grid cells to a VolaTree and write it.
+
+    Returns False if every cell is nodata.
+    """
+    header, heights = parse_grid(filename)
+    valid = np.isfinite(heights)
+    if 'nodata_value' in header:
+        valid &= heights != header['nodata_value']
+    if not np.any(valid):
+        return False
+
+    points = cell_centres(header, valid, heights)
+    if args.srccrs is not None and args.srccrs != args.crs:
+        print("reprojecting", len(points), "cells from epsg:" +
+              str(args.srccrs), "to epsg:" + str(args.crs))
+        points[:, 0], points[:, 1] = reproject(points[:, 0], points[:, 1],
+                                               args.srccrs, args.crs)
+
+    minvals = points.min(axis=0)
+    maxvals = points.max(axis=0)
+    if args.base is not None:
+        minvals[2] = min(minvals[2], args.base)
+        maxvals[2] = max(maxvals[2], args.base)
+    bbox = [minvals.tolist(), maxvals.tolist()]
+
+    volatree = VolaTree(args.depth, bbox, args.crs, args.dense, 0,
+                        args.gridorigin, args.cubesize)
+    keys = volatree.getkeys(points)
+    basekey = None
+    if args.base is not None:
+        basekey = volatree.getkeys([[minvals[0], minvals[1], args.base]])[0, 2]
+    low = column_bottoms(valid, keys[:, 2], basekey)
+    columns, low, high = merge_columns(keys, low)
+
+    counts = high - low + 1
+    for start, stop in volaraster.batches(counts, BATCHSIZE):
+        column, within = volaraster.expand(counts[start:stop])
+        column += start
+        voxels = np.empty((len(column), 3), dtype=np.int64)
+        voxels[:, :2] = columns[column]
+        voxels[:, 2] = low[column] + within
+        volatree.addvoxels(voxels)
+    volatree.build()
+    volatree.countlevels()
+    volatree.writebin(outfilename)
+    return True
+
+
+def read_grid_header(gridfile):
+    """
+    Read the header lines of an ESRI ascii grid.
+
+    Returns the values by their lower case name and the number of lines.
+    """
     header = {}
-
-    ncols = int(infile.readline().split()[1])
-    nrows = int(infile.readline().split()[1])
-    xllcorner = float(infile.readline().split()[1])
-    yllcorner = float(infile.readline().split()[1])
-    cellsize = float(infile.readline().split()[1])
-
-    maxx = xllcorner + (ncols * cellsize)
-    maxy = yllcorner + (nrows * cellsize)
-    header['min'] = [xllcorner, yllcorner, 0]
-    header['max'] = [maxx, maxy, 1000]
-    header['rows'] = nrows
-    header['cols'] = ncols
-    header['cellsize'] = cellsize
-    return header
-
-
-def parse_grid_data(filename, header, lasout=False):
-    """Turning the grid into points for standardised interface."""
-    itm = pyproj.Proj(init='epsg:2157')
-    # irishgrid = pyproj.Proj(init='epsg:29902')
-    wgs84 = pyproj.Proj(init='epsg:4326')
-
-    infile = open(filename, 'r')
-    data = []
-    minz = float("inf")
-    maxz = float("-inf")
-    linecnt = 0
-    point = namedtuple('Point', 'x y z')
-    minx = header['min'][0]
-    miny = header['min'][1]
-    csize = header['cellsize']
-
-    # Ignore the header
-    line = infile.readline()
-    while len(line) < 40:
-        line = infile.readline()
-
-    if lasout:
-        outfilename = filename.replace('aaigrid', 'xyz')
-        outfile = open(outfilename, 'w')
-
-    for line in infile:
-        linecnt += 1
-        print("processing row", linecnt)
-
-        line = line.rstrip()
-        row = [int(x) for x in line.split()]
-        rowmax = max(row)
-        rowmin = min(row)
-
-        if rowmax > maxz:
-            maxz = rowmax
-        if rowmin < minz:
-            minz = rowmin
-
-        for idx, z in enumerate(row):
-            x = minx + (csize * idx)
-            y = miny + (csize * (header['rows'] - linecnt))
-            transform = pyproj.transform(wgs84, itm, x, y)
-            if lasout:
-                outfile.write(
-                    str(transform[0]) + ' ' + str(transform[1]) + ' ' + str(z)
-                    + '\n')
-            data.append(point(x=transform[0], y=transform[1], z=z))
-
-    reproj = pyproj.transform(wgs84, itm, header['min'][0], header['min'][1])
-    header['min'][0] = reproj[0]
-    header['min'][1] = reproj[1]
-    header['min'][2] = minz
-
-    reproj = pyproj.transform(wgs84, itm, header['max'][0], header['max'][1])
-    header['max'][0] = reproj[0]
-    header['max'][1] = reproj[1]
-    header['max'][2] = maxz
-
-    if lasout:
-        print("writing file:", outfilename)
-        outfile.close()
-    return data
+    nlines = 0
+    while True:
+        pos = gridfile.tell()
+        words = gridfile.readline().decode('ascii').split()
+        if not words or words[0].lower() not in HEADER_KEYS:
+            gridfile.seek(pos)
+            break
+        header[words[0].lower()] = float(words[1])
+        nlines += 1
+    for key in ('ncols', 'nrows', 'cellsize'):
+        if key not in header:
+            raise ValueError("the grid header has no " + key)
+    return header, nlines
+
+
+def parse_grid(filename):
+    """Read an ESRI ascii grid, returns the header and (rows, cols) heights."""
+    with open(filename, 'rb') as gridfile:
+        header, nlines = read_grid_header(gridfile)
+    nrows, ncols = int(header['nrows']), int(header['ncols'])
+
+    # rows can be split over several lines so only the total is checked
+    chunks = [rows.reshape(-1) for rows in bu.read_text(filename, nlines)]
+    heights = np.concatenate(chunks) if chunks else np.zeros(0)
+    if len(heights) != nrows * ncols:
+        raise ValueError(filename + " has " + str(len(heights)) +
+                         " values, not " + str(nrows * ncols))
+    print("grid of", nrows, "rows and", ncols, "columns")
+    return header, heights.reshape(nrows, ncols)
+
+
+def cell_centres(header, valid, heights):
+    """The x, y, z of the centres of the valid cells, the first row is north."""
+    cellsize = header['cellsize']
+    if 'xllcenter' in header:
+        xfirst = header['xllcenter']
+    else:
+        xfirst = header['xllcorner'] + cellsize / 2
+    if 'yllcenter' in header:
+        ylast = header['yllcenter']
+    else:
+        ylast = header['yllcorner'] + cellsize / 2
+
+    rows, cols = np.nonzero(valid)
+    points = np.empty((len(rows), 3))
+    points[:, 0] = xfirst + cols * cellsize
+    points[:, 1] = ylast + (heights.shape[0] - 1 - rows) * cellsize
+    points[:, 2] = heights[valid]
+    return points
+
+
+def reproject(xvals, yvals, srccrs, crs):
+    """Transform arrays of x and y between two epsg codes in one go."""
+    source = pyproj.Proj(init='epsg:' + str(srccrs))
+    target = pyproj.Proj(init='epsg:' + str(crs))
+    return pyproj.transform(source, target, xvals, yvals)
+
+
+def column_bottoms(valid, zkeys, basekey=None):
+    """
+    The lowest voxel of the column of each valid cell.
+
+    A column reaches down to one above the lowest of its four neighbours
+    so that neighbouring columns touch, or to basekey if it is given.
+    """
+    top = np.iinfo(np.int64).max
+    zgrid = np.full(valid.shape, top, dtype=np.int64)
+    zgrid[valid] = zkeys
+    padded = np.pad(zgrid, 1, mode='constant', constant_values=top)
+    lowest = np.minimum(np.minimum(padded[:-2, 1:-1], padded[2:, 1:-1]),
+                        np.minimum(padded[1:-1, :-2], padded[1:-1, 2:]))
+    lowest = lowest[valid]
+    low = zkeys.copy()
+    lower = lowest < zkeys
+    low[lower] = lowest[lower] + 1
+    if basekey is not None:
+        low = np.minimum(low, basekey)
+    return low
+
+
+def merge_columns(keys, low):
+    """
+    Join the columns of cells in the same voxel column.
+
+    Cells smaller than the voxels share voxel columns, the columns of
+    neighbouring cells touch so the voxel column runs from the lowest to
+    the highest of them. Returns the x, y keys of each voxel column and
+    its lowest and highest z key.
+    """
+    # keys outside the grid tile can be negative
+    corner = keys[:, :2].min(axis=0)
+    side = np.int64(keys[:, 1].max() - corner[1]) + 1
+    colkeys = (keys[:, 0] - corner[0]) * side + keys[:, 1] - corner[1]
+    order = np.argsort(colkeys, kind='mergesort')
+    colkeys = colkeys[order]
+    starts = np.concatenate(([0], np.nonzero(np.diff(colkeys))[0] + 1))
+    columns = keys[order[starts], :2]
+    low = np.minimum.reduceat(low[order], starts)
+    high = np.maximum.reduceat(keys[order, 2], starts)
+    return columns, low, high
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print("Usage %s <filename> <treedepth>" % sys.argv[0])
-        exit()
-    main(sys.argv[1], int(sys.argv[2]))
+    main()
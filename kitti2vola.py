@@ -5,22 +5,43 @@ Converts bin files from the kitti dataset into VOLA format.
 Kitti is a LIDAR dataset for automotive testing. The dataset
 stores an intensity value which is converted to a greyscale
 color for nbits VOLA.
+With --sequence the scans are treated as the frames of one drive: they
+share the bbox of the whole drive so the frames line up, are converted by
+a pool of processes and a frames.json index of the frames and their
+timestamps (from the timestamps.txt or times.txt of the drive) is written
+next to them.
 @author Ananya Gupta and Jonathan Byrne
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
 from __future__ import print_function
 import glob
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import binutils as bu
 from volatree import VolaTree
 
+# names of the timestamp files of the raw and odometry kitti datasets
+TIMESTAMP_FILES = ['timestamps.txt', 'times.txt']
+
 
 def main():
     """Read the file, build the tree. Write a Binary."""
     start_time = bu.timer()
     parser = bu.parser_args("*.bin")
+    parser.add_argument(
+        "-s", "--sequence",
+        help="convert the files as the frames of one drive, with a shared\
+              bbox and a frames.json index",
+        action='store_true')
+    parser.add_argument(
+        "--workers",
+        help="number of processes converting the frames of a sequence",
+        type=int)
+    parser = bu.add_grid(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -28,63 +49,167 @@ def main():
     else:
         filenames = glob.glob(args.input)
 
+    # the greyscale colour fits in one chunk
+    if args.nbits:
+        print("nbits set, adding metadata to occupancy grid")
+        nbits = 1
+    else:
+        print("Only occupancy data being set! Use -n flag to add metadata")
+        nbits = 0
+
+    if args.sequence:
+        convert_sequence(sorted(filenames), args, nbits)
+        bu.timer(start_time)
+        return
+
     print("processing: ", ' '.join(filenames))
     for filename in filenames:
-        if args.dense:
-            outfilename = bu.sub(filename, "dvol")
-        else:
-            outfilename = bu.sub(filename, "vol")
+        outfilename = out_name(filename, args.dense)
         if os.path.isfile(outfilename):
             print("File already exists!")
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_bin(filename, args.nbits)
-
-        # work out how many chunks are required for the data
-        if args.nbits:
-            print("nbits set, adding metadata to occupancy grid")
-            div, mod = divmod(len(pointsdata[0]), 8)
-            if mod > 0:
-                nbits = div + 1
-            else:
-                nbits = div
-        else:
-            print("Only occupancy data being set! Use -n flag to add metadata")
-            nbits = 0
-
-        if len(points) > 0:
-            volatree = VolaTree(args.depth, bbox, args.crs,
-                                args.dense, nbits)
-            volatree.cubify(points, pointsdata)
-            volatree.countlevels()
-            volatree.writebin(outfilename)
-
+        bbox = scan_bbox(filename)
+        if bbox is not None:
+            convert_bin((filename, outfilename, bbox, args, nbits))
             bu.print_ratio(filename, outfilename)
         else:
-            print("The las file is empty!")
+            print("The bin file is empty!")
     bu.timer(start_time)
 
 
-def parse_bin(filename, nbits):
-    """Read in float values and reshape to 2d numpy array."""
+def out_name(filename, dense):
+    """The .vol or .dvol name of a scan."""
+    if dense:
+        return bu.sub(filename, "dvol")
+    return bu.sub(filename, "vol")
+
+
+def convert_bin(job):
+    """Build and write the tree of one scan."""
+    filename, outfilename, bbox, args, nbits = job
+    points, pointsdata = parse_bin(filename, nbits)
+    volatree = VolaTree(args.depth, bbox, args.crs,
+                        args.dense, nbits,
+                        args.gridorigin, args.cubesize)
+    volatree.cubify(points, pointsdata)
+    volatree.countlevels()
+    volatree.writebin(outfilename)
+    return outfilename
+
+
+def convert_sequence(filenames, args, nbits):
+    """
+    Convert the frames of a drive with the bbox of all of them.
+
+    Frames that are already converted are not converted again but are
+    still in the index.
+    """
+    if not filenames:
+        print("No .bin files found!")
+        return
+    dirname = os.path.dirname(filenames[0])
+    print("processing", len(filenames), "frames in", dirname or '.')
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        bboxes = [bbox for bbox in pool.map(scan_bbox, filenames)
+                  if bbox is not None]
+        if not bboxes:
+            print("The bin files are empty!")
+            return
+        bbox = [np.min([low for low, _ in bboxes], axis=0).tolist(),
+                np.max([high for _, high in bboxes], axis=0).tolist()]
+        print("sequence bbox:", bbox)
+
+        jobs = []
+        for filename in filenames:
+            outfilename = out_name(filename, args.dense)
+            if os.path.isfile(outfilename):
+                print("File already exists!", outfilename)
+            elif os.path.getsize(filename) == 0:
+                print("The bin file is empty!", filename)
+            else:
+                jobs.append((filename, outfilename, bbox, args, nbits))
+        print("converting", len(jobs), "frames")
+        list(pool.map(convert_bin, jobs))
+
+    timestamps = read_timestamps(dirname)
+    frames = []
+    for idx, filename in enumerate(filenames):
+        outfilename = out_name(filename, args.dense)
+        if not os.path.isfile(outfilename):
+            continue
+        name = os.path.splitext(os.path.basename(filename))[0]
+        frame = int(name) if name.isdigit() else idx
+        timestamp = None
+        if frame < len(timestamps):
+            timestamp = timestamps[frame]
+        frames.append({
+            'frame': frame,
+            'filename': os.path.basename(outfilename),
+            'timestamp': timestamp
+        })
+    if not timestamps:
+        print("No timestamps file found, the frames have no timestamps")
+
+    indexname = os.path.join(dirname, "frames.json")
+    print("writing frame index:", indexname)
+    with open(indexname, 'w') as indexfile:
+        indexfile.write(json.dumps({
+            'bbox': bbox,
+            'depth': args.depth,
+            'nbits': nbits,
+            'crs': args.crs,
+            'frames': frames
+        }, sort_keys=True, indent=2))
+
+
+def read_timestamps(dirname):
+    """
+    The timestamps of the frames in a folder, one per line.
+
+    Raw drives keep them in timestamps.txt beside the data folder and the
+    odometry sequences in times.txt beside the velodyne folder.
+    """
+    parent = os.path.dirname(os.path.abspath(dirname))
+    for folder in (dirname, parent):
+        for name in TIMESTAMP_FILES:
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                with open(path) as timesfile:
+                    return [line.strip() for line in timesfile
+                            if line.strip()]
+    return []
+
+
+def read_scan(filename):
+    """The x, y, z, intensity rows of a scan."""
     scan = np.fromfile(filename, dtype=np.float32)
-    data = scan.reshape((-1, 4))
-    points = data[:, :3]
-    minvals = points.min(axis=0).tolist()
-    maxvals = points.max(axis=0).tolist()
-    bbox = [minvals, maxvals]
+    return scan.reshape((-1, 4))
+
 
+def scan_bbox(filename):
+    """Bounding box of the points of a scan, or None if it is empty."""
+    points = read_scan(filename)[:, :3]
+    if len(points) == 0:
+        return None
+    return [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+
+
+def parse_bin(filename, nbits):
+    """Read the points of a scan and, with nbits, their greyscale colour."""
+    data = read_scan(filename)
+    points = data[:, :3]
     if nbits:
-        pointsdata = data[:, 3:]
-        # All values are nonzero otherwise they wont render
-        for x in np.nditer(pointsdata, op_flags=['readwrite']):
-            x[...] = bu.normalize(x, -.2, 1)
-        pointsdata = np.repeat(pointsdata, 3, axis=1)
-        pointsdata = np.multiply(pointsdata, 255).astype(int)
-        return bbox, points, pointsdata
+        # intensity from -.2 to 1 as a grey between 0 and 255, scaled in
+        # float64 and stored as float32 like the per point normalize was
+        grey = np.clip((data[:, 3].astype(np.float64) + .2) / 1.2, 0, 1)
+        grey = (grey.astype(np.float32) * 255).astype(int)
+        pointsdata = np.repeat(grey[:, np.newaxis], 3, axis=1)
+        return points, pointsdata
     else:
-        return bbox, points, None
+        return points, None
 
 
 if __name__ == '__main__':
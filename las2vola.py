@@ -6,24 +6,51 @@ The ISPRS las format is the standard for LIDAR devices and stores information
 on the points obtained. This parser uses the las information
 for the nbit per voxel representation. The data stored is: color, height,
 number of returns, intensity and classification
+
+With --tile a (large) las file is streamed in chunks and split into cubic
+tiles of a given size in crs units, or into the tiles of the global grid
+if --cubesize is given. The voxels of each tile are kept in run files on
+disk until all points are read, then the tiles are built in parallel and
+written into a folder along with a .vola dataset index.
 @author Jonathan Byrne & Anton Shmatov
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
 from __future__ import print_function
 import glob
+import json
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import binutils as bu
+import datasetparser
 from laspy import file as lasfile
 from laspy.util import LaspyException
-from volatree import VolaTree
+from volatree import VolaTree, last_unique
 
 
 def main():
     """Read the file, build the tree. Write a Binary."""
     start_time = bu.timer()
     parser = bu.parser_args("*.las / *.laz")
+    parser.add_argument(
+        "--tile",
+        help="split the points into cubic tiles of this size (in crs units)\
+              and write a folder of .vol tiles with a .vola index. With\
+              --cubesize the tiles are the grid tiles of the depth",
+        type=float)
+    parser.add_argument(
+        "--chunksize",
+        help="number of points read from the las file at a time",
+        type=int, default=1000000)
+    parser.add_argument(
+        "--workers",
+        help="number of processes building the tiles",
+        type=int)
+    parser = bu.add_grid(parser)
+    parser = add_filters(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -34,6 +61,9 @@ def main():
 
     print("processing: ", ' '.join(filenames))
     for filename in filenames:
+        if args.tile:
+            tile_las(filename, args)
+            continue
         if args.dense:
             outfilename = bu.sub(filename, "dvol")
         else:
@@ -43,78 +73,334 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_las(filename, args.nbits)
-
-        # work out how many chunks are required for the data
         if args.nbits:
             print("nbits set, adding metadata to occupancy grid")
-            div, mod = divmod(len(pointsdata[0]), 8)
-            if mod > 0:
-                nbits = div + 1
-            else:
-                nbits = div
+            nbits = 1
         else:
             print("Only occupancy data being set! Use -n flag to add metadata")
             nbits = 0
 
-        if len(points) > 0:
-            volatree = VolaTree(args.depth, bbox, args.crs,
-                                args.dense, nbits)
-            volatree.cubify(points, pointsdata)
-            volatree.writebin(outfilename)
-
+        if convert_las(filename, outfilename, args, nbits):
             bu.print_ratio(filename, outfilename)
         else:
-            print("The las file is empty!")
+            print("The las file is empty (after filtering)!")
     bu.timer(start_time)
 
 
-def parse_las(filename, nbits):
-    """Read las format point data and return header and points."""
+def add_filters(parser):
+    """Arguments for selecting the points that are converted."""
+    parser.add_argument(
+        "--classes",
+        help="only convert points of these classifications, e.g. 2 (ground)",
+        type=int, nargs='+')
+    parser.add_argument(
+        "--returnnumber",
+        help="only convert points with these return numbers, e.g. 1 (first)",
+        type=int, nargs='+')
+    parser.add_argument(
+        "--lastreturn",
+        help="only convert the last return of each pulse",
+        action='store_true')
+    parser.add_argument(
+        "--intensityrange",
+        help="only convert points with an intensity in this range",
+        type=float, nargs=2, metavar=('MIN', 'MAX'))
+    parser.add_argument(
+        "--zrange",
+        help="only convert points with a height in this range",
+        type=float, nargs=2, metavar=('MIN', 'MAX'))
+    parser.add_argument(
+        "--clip",
+        help="only convert points inside this box",
+        type=float, nargs=6,
+        metavar=('MINX', 'MINY', 'MINZ', 'MAXX', 'MAXY', 'MAXZ'))
+    return parser
+
+
+def has_filters(args):
+    """Check if any of the point filters are set."""
+    return bool(args.classes or args.returnnumber or args.lastreturn or
+                args.intensityrange or args.zrange or args.clip)
+
+
+def filter_mask(pointfile, start, stop, points, args):
+    """Mask of the points of a slice that pass the filters."""
+    mask = np.ones(len(points), dtype=np.bool_)
+    if args.classes:
+        mask &= np.isin(classifications(pointfile, start, stop), args.classes)
+    if args.returnnumber or args.lastreturn:
+        returnnumber, numreturns = returns(pointfile, start, stop)
+        if args.returnnumber:
+            mask &= np.isin(returnnumber, args.returnnumber)
+        if args.lastreturn:
+            mask &= returnnumber == numreturns
+    if args.intensityrange:
+        intensity = pointfile.intensity[start:stop]
+        mask &= (intensity >= args.intensityrange[0]) & \
+            (intensity <= args.intensityrange[1])
+    if args.zrange:
+        mask &= (points[:, 2] >= args.zrange[0]) & \
+            (points[:, 2] <= args.zrange[1])
+    if args.clip:
+        mask &= np.all((points >= args.clip[:3]) &
+                       (points <= args.clip[3:]), axis=1)
+    return mask
+
+
+def is_las14(pointfile):
+    """Check if the points use the las 1.4 point formats 6 to 10."""
+    return pointfile.header.data_format_id >= 6
+
+
+def returns(pointfile, start, stop):
+    """
+    The return number and number of returns of a slice of points.
+
+    The las 1.4 point formats hold them in 4 bits each of the flag byte,
+    the older formats in bits 0-2 and 3-5.
+    """
+    flags = pointfile.flag_byte[start:stop]
+    if is_las14(pointfile):
+        return flags & 15, (flags >> 4) & 15
+    return flags & 7, (flags >> 3) & 7
+
+
+def classifications(pointfile, start, stop):
+    """
+    The classification of a slice of points.
+
+    The las 1.4 point formats have a whole byte for it, the older ones
+    the low 5 bits of the classification byte.
+    """
+    if is_las14(pointfile):
+        return pointfile.classification_byte[start:stop]
+    return pointfile.raw_classification[start:stop] & 31
+
+
+def convert_las(filename, outfilename, args, nbits):
+    """
+    Stream a las file into a VolaTree chunk by chunk and write it.
+
+    Only a few chunks of points are held in memory at a time, the tree
+    keeps the voxels found so far. Returns False if the file is empty.
+    """
     pointfile = lasfile.File(filename, mode='r')
+    total = len(pointfile)
+    if total == 0:
+        return False
+    bbox = las_bbox(pointfile, args.chunksize, args)
+    if bbox is None:
+        return False
+    maxheight = pointfile.header.max[2]
+
+    volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits,
+                        args.gridorigin, args.cubesize)
+    for start in range(0, total, args.chunksize):
+        stop = min(start + args.chunksize, total)
+        points, pointsdata = read_points(pointfile, start, stop, nbits,
+                                         maxheight, args)
+        volatree.addpoints(points, pointsdata)
+    pointfile.close()
+    volatree.writebin(outfilename)
+    return True
+
+
+def las_bbox(pointfile, chunksize, args=None):
+    """
+    Bounding box of the points, from the raw fields chunk by chunk.
+
+    If filters are set the box only covers the points that pass them, so
+    the voxels keep the full resolution for the points that are kept.
+    Returns None if no points pass.
+    """
     header = pointfile.header
-    maxheight = header.max[2]
-    points = np.array((pointfile.x, pointfile.y, pointfile.z)).transpose() # get all points, change matrix orientation
-    pointsdata = np.zeros((len(pointfile), 7), dtype=np.int)
+    if args is not None and has_filters(args):
+        low, high = [], []
+        for start in range(0, len(pointfile), chunksize):
+            points, _ = read_points(pointfile, start, start + chunksize, 0,
+                                    0, args)
+            if len(points):
+                low.append(points.min(axis=0))
+                high.append(points.max(axis=0))
+        if not low:
+            return None
+        return [np.min(low, axis=0).tolist(), np.max(high, axis=0).tolist()]
 
-    if nbits > 0: # if want to set other data, find in matrices
-        try:
-            red = pointfile.red
-        except LaspyException:
-            red = [0] * len(points)
+    bbox = [[], []]
+    for axis, raw in enumerate((pointfile.X, pointfile.Y, pointfile.Z)):
+        low = min(raw[start:start + chunksize].min()
+                  for start in range(0, len(raw), chunksize))
+        high = max(raw[start:start + chunksize].max()
+                   for start in range(0, len(raw), chunksize))
+        bbox[0].append(low * header.scale[axis] + header.offset[axis])
+        bbox[1].append(high * header.scale[axis] + header.offset[axis])
+    return bbox
 
-        try:
-            green = pointfile.green
-        except LaspyException:
-            green = [0] * len(points)
 
+def read_points(pointfile, start, stop, nbits, maxheight, args=None):
+    """
+    Read a slice of the points of an open las file.
+
+    Only the [start:stop] slice of the memory mapped raw fields is scaled
+    so the whole file is never held in memory. If args has filters set
+    only the points passing them are kept. Returns the points and, if
+    nbits is set, the 7 bytes of data of each point: color, height,
+    number of returns, intensity and classification.
+    """
+    header = pointfile.header
+    scale, offset = header.scale, header.offset
+    points = np.empty((len(pointfile.X[start:stop]), 3))
+    for axis, raw in enumerate((pointfile.X, pointfile.Y, pointfile.Z)):
+        np.multiply(raw[start:stop], scale[axis], out=points[:, axis])
+        points[:, axis] += offset[axis]
+
+    mask = None
+    if args is not None and has_filters(args):
+        mask = filter_mask(pointfile, start, stop, points, args)
+        points = points[mask]
+    if nbits == 0:
+        return points, None
+
+    def field(name):
+        """The slice of a field for the points that are kept."""
+        values = getattr(pointfile, name)[start:stop]
+        return values if mask is None else values[mask]
+
+    pointsdata = np.empty((len(points), 7), dtype=np.int64)
+    for col, color in enumerate(('red', 'green', 'blue')):
         try:
-            blue = pointfile.blue
+            np.floor_divide(field(color), 256, out=pointsdata[:, col])
         except LaspyException:
-            blue = [0] * len(points)
+            pointsdata[:, col] = 0
+    # if all three colours are 0, set to 200
+    pointsdata[~pointsdata[:, :3].any(axis=1), :3] = 200
+
+    scaleddata = pointsdata[:, 3:]
+    scaleddata[:, 0] = points[:, 2]
+    numreturns = returns(pointfile, start, stop)[1]
+    scaleddata[:, 1] = numreturns if mask is None else numreturns[mask]
+    scaleddata[:, 2] = field('intensity')
+    classes = classifications(pointfile, start, stop)
+    scaleddata[:, 3] = classes if mask is None else classes[mask]
+
+    minval = np.array([0, 1, 0, 0])
+    if is_las14(pointfile):
+        maxval = np.array([maxheight, 15, 1000, 255])
+    else:
+        maxval = np.array([maxheight, 7, 1000, 31])
+    scaleddata[:] = bu.normalize_np(scaleddata, minval, maxval) * 255
+    return points, pointsdata
+
 
-        coldata = np.int64(np.array([red, green, blue]).transpose() / 256)
-        scaleddata = np.array([pointfile.get_z(), pointfile.get_num_returns(), 
-            pointfile.intensity, pointfile.raw_classification], dtype='int64').transpose()
+def tile_las(filename, args):
+    """Stream a las file into tiles and write them with a .vola index."""
+    outdir = os.path.splitext(filename)[0]
+    volaname = os.path.join(outdir, os.path.basename(outdir) + ".vola")
+    if os.path.isfile(volaname):
+        print("File already exists!")
+        return
+    # start from empty runs as they are appended to
+    rundir = os.path.join(outdir, "runs")
+    if os.path.exists(rundir):
+        shutil.rmtree(rundir)
+    os.makedirs(rundir)
+    nbits = 1 if args.nbits else 0
+    sidelength = pow(4, args.depth)
+    tileside = args.tile
+    origin = np.zeros(3)
+    if args.cubesize:
+        # on a global grid the tiles are the grid tiles of the depth
+        tileside = args.cubesize * sidelength
+        if args.gridorigin:
+            origin = np.array(args.gridorigin)
+        print("grid tile size:", tileside)
 
-        min = np.array([0, 1, 0, 0])
-        max = np.array([maxheight, 7, 1000, 31])
-        normdata = np.int64(bu.normalize_np(scaleddata, min, max) * 255)
+    pointfile = lasfile.File(filename, mode='r')
+    maxheight = pointfile.header.max[2]
+    total = len(pointfile)
+    print("tiling", filename, "with", total, "points into", outdir)
 
-        coldata[(coldata[:, 0] == 0) & (coldata[:, 1] == 0) &
-            (coldata[:, 2] == 0)] = 200 # if all three colours are 0, set to 200
+    tiles = set()
+    for start in range(0, total, args.chunksize):
+        stop = min(start + args.chunksize, total)
+        print("reading points", start, "to", stop)
+        points, pointsdata = read_points(pointfile, start, stop, nbits,
+                                         maxheight, args)
+        # tiles are numbered globally so neighbouring files line up
+        if args.cubesize:
+            voxels = np.int64(np.floor((points - origin) / args.cubesize))
+            tileidx = voxels // sidelength
+            keys = voxels - tileidx * sidelength
+        else:
+            tilepos = points / tileside
+            tileidx = np.int64(np.floor(tilepos))
+            # voxel k covers k to k + 1 sidelength-ths of the tile, as on
+            # a global grid, so the border voxels of neighbouring tiles do
+            # not overlap
+            voxels = np.floor((tilepos - tileidx) * sidelength)
+            keys = np.clip(np.int64(voxels), 0, sidelength - 1)
+        codes = bu.morton_codes(keys, args.depth)
+        if nbits:
+            payloads = bu.pack_payloads(pointsdata)
+        else:
+            payloads = np.zeros(len(points), dtype=np.uint64)
 
-        pointsdata = np.concatenate([coldata, normdata], axis=1)
+        # group the points by tile, keeping their order within each tile
+        tiled, inverse = np.unique(tileidx, axis=0, return_inverse=True)
+        order = np.argsort(inverse.reshape(-1), kind='mergesort')
+        bounds = np.cumsum(np.bincount(inverse.reshape(-1)))[:-1]
+        for tile, group in zip(map(tuple, tiled.tolist()),
+                               np.split(order, bounds)):
+            tiles.add(tile)
+            tilecodes, tilepayloads = last_unique(codes[group],
+                                                  payloads[group])
+            runname = os.path.join(rundir, "{}_{}_{}".format(*tile))
+            with open(runname + ".codes", 'ab') as runfile:
+                runfile.write(tilecodes.tobytes())
+            with open(runname + ".data", 'ab') as runfile:
+                runfile.write(tilepayloads.tobytes())
+    pointfile.close()
+    if not tiles:
+        print("The las file is empty!")
+        return
 
-    if len(points) == 0:
-        return [], [], None
+    base = os.path.join(outdir, os.path.basename(outdir))
+    jobs = []
+    for tile in sorted(tiles):
+        tilemin = origin + np.array(tile) * tileside
+        bbox = [tilemin.tolist(), (tilemin + tileside).tolist()]
+        outfilename = "{}_{}_{}_{}.{}".format(
+            base, tile[0], tile[1], tile[2], "dvol" if args.dense else "vol")
+        runname = os.path.join(rundir, "{}_{}_{}".format(*tile))
+        jobs.append((runname, outfilename, args.depth, bbox, args.crs,
+                     args.dense, nbits))
 
-    bbox = [points.min(axis=0).tolist(), points.max(axis=0).tolist()]
+    print("building", len(jobs), "tiles")
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        outfilenames = list(pool.map(build_tile, jobs))
+    shutil.rmtree(rundir)
 
-    if nbits:
-        return bbox, points, pointsdata
+    infofile = os.path.join(os.path.dirname(filename), "info.json")
+    infodata = {}
+    if os.path.isfile(infofile):
+        with open(infofile) as data_file:
+            infodata = json.load(data_file)
     else:
-        return bbox, points, None
+        print("Missing attribution info file!! Add it to", volaname)
+    files = [datasetparser.read_entry(name, os.stat(name))
+             for name in outfilenames]
+    datasetparser.write_vola(volaname, files, infodata)
+
+
+def build_tile(job):
+    """Build and write one tile from its run files."""
+    runname, outfilename, depth, bbox, crs, dense, nbits = job
+    codes = np.fromfile(runname + ".codes", dtype=np.uint64)
+    payloads = np.fromfile(runname + ".data", dtype=np.uint64)
+    volatree = VolaTree(depth, bbox, crs, dense, nbits)
+    volatree.addcodes(codes, payloads)
+    volatree.writebin(outfilename)
+    return outfilename
 
 
 if __name__ == '__main__':
@@ -2,7 +2,11 @@
 """
 npy2vola: Converts numpy arrays into VOLA format.
 
-Converting numpy depth images with a fixed grid size of 256
+Converts bool or uint8 occupancy grids indexed [x, y, z] of any size. The
+grid is padded to a side that is a power of 4 and made into the levels
+directly (see VolaTree.set_grid). The .npy file is memory mapped and read
+a cube at a time, so grids larger than memory can be converted to sparse
+files. With --cubesize the cells are snapped to the global grid instead.
 There is no information other than voxels so the occupancy information
 is only available for this format.
 @author Jonathan Byrne & Anton Shmatov
@@ -15,12 +19,17 @@ import numpy as np
 import binutils as bu
 from volatree import VolaTree
 
+# x slices of the grid read at a time when snapping to a global grid
+SLAB = 64
+
 
 def main():
     """Read the file, build the tree. Write a Binary."""
     start_time = bu.timer()
     parser = bu.parser_args("*.npy")
+    parser = bu.add_grid(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -39,30 +48,43 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_npy(filename)
+        grid = parse_npy(filename)
+        if grid.ndim != 3:
+            print("The array needs to be a 3d grid!")
+            continue
 
         print("npy only has occupancy data," +
               " no additional data is being added")
         nbits = 0
 
-        if len(points) > 0:
+        # the cells are cubes of side 1 from the origin
+        if args.cubesize:
+            bbox = [[0, 0, 0], list(grid.shape)]
+            volatree = VolaTree(args.depth, bbox, args.crs,
+                                args.dense, nbits,
+                                args.gridorigin, args.cubesize)
+            for start in range(0, grid.shape[0], SLAB):
+                keys = np.argwhere(grid[start:start + SLAB])
+                keys[:, 0] += start
+                volatree.addpoints(keys + 0.5)
+        else:
+            griddepth = int(np.ceil(np.log(max(max(grid.shape), 1)) /
+                                    np.log(4) - 1e-9))
+            side = pow(4, max(args.depth, griddepth))
+            print("grid of shape", grid.shape, "is padded to", side)
+            bbox = [[0, 0, 0], [side, side, side]]
             volatree = VolaTree(args.depth, bbox, args.crs,
                                 args.dense, nbits)
-            volatree.cubify(points, pointsdata)
-            volatree.writebin(outfilename)
+            volatree.set_grid(grid)
+        volatree.writebin(outfilename)
 
-            bu.print_ratio(filename, outfilename)
-        else:
-            print("The points file is empty!")
+        bu.print_ratio(filename, outfilename)
     bu.timer(start_time)
 
 
 def parse_npy(filename):
-    """Read xyz format point data and return header, points and points data."""
-    depthmap = np.load(filename)
-    points = np.argwhere(depthmap == 1).tolist()
-    bbox = [[0, 0, 0], [255, 255, 255]]
-    return bbox, points, None
+    """Memory map a .npy occupancy grid, nonzero cells are occupied."""
+    return np.load(filename, mmap_mode='r')
 
 
 if __name__ == '__main__':
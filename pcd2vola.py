@@ -1,25 +1,38 @@
 #!/usr/bin/env python3
 """
-pcd2vola: Converts ascii PCL point clouds into VOLA format.
+pcd2vola: Converts PCL point clouds into VOLA format.
 
-This will automatically parse files with a structure x,y, z or
-x, y, z, r, g, b, intensity
+Reads ascii, binary and binary_compressed PCD files. The header fields
+are turned into a numpy record type so binary files are memory mapped
+and compressed files are decompressed in one go instead of being parsed
+point by point. Compressed files use the python-lzf package if it is
+installed and a (slower) pure python decompressor if not.
+With nbits set the colour (rgb or rgba) and intensity fields are stored.
 @author Jonathan Byrne
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
 from __future__ import print_function
 import glob
 import os
+import struct
 import numpy as np
 import binutils as bu
 from volatree import VolaTree
+try:
+    import lzf
+except ImportError:
+    lzf = None
+
+CHUNKSIZE = 1000000
 
 
 def main():
     """Read the file, build the tree. Write a Binary."""
     start_time = bu.timer()
     parser = bu.parser_args("*.pcd")
+    parser = bu.add_grid(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -38,68 +51,269 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_pcd(filename, args.nbits)
-        print("PCD only has occupancy data," +
-              " no additional data is being added")
-
-        if len(points) > 0:
-            volatree = VolaTree(args.depth, bbox, args.crs,
-                                args.dense, 0)
-            volatree.cubify(points, pointsdata)
-            volatree.countlevels()
-            volatree.writebin(outfilename)
-
+        if convert_pcd(filename, outfilename, args):
             bu.print_ratio(filename, outfilename)
         else:
             print("The points file is empty!")
     bu.timer(start_time)
 
 
-def parse_pcd(filename, nbits):
-    """Read xyz format point data and return header, points and points data."""
-    pointstrings = []
-    header = True
-    with open(filename) as points_file:
-        while header:
-            line = points_file.readline()
-            if line.startswith('DATA'):
-                line = line.rstrip()
-                line = line.split(' ')
-                print(line[1])
-                if line[1] == 'ascii':
-                    header = False
-                else:
-                    print("pcd2vola only handles ascii files!!!")
-                    exit()
-
-        for line in points_file:
-            if not line.startswith('nan'):
-                if not line.isspace():
-                    line = line.split()
-                    pointstrings.append(line)
-
-    points = np.zeros((len(pointstrings), 3), dtype=np.float)
-    # if nbits > 0:
-    #     datalen = len(pointstrings[0][3:])
-    #     pointsdata = np.zeros((len(pointstrings), datalen), dtype=np.int)
-
-    for idx, line in enumerate(pointstrings):
-        coords = line[: 3]
-        coords = [float(i) for i in coords]
-        points[idx] = coords
-        # if nbits > 0:
-        #     data = line[3:]
-        #     data = [int(i) for i in data]
-        #     pointsdata[idx] = data
-
-    minvals = points.min(axis=0).tolist()
-    maxvals = points.max(axis=0).tolist()
-    bbox = [minvals, maxvals]
-
-    # if nbits > 0:
-    #     return bbox, points, pointsdata
-    # else:
-    return bbox, points, None
+def convert_pcd(filename, outfilename, args):
+    """
+    Add the points to a VolaTree chunk by chunk and write it.
+
+    Points with nan coordinates are left out. Returns False if there are
+    no points.
+    """
+    records = read_pcd(filename)
+    bbox = pcd_bbox(records)
+    if bbox is None:
+        return False
+
+    nbits = 0
+    if args.nbits:
+        if data_fields(records):
+            print("nbits set, adding", ', '.join(data_fields(records)),
+                  "to occupancy grid")
+            nbits = 1
+        else:
+            print("PCD has no colour or intensity fields," +
+                  " no additional data is being added")
+    else:
+        print("Only occupancy data being set! Use -n flag to add metadata")
+
+    # intensity is scaled to the range of the file
+    maxintensity = 0
+    if nbits and 'intensity' in records.dtype.names:
+        intensity = records['intensity']
+        maxintensity = max(np.nanmax(intensity[start:start + CHUNKSIZE])
+                           for start in range(0, len(records), CHUNKSIZE))
+
+    volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits,
+                        args.gridorigin, args.cubesize)
+    for start in range(0, len(records), CHUNKSIZE):
+        points, pointsdata = parse_pcd(records[start:start + CHUNKSIZE],
+                                       nbits, maxintensity)
+        volatree.addpoints(points, pointsdata)
+    volatree.build()
+    volatree.countlevels()
+    volatree.writebin(outfilename)
+    return True
+
+
+def read_header(pcdfile):
+    """
+    Read the header lines of a pcd file up to and including DATA.
+
+    Returns the values of each header line by its lower case name and the
+    number of lines read.
+    """
+    header = {}
+    nlines = 0
+    while 'data' not in header:
+        line = pcdfile.readline()
+        nlines += 1
+        if not line:
+            raise ValueError("the pcd header has no DATA line")
+        line = line.decode('ascii').strip()
+        if not line or line.startswith('#'):
+            continue
+        words = line.split()
+        header[words[0].lower()] = words[1:]
+    return header, nlines
+
+
+def pcd_dtype(header):
+    """Numpy record type of a point from the FIELDS/SIZE/TYPE/COUNT lines."""
+    fields = header['fields']
+    sizes = header['size']
+    types = header['type']
+    counts = header.get('count', ['1'] * len(fields))
+    dtype = []
+    for idx, (name, size, kind, count) in enumerate(
+            zip(fields, sizes, types, counts)):
+        # padding fields are all called _
+        if name == '_':
+            name = '_' + str(idx)
+        kind = '<' + {'F': 'f', 'I': 'i', 'U': 'u'}[kind.upper()] + size
+        if int(count) == 1:
+            dtype.append((name, kind))
+        else:
+            dtype.append((name, kind, (int(count),)))
+    return np.dtype(dtype)
+
+
+def read_pcd(filename):
+    """
+    Read the points of a pcd file as a numpy record array.
+
+    Binary files are memory mapped, compressed files are decompressed
+    into memory and ascii files are converted in blocks of lines.
+    """
+    with open(filename, 'rb') as pcdfile:
+        header, nlines = read_header(pcdfile)
+        offset = pcdfile.tell()
+        dtype = pcd_dtype(header)
+        if 'points' in header:
+            npoints = int(header['points'][0])
+        else:
+            npoints = int(header['width'][0]) * int(header['height'][0])
+        datatype = header['data'][0].lower()
+        print("pcd data is", datatype)
+
+        if datatype == 'binary_compressed':
+            compressed, size = struct.unpack('<II', pcdfile.read(8))
+            buf = decompress(pcdfile.read(compressed), size)
+            return columns_to_records(buf, dtype, npoints)
+
+    if datatype == 'binary':
+        if npoints == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                         shape=(npoints,))
+    elif datatype == 'ascii':
+        return ascii_to_records(filename, dtype, nlines)
+    raise ValueError("unknown pcd DATA type " + datatype)
+
+
+def ascii_to_records(filename, dtype, skiprows):
+    """Convert the rows of an ascii pcd file to records."""
+    chunks = list(bu.read_text(filename, skiprows))
+    if not chunks:
+        return np.zeros(0, dtype=dtype)
+    rows = np.concatenate(chunks)
+    records = np.zeros(len(rows), dtype=dtype)
+    col = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        count = int(np.prod(field.shape))
+        records[name] = rows[:, col:col + count].reshape((-1,) + field.shape)
+        col += count
+    return records
+
+
+def columns_to_records(buf, dtype, npoints):
+    """
+    Records from decompressed binary_compressed data.
+
+    The compressed layout stores all the values of one field, then all the
+    values of the next.
+    """
+    records = np.zeros(npoints, dtype=dtype)
+    offset = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        count = npoints * int(np.prod(field.shape))
+        values = np.frombuffer(buf, dtype=field.base, count=count,
+                               offset=offset)
+        records[name] = values.reshape((npoints,) + field.shape)
+        offset += count * field.base.itemsize
+    return records
+
+
+def decompress(data, size):
+    """Decompress LZF data, with python-lzf if it is installed."""
+    if lzf is not None:
+        buf = lzf.decompress(data, size)
+    else:
+        buf = lzf_decompress(data)
+    if buf is None or len(buf) != size:
+        raise ValueError("the compressed pcd data is corrupt")
+    return bytes(buf)
+
+
+def lzf_decompress(data):
+    """Pure python LZF decompression."""
+    data = bytearray(data)
+    out = bytearray()
+    pos = 0
+    while pos < len(data):
+        ctrl = data[pos]
+        pos += 1
+        if ctrl < 32:
+            # a run of ctrl + 1 literal bytes
+            out += data[pos:pos + ctrl + 1]
+            pos += ctrl + 1
+            continue
+        # a back reference to bytes already written
+        length = ctrl >> 5
+        if length == 7:
+            length += data[pos]
+            pos += 1
+        ref = len(out) - ((ctrl & 0x1f) << 8) - data[pos] - 1
+        pos += 1
+        length += 2
+        if ref < 0:
+            raise ValueError("the compressed pcd data is corrupt")
+        # the reference may overlap the bytes it writes
+        while length > 0:
+            chunk = out[ref:ref + length]
+            out += chunk
+            ref += len(chunk)
+            length -= len(chunk)
+    return out
+
+
+def pcd_bbox(records):
+    """Bounding box of the points that are not nan, or None."""
+    low, high = [], []
+    for start in range(0, len(records), CHUNKSIZE):
+        points, finite = get_points(records[start:start + CHUNKSIZE])
+        points = points[finite]
+        if len(points):
+            low.append(points.min(axis=0))
+            high.append(points.max(axis=0))
+    if not low:
+        return None
+    return [np.min(low, axis=0).tolist(), np.max(high, axis=0).tolist()]
+
+
+def get_points(records):
+    """The x, y, z of the records and a mask of the points without nans."""
+    points = np.empty((len(records), 3))
+    for axis, name in enumerate('xyz'):
+        points[:, axis] = records[name]
+    return points, np.isfinite(points).all(axis=1)
+
+
+def data_fields(records):
+    """The fields of the records that can be stored with nbits."""
+    return [name for name in ('rgb', 'rgba', 'intensity')
+            if name in records.dtype.names]
+
+
+def parse_pcd(records, nbits, maxintensity=0):
+    """
+    Return the points of a slice of records and, with nbits, their data.
+
+    The data is the red, green and blue bytes of the colour field and the
+    intensity scaled to 0-255 by maxintensity. Black points without an
+    intensity are stored as 200, a payload can not be 0.
+    """
+    points, finite = get_points(records)
+    points = points[finite]
+    if nbits == 0:
+        return points, None
+    records = records[finite]
+
+    pointsdata = np.zeros((len(records), 4), dtype=np.int64)
+    names = records.dtype.names
+    for name in ('rgb', 'rgba'):
+        if name in names:
+            colour = np.ascontiguousarray(records[name])
+            if colour.dtype.itemsize == 4:
+                colour = colour.view(np.uint32)
+            colour = colour.astype(np.int64)
+            for col, shift in enumerate((16, 8, 0)):
+                pointsdata[:, col] = (colour >> shift) & 255
+    if 'intensity' in names and maxintensity > 0:
+        intensity = np.nan_to_num(records['intensity'].astype(np.float64))
+        pointsdata[:, 3] = bu.normalize_np(intensity, 0, maxintensity) * 255
+    if 'rgb' in names or 'rgba' in names:
+        # a payload of 0 is no payload, so as in las2vola black is set to
+        # 200 if the point has no other data
+        pointsdata[~pointsdata.any(axis=1), :3] = 200
+    return points, pointsdata
 
 
 if __name__ == '__main__':
@@ -2,20 +2,22 @@
 """
 Converts ply triangle meshes into VOLA format.
 
-PLY is an industry standard mesh format. This parser only looks at the points
-and their colors, not the triangles.
+PLY is an industry standard mesh format. Every voxel the triangle surfaces
+pass through is set (with --fill the inside of closed meshes as well), along
+with the voxels of the points. Files without faces are point clouds. The
+vertex coordinates and colours are taken from the plyfile vertex array by
+field name, which plyfile memory maps for binary files.
 
 @author Jonathan Byrne
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
-#TODO: Need to cleverly remove duplicate points and add subdivide function.
 from __future__ import print_function
 import glob
 import os
 import plyfile
 import numpy as np
-from stl import mesh
 import binutils as bu
+import volaraster
 from volatree import VolaTree
 
 
@@ -24,7 +26,10 @@ def main():
     start_time = bu.timer()
     parser = bu.parser_args("*.ply")
     parser = bu.add_reverse(parser)
+    parser = bu.add_grid(parser)
+    parser = bu.add_mesh(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -43,18 +48,35 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_ply(filename, args.nbits)
+        bbox, points, pointsdata, faces = parse_ply(filename, args.nbits)
 
         if args.reverse_zy:
-            points = np.array([points[:, 0], points[:, 2], points[:, 1]]).transpose()
-
-        # work out how many chunks are required for the data
-        print("PLY only has occupancy data," +
-              " no additional data is being added")
-        nbits = 0
-
-        volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits)
-        volatree.cubify(points)
+            points = points[:, [0, 2, 1]]
+            bbox = [[low[0], low[2], low[1]] for low in bbox]
+
+        if pointsdata is not None:
+            print("nbits set, adding the vertex colours to occupancy grid")
+            nbits = 1
+        elif args.nbits:
+            print("PLY has no vertex colours," +
+                  " no additional data is being added")
+            nbits = 0
+        else:
+            print("Only occupancy data being set! Use -n flag to add metadata")
+            nbits = 0
+
+        volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits,
+                            args.gridorigin, args.cubesize)
+        if faces is not None and not args.vertices:
+            payloads = None
+            if pointsdata is not None:
+                # a triangle has the mean colour of its corners
+                payloads = bu.pack_payloads(
+                    pointsdata[faces].mean(axis=1).astype(np.int64))
+            volatree.addtriangles(points[faces], payloads, args.fill)
+        # the vertices go last so their voxels keep the vertex colours
+        volatree.addpoints(points, pointsdata)
+        volatree.build()
         volatree.countlevels()
         volatree.writebin(outfilename)
 
@@ -64,19 +86,85 @@ def main():
 
 
 def parse_ply(filename, nbits):
-    """Read ply format mesh and return header and points."""
-    ply_file = plyfile.PlyData.read(filename)
-    vertices = ply_file.elements[0].data
-    coords = np.zeros((len(vertices), 3), dtype=np.float)
+    """
+    Read ply format mesh and return header, points, points data and faces.
 
-    for idx, vert in enumerate(vertices):
-        coords[idx] = list(vert)[:3]
+    With nbits set the points data is the red, green and blue bytes of the
+    vertices, or None if they have no colour. The faces are the (n, 3)
+    vertex indices of the triangles, None if there are none.
+    """
+    ply_file = plyfile.PlyData.read(filename)
+    vertices = ply_file['vertex'].data
+    coords = np.empty((len(vertices), 3))
+    for axis, name in enumerate('xyz'):
+        coords[:, axis] = vertices[name]
 
     minvals = coords.min(axis=0).tolist()
     maxvals = coords.max(axis=0).tolist()
     bbox = [minvals, maxvals]
 
-    return bbox, coords, None
+    pointsdata = None
+    if nbits:
+        pointsdata = vertex_colours(vertices)
+    return bbox, coords, pointsdata, parse_faces(ply_file)
+
+
+def parse_faces(ply_file):
+    """
+    Vertex indices of the triangles of the faces, None if there are none.
+
+    Faces with more than three corners are split into triangle fans.
+    """
+    if 'face' not in [element.name for element in ply_file.elements]:
+        return None
+    faces = ply_file['face'].data
+    if len(faces) == 0:
+        return None
+    name = 'vertex_indices'
+    if name not in faces.dtype.names:
+        name = 'vertex_index'
+    polygons = faces[name]
+    if polygons.dtype != object:
+        polygons = list(polygons)
+    lengths = np.fromiter(map(len, polygons), dtype=np.int64,
+                          count=len(polygons))
+    corners = np.concatenate(polygons).astype(np.int64)
+    if np.all(lengths == 3):
+        return corners.reshape(-1, 3)
+
+    counts = np.maximum(lengths - 2, 0)
+    starts = np.repeat(np.cumsum(lengths) - lengths, counts)
+    _, within = volaraster.expand(counts)
+    return np.stack((corners[starts], corners[starts + within + 1],
+                     corners[starts + within + 2]), axis=1)
+
+
+def vertex_colours(vertices):
+    """
+    The red, green and blue bytes of the vertices, None if they have none.
+
+    Float colours are taken to be between 0 and 1 and 16 bit ones are
+    scaled down to a byte. Black is stored as 200, a payload can not be 0.
+    """
+    names = vertices.dtype.names
+    for fields in (('red', 'green', 'blue'), ('r', 'g', 'b'),
+                   ('diffuse_red', 'diffuse_green', 'diffuse_blue')):
+        if all(name in names for name in fields):
+            break
+    else:
+        return None
+
+    colours = np.empty((len(vertices), 3), dtype=np.int64)
+    for col, name in enumerate(fields):
+        values = vertices[name]
+        if values.dtype.kind == 'f':
+            values = np.clip(values, 0, 1) * 255
+        elif values.dtype.itemsize > 1:
+            values = np.clip(values, 0, 65535) // 256
+        colours[:, col] = values
+    # a payload of 0 is no payload, so as in las2vola black is set to 200
+    colours[~colours.any(axis=1)] = 200
+    return colours
 
 
 if __name__ == '__main__':
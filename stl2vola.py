@@ -4,11 +4,12 @@ Converts stl triangle meshes into VOLA format.
 
 STL is an industry standard mesh format. There is no information other than
 triangles so the occupancy information is only available for this format.
+Every voxel the triangle surfaces pass through is set, and with --fill the
+inside of closed meshes as well.
 
 @author Jonathan Byrne
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
-#TODO: Need to cleverly remove duplicate points and add subdivide function.
 from __future__ import print_function
 import glob
 import os
@@ -23,7 +24,10 @@ def main():
     start_time = bu.timer()
     parser = bu.parser_args("*.stl")
     parser = bu.add_reverse(parser)
+    parser = bu.add_grid(parser)
+    parser = bu.add_mesh(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -42,17 +46,19 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points = parse_stl(filename, revzy=args.reverse_zy)
-
-        if args.reverse_zy:
-            points = np.array([points[:, 0], points[:, 2], points[:, 1]]).transpose()
+        bbox, triangles = parse_stl(filename, revzy=args.reverse_zy)
 
         print("STL only has occupancy data," +
               " no additional data is being added")
         nbits = 0
 
-        volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits)
-        volatree.cubify(points)
+        volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits,
+                            args.gridorigin, args.cubesize)
+        if args.vertices:
+            volatree.addpoints(triangles.reshape(-1, 3))
+        else:
+            volatree.addtriangles(triangles, fill=args.fill)
+        volatree.build()
         volatree.countlevels()
         volatree.writebin(outfilename)
 
@@ -62,16 +68,16 @@ def main():
 
 
 def parse_stl(filename, revzy=False):
-    """Read stl format mesh and return header and points."""
+    """Read stl format mesh and return header and (n, 3, 3) triangles."""
     stlmesh = mesh.Mesh.from_file(filename)
-    minvals = stlmesh.min_.tolist()
-    maxvals = stlmesh.max_.tolist()
+    triangles = stlmesh.points.reshape(-1, 3, 3).astype(np.float64)
+    if revzy:
+        triangles = triangles[:, :, [0, 2, 1]]
+    minvals = triangles.min(axis=(0, 1)).tolist()
+    maxvals = triangles.max(axis=(0, 1)).tolist()
     bbox = [minvals, maxvals]
-    points = stlmesh.points[:, :3]
-    points = np.append(points, stlmesh.points[:, 3:6], axis=0)
-    points = np.append(points, stlmesh.points[:, 6:], axis=0)
 
-    return bbox, points
+    return bbox, triangles
 
 
 if __name__ == '__main__':
@@ -22,7 +22,9 @@ def main():
     """Read the file, build the tree. Write a Binary."""
     start_time = bu.timer()
     parser = bu.parser_args("*.asc / *.xyz")
+    parser = bu.add_grid(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -42,65 +44,53 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_xyz(filename, args.nbits)
-        # work out how many chunks are required for the data
-        if args.nbits:
-            div, mod = divmod(len(pointsdata[0]), 8)
-            if mod > 0:
-                nbits = div + 1
-            else:
-                nbits = div
-        else:
-            nbits = 0
-
-        if len(points) > 0:
-            volatree = VolaTree(args.depth, bbox, args.crs,
-                                args.dense, nbits)
-            volatree.cubify(points, pointsdata)
-            volatree.countlevels()
-            volatree.writebin(outfilename)
-
+        if convert_txt(filename, outfilename, args):
             bu.print_ratio(filename, outfilename)
         else:
             print("The points file is empty!")
     bu.timer(start_time)
 
 
-def parse_xyz(filename, nbits):
-    """Read xyz format point data and return header, points and points data."""
-    pointstrings = []
-    with open(filename) as points_file:
-        next(points_file)
-        for line in points_file:
-            if not line.startswith('#'):
-                if not line.isspace():
-                    line = line.replace(',', ' ')
-                    line = line.split()
-                    pointstrings.append(line)
-
-    points = np.zeros((len(pointstrings), 3), dtype=np.float)
-    if nbits > 0:
-        datalen = len(pointstrings[0][3:])
-        pointsdata = np.zeros((len(pointstrings), datalen), dtype=np.int)
-
-    for idx, line in enumerate(pointstrings):
-        coords = line[: 3]
-        coords = [float(i) for i in coords]
-        points[idx] = coords
-        if nbits > 0:
-            data = line[3:]
-            data = [int(float(i)) for i in data]
-            data[0] = int(bu.normalize(data[0], -1500, 0) * 255)
-            pointsdata[idx] = data
+def convert_txt(filename, outfilename, args):
+    """
+    Stream the points into a VolaTree chunk by chunk and write it.
 
-    minvals = points.min(axis=0).tolist()
-    maxvals = points.max(axis=0).tolist()
-    bbox = [minvals, maxvals]
+    Returns False if the file is empty.
+    """
+    bbox, ncols = bu.text_bbox(filename, 1)
+    if bbox is None:
+        return False
 
-    if nbits > 0:
-        return bbox, points, pointsdata
+    # work out how many chunks are required for the data
+    if args.nbits:
+        div, mod = divmod(ncols - 3, 8)
+        if mod > 0:
+            nbits = div + 1
+        else:
+            nbits = div
     else:
-        return bbox, points, None
+        nbits = 0
+
+    volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits,
+                        args.gridorigin, args.cubesize)
+    for points, pointsdata in parse_xyz(filename, nbits):
+        volatree.addpoints(points, pointsdata)
+    volatree.build()
+    volatree.countlevels()
+    volatree.writebin(outfilename)
+    return True
+
+
+def parse_xyz(filename, nbits):
+    """Read xyz format point data, yielding chunks of points and data."""
+    for rows in bu.read_text(filename, 1):
+        if nbits > 0:
+            pointsdata = rows[:, 3:].astype(np.int64)
+            pointsdata[:, 0] = bu.normalize_np(pointsdata[:, 0],
+                                               -1500, 0) * 255
+            yield rows[:, :3], pointsdata
+        else:
+            yield rows[:, :3], None
 
 
 if __name__ == '__main__':
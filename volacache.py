@@ -0,0 +1,174 @@
+"""
+VOLA tile cache.
+
+Keeps decoded .vol files around so they do not have to be decoded again.
+There are two tiers: an in-process LRU bounded by bytes holding the voxel
+position and data arrays, and an optional cache directory on disk where
+the arrays are stored as .npy files that are memory mapped when read back.
+Entries are keyed by the file path and the decode parameters (depth and
+box) and are only used while the size and modification time of the .vol
+file are unchanged, so edited files are decoded again automatically.
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+import volareader as vr
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by the bytes of its values."""
+
+    def __init__(self, maxbytes):
+        """Create an empty cache holding up to maxbytes."""
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Return the value for key and mark it as most recently used."""
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value, nbytes):
+        """Add a value, dropping the least recently used ones to fit."""
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        # the newest entry is kept even if it is larger than the cache
+        while self.nbytes > self.maxbytes and len(self.entries) > 1:
+            _, (_, oldbytes) = self.entries.popitem(last=False)
+            self.nbytes -= oldbytes
+
+    def clear(self):
+        """Remove all entries."""
+        self.entries.clear()
+        self.nbytes = 0
+
+
+class TileCache(object):
+    """
+    Two tier cache of decoded .vol files.
+
+    load() returns the same header, voxel and voxel data as decoding the
+    file with open_file and get_voxels_np, from memory or from the cache
+    directory if possible.
+    """
+
+    def __init__(self, cachedir=None, maxbytes=512 * 1024 * 1024):
+        """
+        Set up the memory tier and the (optional) cache directory.
+
+        With maxbytes 0 there is no memory tier, only the cache directory.
+        """
+        self.cachedir = cachedir
+        self.memory = LRUCache(maxbytes)
+        self.diskhits = 0
+        self.diskmisses = 0
+        if cachedir is not None and not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+    def load(self, filename, depth=None, box=None):
+        """Decode a .vol file, or fetch it from the cache."""
+        stat = os.stat(vr.disk_file(filename))
+        path = os.path.abspath(filename)
+        if box is not None:
+            box = tuple(tuple(int(val) for val in corner) for corner in box)
+        identity = [stat.st_size, stat.st_mtime_ns]
+        key = (path, depth, box)
+
+        # stale memory entries are never looked up again and age out
+        tile = self.memory.get(key + tuple(identity))
+        if tile is not None:
+            return tile
+
+        if self.cachedir is not None:
+            tile = self.read_entry(key, identity)
+        if tile is None:
+            header, levels, data = vr.open_file(filename, depth)
+            voxels, voxel_data = vr.get_voxels_np(header, levels, data, box)
+            tile = (header, voxels, voxel_data)
+            if self.cachedir is not None:
+                self.write_entry(key, identity, tile)
+
+        if self.memory.maxbytes > 0:
+            self.memory.put(key + tuple(identity), tile,
+                            tile[1].nbytes + tile[2].nbytes)
+        return tile
+
+    def stats(self):
+        """Hit and miss counts for both tiers."""
+        return {'memoryhits': self.memory.hits,
+                'memorymisses': self.memory.misses,
+                'diskhits': self.diskhits,
+                'diskmisses': self.diskmisses,
+                'memorybytes': self.memory.nbytes}
+
+    def entry_name(self, key):
+        """Base path of the cache directory files for a key."""
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, digest)
+
+    def read_entry(self, key, identity):
+        """Memory map a cached tile if it matches the file identity."""
+        name = self.entry_name(key)
+        try:
+            with open(name + ".json") as infofile:
+                info = json.load(infofile)
+            if info['identity'] != identity:
+                self.diskmisses += 1
+                return None
+            voxels = np.load(name + ".voxels.npy", mmap_mode='r')
+            voxel_data = np.load(name + ".data.npy", mmap_mode='r')
+        except (IOError, OSError, ValueError, KeyError):
+            self.diskmisses += 1
+            return None
+        self.diskhits += 1
+        return info['header'], voxels, voxel_data
+
+    def write_entry(self, key, identity, tile):
+        """Store a decoded tile in the cache directory."""
+        name = self.entry_name(key)
+        header, voxels, voxel_data = tile
+        # write to temporary files first so readers never see half a tile
+        tmpname = "{}.{}.tmp".format(name, os.getpid())
+        np.save(tmpname + ".voxels.npy", voxels)
+        np.save(tmpname + ".data.npy", voxel_data)
+        with open(tmpname + ".json", 'w') as infofile:
+            json.dump({'identity': identity, 'header': header}, infofile)
+        # the info file goes last as it marks the entry as complete
+        for suffix in (".voxels.npy", ".data.npy", ".json"):
+            os.replace(tmpname + suffix, name + suffix)
+
+
+SHARED_CACHES = {}
+
+
+def shared_cache(cachedir=None, maxbytes=512 * 1024 * 1024):
+    """
+    The TileCache for a cache directory shared within this process.
+
+    Each process has its own, so every process using it can hold up to
+    maxbytes in its memory tier.
+    """
+    key = (cachedir, maxbytes)
+    if key not in SHARED_CACHES:
+        SHARED_CACHES[key] = TileCache(cachedir, maxbytes)
+    return SHARED_CACHES[key]
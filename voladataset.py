@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+VOLA dataset queries.
+
+Answers point, batched point and box queries over a whole .vola dataset,
+in the coordinates of the tile bounding boxes (the CRS coordinates). The
+spatial index (.volaidx) finds the tiles for a query, the tiles are
+decoded on first use and kept in a pool bounded by bytes, and queries
+touching several tiles look them up concurrently.
+Each pooled tile holds its voxel keys sorted so that lookups are binary
+searches instead of tree walks.
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import volacache
+import volaindex
+import volapack
+import volamesh as vm
+import volareader as vr
+
+
+class VolaDataset(object):
+    """A .vola dataset with a pool of decoded tiles."""
+
+    def __init__(self, volaname, poolbytes=256 * 1024 * 1024, workers=None,
+                 gridded=False):
+        """
+        Load the dataset (.vola or .volapack) and its spatial index.
+
+        Set gridded if the tiles were made on a global grid (--cubesize),
+        the coordinates are then mapped to voxels as on that grid.
+        """
+        self.vola = volapack.load_vola(volaname)
+        self.gridded = gridded
+        self.dirname = os.path.dirname(volaname)
+        self.files = [self.tile_path(entry['filename'])
+                      for entry in self.vola['files']]
+
+        self.index = None
+        indexname = os.path.join(self.dirname,
+                                 self.vola.get('index', ''))
+        if 'index' in self.vola and os.path.isfile(indexname):
+            self.index = volaindex.load_index(indexname)
+        if self.index is None or len(self.index.bboxes) != len(self.files):
+            # no sidecar or an out of date one, build the index in memory
+            self.index = volaindex.build_index(
+                [entry['bbox'] for entry in self.vola['files']])
+
+        self.pool = volacache.LRUCache(poolbytes)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def tile_path(self, filename):
+        """Find a tile relative to the .vola file if it has moved."""
+        if os.path.isfile(filename) or vr.PACK_SEPARATOR in filename:
+            return filename
+        return os.path.join(self.dirname, os.path.basename(filename))
+
+    def close(self):
+        """Stop the worker threads and empty the pool."""
+        self.executor.shutdown()
+        self.pool.clear()
+
+    def tile(self, tileid):
+        """
+        Decoded tile from the pool, decoding it if needed.
+
+        A tile is its header, the sorted linear keys of its voxels, the
+        voxel positions and the voxel data in key order.
+        """
+        with self.lock:
+            tile = self.pool.get(tileid)
+        if tile is not None:
+            return tile
+
+        header, levels, data = vr.open_file(self.files[tileid])
+        voxels, voxel_data = vr.get_voxels_np(header, levels, data)
+        keys = vm.voxel_keys(voxels, header['sidelength'])
+        order = np.argsort(keys)
+        if len(voxel_data):
+            voxel_data = voxel_data[order]
+        tile = (header, keys[order], voxels[order], voxel_data)
+
+        nbytes = sum(arr.nbytes for arr in tile[1:])
+        with self.lock:
+            self.pool.put(tileid, tile, nbytes)
+        return tile
+
+    def query_point(self, point):
+        """
+        Look up a single coordinate.
+
+        Returns None if there is no voxel at the point, otherwise the voxel
+        data (0 if the dataset has no nbits data).
+        """
+        found, values = self.query_points([point])
+        if not found[0]:
+            return None
+        return int(values[0])
+
+    def query_points(self, points):
+        """
+        Look up a batch of coordinates.
+
+        Returns a bool array marking the points that fall in a voxel and a
+        uint64 array with the voxel data of those points.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        found = np.zeros(len(points), dtype=np.bool_)
+        values = np.zeros(len(points), dtype=np.uint64)
+        pointidx, tileids = self.index.tiles_for_points(points)
+
+        order = np.argsort(tileids, kind='mergesort')
+        pointidx, tileids = pointidx[order], tileids[order]
+        groups, starts = np.unique(tileids, return_index=True)
+        groupidx = np.split(pointidx, starts[1:])
+
+        def lookup(tileid, idx):
+            header, keys, _, voxel_data = self.tile(tileid)
+            sidelen = header['sidelength']
+            positions = vr.get_positions_np(header, points[idx],
+                                             self.gridded)
+            inside = np.all((positions >= 0) & (positions < sidelen), axis=1)
+            idx, positions = idx[inside], positions[inside]
+            if len(keys) == 0:
+                return idx[:0], values[:0]
+            pkeys = vm.voxel_keys(positions, sidelen)
+            pos = np.minimum(np.searchsorted(keys, pkeys), len(keys) - 1)
+            hit = keys[pos] == pkeys
+            if len(voxel_data):
+                return idx[hit], voxel_data[pos[hit]]
+            return idx[hit], np.zeros(np.count_nonzero(hit), dtype=np.uint64)
+
+        if len(groups) > 1:
+            results = self.executor.map(lookup, groups, groupidx)
+        else:
+            results = map(lookup, groups, groupidx)
+        # points on a shared tile border may be found in more than one tile
+        for idx, data in results:
+            found[idx] = True
+            values[idx] = data
+        return found, values
+
+    def query_box(self, box):
+        """
+        Find the voxels inside a box [[minx, miny, minz], [maxx, ...]].
+
+        Returns the (n, 3) bbox frame coordinates of the voxels, their
+        corners if gridded and else the coordinates getkeys rounded to
+        them, and their uint64 data (empty if there is no nbits data).
+        """
+        box = np.asarray(box, dtype=np.float64).reshape(2, 3)
+
+        def lookup(tileid):
+            header, keys, voxels, voxel_data = self.tile(tileid)
+            sidelen = header['sidelength']
+            low, high = vr.get_positions_np(header, box, self.gridded)
+            low = np.maximum(low, 0)
+            high = np.minimum(high, sidelen - 1)
+            if np.any(low > high):
+                return np.zeros((0, 3)), voxel_data[:0]
+            # keys are z major so the z range is a slice of the tile
+            first, last = np.searchsorted(
+                keys, [low[2] * sidelen * sidelen,
+                       (high[2] + 1) * sidelen * sidelen])
+            voxels = voxels[first:last]
+            inside = np.all((voxels >= low) & (voxels <= high), axis=1)
+            if len(voxel_data):
+                voxel_data = voxel_data[first:last][inside]
+            if self.gridded:
+                coords = voxels[inside] * header['cubesize'] + \
+                    header['offset']
+            else:
+                # the last voxels of the short sides reach past the bbox
+                scale = max(header['diff']) / (sidelen - 1)
+                coords = np.minimum(
+                    voxels[inside] * scale + header['offset'],
+                    [header['maxx'], header['maxy'], header['maxz']])
+            return coords, voxel_data
+
+        tileids = self.index.tiles_for_box(box)
+        if len(tileids) > 1:
+            results = list(self.executor.map(lookup, tileids))
+        else:
+            results = [lookup(tileid) for tileid in tileids]
+        if not results:
+            return np.zeros((0, 3)), np.zeros(0, dtype=np.uint64)
+        coords = np.concatenate([coords for coords, _ in results])
+        voxel_data = np.concatenate([data for _, data in results])
+        return coords, voxel_data
+
+
+def main():
+    """Query the voxels of a dataset at points or in a box."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("vola", help="the .vola dataset or .volapack file",
+                        type=str)
+    parser.add_argument(
+        "-p", "--point",
+        help="look up the voxel at a coordinate, can be repeated",
+        type=float, nargs=3, action='append')
+    parser.add_argument(
+        "-b", "--box",
+        help="output the coordinates of the voxels inside a box",
+        type=float, nargs=6,
+        metavar=('MINX', 'MINY', 'MINZ', 'MAXX', 'MAXY', 'MAXZ'))
+    parser.add_argument(
+        "-g", "--gridded",
+        help="the tiles were made on a global grid with --cubesize",
+        action='store_true')
+    args = parser.parse_args()
+
+    dataset = VolaDataset(args.vola, gridded=args.gridded)
+    if args.point:
+        found, values = dataset.query_points(args.point)
+        for point, hit, value in zip(args.point, found, values):
+            if hit:
+                print(str(point)[1:-1], "voxel", int(value))
+            else:
+                print(str(point)[1:-1], "empty")
+
+    if args.box:
+        coords, _ = dataset.query_box([args.box[:3], args.box[3:]])
+        for coord in coords.tolist():
+            print(str(coord)[1:-1])
+
+    if not args.point and not args.box:
+        parser.print_help()
+    dataset.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+VOLA dataset spatial index.
+
+A uniform grid over the tile bounding boxes of a .vola dataset so that the
+tiles touching a point or a box can be found without scanning the whole
+files list. Each grid cell lists the tiles overlapping it in a compressed
+(offsets + ids) layout which is stored in a small binary sidecar next to
+the .vola file (.volaidx). Tile ids are positions in the .vola files list.
+
+Sidecar layout (little endian): the magic bytes VOLAIDX1, the tile count
+and grid dimensions as uint32, the grid origin and cell size as float64,
+then the tile bboxes (float64 minx, miny, minz, maxx, maxy, maxz), the
+cell offsets (uint32, one more than the number of cells) and the tile ids
+of every cell (uint32).
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import numpy as np
+
+MAGIC = b'VOLAIDX1'
+
+INDEX_HEADER = np.dtype([('magic', 'S8'), ('ntiles', '<u4'),
+                         ('dims', '<u4', (3,)), ('origin', '<f8', (3,)),
+                         ('cellsize', '<f8', (3,))])
+
+
+class SpatialIndex(object):
+    """Uniform grid of tile ids over the tile bounding boxes."""
+
+    def __init__(self, bboxes, origin, cellsize, dims, offsets, ids):
+        """Wrap the grid arrays, see build_index to create them."""
+        self.bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.cellsize = np.asarray(cellsize, dtype=np.float64)
+        self.dims = np.asarray(dims, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = np.asarray(ids, dtype=np.int64)
+
+    def cells(self, points):
+        """Grid cell (x, y, z) of each point, clipped to the grid."""
+        cells = np.floor((points - self.origin) / self.cellsize)
+        return np.clip(cells, 0, self.dims - 1).astype(np.int64)
+
+    def cell_index(self, cells):
+        """Linear index of grid cells."""
+        return cells[..., 0] + self.dims[0] * (
+            cells[..., 1] + self.dims[1] * cells[..., 2])
+
+    def tiles_for_point(self, point):
+        """Ids of the tiles whose bbox contains the point."""
+        _, tileids = self.tiles_for_points([point])
+        return tileids
+
+    def tiles_for_points(self, points):
+        """
+        Find the tiles containing each of a batch of points.
+
+        Returns two arrays of equal length, the index of the point and the
+        id of a tile containing it, for every matching pair.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        cells = self.cell_index(self.cells(points))
+        starts = self.offsets[cells]
+        counts = self.offsets[cells + 1] - starts
+
+        # expand each point into its candidate tiles
+        pointidx = np.repeat(np.arange(len(points)), counts)
+        within = np.arange(len(pointidx)) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        tileids = self.ids[np.repeat(starts, counts) + within]
+
+        bboxes = self.bboxes[tileids]
+        inside = np.all((bboxes[:, :3] <= points[pointidx]) &
+                        (points[pointidx] <= bboxes[:, 3:]), axis=1)
+        return pointidx[inside], tileids[inside]
+
+    def tiles_for_box(self, box):
+        """Ids of the tiles whose bbox overlaps [[minx, ...], [maxx, ...]]."""
+        box = np.asarray(box, dtype=np.float64).reshape(2, 3)
+        low, high = self.cells(box)
+        ranges = [np.arange(low[i], high[i] + 1) for i in range(3)]
+        cells = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1)
+        cells = self.cell_index(cells.reshape(-1, 3))
+
+        candidates = [self.ids[self.offsets[cell]:self.offsets[cell + 1]]
+                      for cell in cells]
+        tileids = np.unique(np.concatenate(candidates))
+        bboxes = self.bboxes[tileids]
+        overlap = np.all((bboxes[:, :3] <= box[1]) &
+                         (box[0] <= bboxes[:, 3:]), axis=1)
+        return tileids[overlap]
+
+    def write(self, filename):
+        """Write the index to a binary sidecar file."""
+        hdr = np.zeros(1, dtype=INDEX_HEADER)
+        hdr['magic'] = MAGIC
+        hdr['ntiles'] = len(self.bboxes)
+        hdr['dims'] = self.dims
+        hdr['origin'] = self.origin
+        hdr['cellsize'] = self.cellsize
+        with open(filename, 'wb') as outfile:
+            outfile.write(hdr.tobytes())
+            outfile.write(self.bboxes.astype('<f8').tobytes())
+            outfile.write(self.offsets.astype('<u4').tobytes())
+            outfile.write(self.ids.astype('<u4').tobytes())
+
+
+def build_index(bboxes, maxcells=None):
+    """
+    Build the grid index for a list of tile bboxes.
+
+    The cells are sized from the median tile sides so most cells hold about
+    one tile, with at most maxcells cells (8 per tile by default).
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+    if maxcells is None:
+        maxcells = max(64, 8 * len(bboxes))
+    if len(bboxes) == 0:
+        return SpatialIndex(bboxes, [0, 0, 0], [1, 1, 1], [1, 1, 1],
+                            [0, 0], [])
+
+    origin = bboxes[:, :3].min(axis=0)
+    extent = np.maximum(bboxes[:, 3:].max(axis=0) - origin, 1e-9)
+    tileside = np.median(bboxes[:, 3:] - bboxes[:, :3], axis=0)
+    tileside = np.maximum(tileside, extent / maxcells)
+    dims = np.maximum(np.ceil(extent / tileside), 1)
+    while np.prod(dims) > maxcells:
+        dims = np.maximum(np.ceil(dims / 2), 1)
+    dims = dims.astype(np.int64)
+    cellsize = extent / dims
+
+    index = SpatialIndex(bboxes, origin, cellsize, dims, [0], [])
+    low = index.cells(bboxes[:, :3])
+    spans = index.cells(bboxes[:, 3:]) - low + 1
+
+    # every tile goes in each cell of the block its bbox covers
+    counts = np.prod(spans, axis=1)
+    tileids = np.repeat(np.arange(len(bboxes)), counts)
+    within = np.arange(len(tileids)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    span = spans[tileids]
+    cells = low[tileids] + np.stack(
+        (within % span[:, 0], within // span[:, 0] % span[:, 1],
+         within // (span[:, 0] * span[:, 1])), axis=1)
+    cells = index.cell_index(cells)
+
+    order = np.argsort(cells, kind='mergesort')
+    percell = np.bincount(cells, minlength=int(np.prod(dims)))
+    index.offsets = np.concatenate(([0], np.cumsum(percell)))
+    index.ids = tileids[order]
+    return index
+
+
+def load_index(filename):
+    """Read an index written by SpatialIndex.write."""
+    with open(filename, 'rb') as infile:
+        hdr = np.frombuffer(infile.read(INDEX_HEADER.itemsize),
+                            dtype=INDEX_HEADER)[0]
+        if hdr['magic'] != MAGIC:
+            raise ValueError(filename + " is not a vola index file")
+        ntiles = int(hdr['ntiles'])
+        ncells = int(np.prod(hdr['dims']))
+        bboxes = np.fromfile(infile, dtype='<f8', count=6 * ntiles)
+        offsets = np.fromfile(infile, dtype='<u4', count=ncells + 1)
+        ids = np.fromfile(infile, dtype='<u4', count=int(offsets[-1]))
+    return SpatialIndex(bboxes, hdr['origin'], hdr['cellsize'], hdr['dims'],
+                        offsets, ids)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+VOLA mesh utilities.
+
+Surface extraction for voxel sets so that only the voxels and cube faces
+that can be seen are drawn or written out. Voxels are looked up through
+sorted linear keys so everything is done with numpy array operations.
+Run as a script it converts .vol files into compact binary PLY or OBJ
+meshes without needing VTK: coplanar exposed faces of the same color are
+greedily merged into rectangles and shared vertices are written once.
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import argparse
+import glob
+import os
+import numpy as np
+import binutils as bu
+import volareader as vr
+
+# face neighbour directions, in the order -x, +x, -y, +y, -z, +z
+DIRECTIONS = np.array([[-1, 0, 0], [1, 0, 0], [0, -1, 0],
+                       [0, 1, 0], [0, 0, -1], [0, 0, 1]], dtype=np.int64)
+
+
+def face_corners():
+    """
+    Corner offsets of the six faces of a unit cube centred on the origin.
+
+    The corners of every face are ordered anticlockwise when seen from
+    outside the cube so the face normals point outwards.
+    """
+    corners = np.zeros((6, 4, 3))
+    for face, direction in enumerate(DIRECTIONS):
+        axis = int(np.nonzero(direction)[0][0])
+        sign = direction[axis]
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        square = [(-1, -1), (1, -1), (1, 1), (-1, 1)]
+        if sign < 0:
+            square = square[::-1]
+        for idx, (du, dv) in enumerate(square):
+            corners[face, idx, axis] = 0.5 * sign
+            corners[face, idx, u] = 0.5 * du
+            corners[face, idx, v] = 0.5 * dv
+    return corners
+
+
+FACE_CORNERS = face_corners()
+
+
+def voxel_keys(voxels, sidelen):
+    """Linear key x + y * sidelen + z * sidelen^2 of each voxel."""
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+    return voxels[:, 0] + sidelen * (voxels[:, 1] + sidelen * voxels[:, 2])
+
+
+def exposed_faces(voxels, sidelen):
+    """
+    Work out which faces of each voxel are not covered by a neighbour.
+
+    Returns an (n, 6) bool array with the faces in DIRECTIONS order. Faces
+    on the border of the volume count as exposed.
+    """
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+    keys = np.sort(voxel_keys(voxels, sidelen))
+    exposed = np.ones((len(voxels), 6), dtype=np.bool_)
+    if len(keys) == 0:
+        return exposed
+
+    for face, direction in enumerate(DIRECTIONS):
+        neighbours = voxels + direction
+        inside = np.all((neighbours >= 0) & (neighbours < sidelen), axis=1)
+        nkeys = voxel_keys(neighbours[inside], sidelen)
+        pos = np.minimum(np.searchsorted(keys, nkeys), len(keys) - 1)
+        exposed[inside, face] = keys[pos] != nkeys
+    return exposed
+
+
+def surface_voxels(voxels, sidelen):
+    """Mask of the voxels that have at least one exposed face."""
+    return exposed_faces(voxels, sidelen).any(axis=1)
+
+
+def face_quads(positions, faces, cubesize=1):
+    """
+    Build the quads for the exposed faces of voxel cubes.
+
+    positions are the cube centres and faces the (n, 6) exposed face mask.
+    Returns the (4 * m, 3) quad corners of the m exposed faces and the
+    index of the voxel each face came from.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+    voxidx, faceidx = np.nonzero(faces)
+    corners = positions[voxidx, None, :] + FACE_CORNERS[faceidx] * cubesize
+    return corners.reshape(-1, 3), voxidx
+
+
+def greedy_quads(voxels, sidelen, labels=None):
+    """
+    Merge the exposed faces of the voxels into rectangles.
+
+    For each face direction the exposed faces are first joined into runs
+    along one in-plane axis, then runs with the same extent on neighbouring
+    rows are joined along the other axis. Only faces with the same label
+    (e.g. color) are merged. Returns the (m, 4, 3) integer lattice corners
+    of the rectangles, anticlockwise seen from outside, and their labels.
+    """
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+    if labels is None:
+        labels = np.zeros(len(voxels), dtype=np.int64)
+    exposed = exposed_faces(voxels, sidelen)
+
+    quads = []
+    quadlabels = []
+    for face, direction in enumerate(DIRECTIONS):
+        axis = int(np.nonzero(direction)[0][0])
+        u, v = (axis + 1) % 3, (axis + 2) % 3
+        mask = exposed[:, face]
+        # faces on the positive side sit on the far plane of the voxel
+        plane = voxels[mask, axis] + max(direction[axis], 0)
+        label = labels[mask]
+
+        # join faces into runs along u
+        label, plane, vrow, ustart, uend = merge_runs(
+            (label, plane, voxels[mask, v]), voxels[mask, u],
+            voxels[mask, u] + 1)
+        # join runs with the same u extent along v
+        label, plane, ustart, uend, vstart, vend = merge_runs(
+            (label, plane, ustart, uend), vrow, vrow + 1)
+
+        corners = np.zeros((len(plane), 4, 3), dtype=np.int64)
+        corners[:, :, axis] = plane[:, None]
+        corners[:, :, u] = np.stack((ustart, uend, uend, ustart), axis=1)
+        corners[:, :, v] = np.stack((vstart, vstart, vend, vend), axis=1)
+        if direction[axis] < 0:
+            corners = corners[:, ::-1]
+        quads.append(corners)
+        quadlabels.append(label)
+
+    return np.concatenate(quads), np.concatenate(quadlabels)
+
+
+def merge_runs(groups, start, end):
+    """
+    Join consecutive [start, end) intervals that share the same group keys.
+
+    groups is a tuple of key arrays. Returns the group keys of each merged
+    run, in the order given, followed by the run start and end.
+    """
+    if len(start) == 0:
+        return tuple(group[:0] for group in groups) + (start[:0], end[:0])
+    order = np.lexsort((start,) + tuple(groups[::-1]))
+    start, end = start[order], end[order]
+    groups = [group[order] for group in groups]
+
+    newrun = np.ones(len(start), dtype=np.bool_)
+    newrun[1:] = start[1:] != end[:-1]
+    for group in groups:
+        newrun[1:] |= group[1:] != group[:-1]
+    first = np.nonzero(newrun)[0]
+    last = np.append(first[1:], len(start)) - 1
+
+    runs = tuple(group[first] for group in groups)
+    return runs + (start[first], end[last])
+
+
+def mesh_from_voxels(voxels, sidelen, colors=None):
+    """
+    Build a compact quad mesh for the surface of the voxels.
+
+    Returns the unique integer lattice vertices, the (m, 4) vertex indexes of
+    each quad and the quad colors (None if no colors are given). A voxel at
+    (x, y, z) spans the lattice from (x, y, z) to (x + 1, y + 1, z + 1).
+    """
+    labels = None
+    if colors is not None:
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+        palette, labels = np.unique(colors, axis=0, return_inverse=True)
+        labels = labels.reshape(-1)
+
+    corners, quadlabels = greedy_quads(voxels, sidelen, labels)
+    vertices, quads = np.unique(corners.reshape(-1, 3), axis=0,
+                                return_inverse=True)
+    quads = quads.reshape(-1, 4)
+
+    if colors is None:
+        return vertices, quads, None
+    return vertices, quads, palette[quadlabels]
+
+
+def merge_meshes(meshes):
+    """Concatenate (vertices, quads, colors) meshes into one."""
+    vertices, quads, colors = [], [], []
+    count = 0
+    for mverts, mquads, mcolors in meshes:
+        vertices.append(mverts)
+        quads.append(mquads + count)
+        count += len(mverts)
+        if mcolors is None:
+            mcolors = np.full((len(mquads), 3), 200, dtype=np.uint8)
+        colors.append(mcolors)
+    return (np.concatenate(vertices), np.concatenate(quads),
+            np.concatenate(colors))
+
+
+def write_ply(filename, vertices, quads, colors=None):
+    """Write a binary little endian PLY with optional face colors."""
+    print("writing file:", filename)
+    facetype = [('count', 'u1'), ('indexes', '<i4', (4,))]
+    if colors is not None:
+        facetype.extend([('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    faces = np.zeros(len(quads), dtype=facetype)
+    faces['count'] = 4
+    faces['indexes'] = quads
+    hdr = ["ply", "format binary_little_endian 1.0",
+           "comment VOLA surface mesh",
+           "element vertex {}".format(len(vertices)),
+           "property double x", "property double y", "property double z",
+           "element face {}".format(len(quads)),
+           "property list uchar int vertex_indices"]
+    if colors is not None:
+        faces['red'], faces['green'], faces['blue'] = np.asarray(colors).T
+        hdr.extend(["property uchar red", "property uchar green",
+                    "property uchar blue"])
+    hdr.append("end_header\n")
+
+    with open(filename, 'wb') as plyfile:
+        plyfile.write("\n".join(hdr).encode('ascii'))
+        plyfile.write(np.ascontiguousarray(vertices, dtype='<f8').tobytes())
+        plyfile.write(faces.tobytes())
+
+
+def write_obj(filename, vertices, quads):
+    """Write a Wavefront OBJ with one quad per face."""
+    print("writing file:", filename)
+    with open(filename, 'wb') as objfile:
+        objfile.write(b"# VOLA surface mesh\n")
+        np.savetxt(objfile, vertices, fmt='v %.6f %.6f %.6f')
+        # obj vertex indexes start at one
+        np.savetxt(objfile, quads + 1, fmt='f %d %d %d %d')
+
+
+def main():
+    """Convert .vol files into greedy meshed PLY or OBJ files."""
+    start_time = bu.timer()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input",
+        help="the name of the vola file / files / directory to convert.\
+              Put wildcards in quotation marks e.g.: volamesh \"*.vol\"",
+        type=str)
+    parser.add_argument(
+        "--obj", help="output an OBJ mesh instead of PLY",
+        action='store_true')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.input):
+        filenames = glob.glob(os.path.join(args.input, '*.vol'))
+    else:
+        filenames = glob.glob(args.input)
+
+    for filename in filenames:
+        header, levels, data = vr.open_file(filename)
+        voxels, voxel_data = vr.get_voxels_np(header, levels, data)
+        colors = None
+        if header['nbits'] > 0:
+            bytevals = np.ascontiguousarray(voxel_data, dtype='<u8')
+            colors = bytevals.view(np.uint8).reshape(-1, 8)[:, :3]
+
+        lattice, quads, quadcolors = mesh_from_voxels(
+            voxels, header['sidelength'], colors)
+        # cubes are centred on the voxel coordinate, as volaviewer draws them
+        vertices = vr.get_coords_np(header, lattice - 0.5)
+        print(len(voxels), "voxels meshed to", len(quads), "quads")
+
+        if args.obj:
+            write_obj(bu.sub(filename, "obj"), vertices, quads)
+        else:
+            write_ply(bu.sub(filename, "ply"), vertices, quads, quadcolors)
+    bu.timer(start_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Builds overview pyramids for .vola datasets.
+
+The tiles of a dataset made on a global grid (--cubesize) are grouped 4 x 4
+x 4 into overview volumes of the same depth with 4 times the side. The
+overviews are grouped again until one volume covers the whole dataset. An
+overview is made from the top levels of its children without decoding any
+voxels: its first level marks which children exist and each level below is
+the level above it of the children, joined in bit order. The payload of a
+block is the per byte mean of the nonzero payloads of the blocks or voxels
+under it, combined level by level from the voxels of the children. The
+overviews are written to an overviews folder next to the .vola file and
+listed in it.
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import numpy as np
+import binutils as bu
+import datasetparser
+import volareader as vr
+from volatree import VolaTree
+
+
+def main():
+    """Read the dataset, build the overview levels and update the .vola."""
+    start_time = bu.timer()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("vola", help="the .vola dataset file", type=str)
+    parser.add_argument(
+        "--gridorigin",
+        help="origin of the global grid the tiles were converted on,\
+              defaults to 0 0 0",
+        type=float, nargs=3, metavar=('X', 'Y', 'Z'))
+    args = parser.parse_args()
+
+    with open(args.vola) as volafile:
+        vola = json.load(volafile)
+    dirname = os.path.dirname(args.vola)
+    origin = np.zeros(3)
+    if args.gridorigin:
+        origin = np.array(args.gridorigin)
+
+    if vola['mode'] != 0:
+        print("Overviews can only be made from sparse tiles!")
+        exit()
+    sides = np.array([entry['sides'] for entry in vola['files']])
+    tileside = sides[0, 0]
+    if not np.allclose(sides, tileside):
+        print("The tiles are not all the same size! Convert them on a grid",
+              "with --cubesize")
+        exit()
+
+    nodes = {}
+    for entry in vola['files']:
+        position = (np.array(entry['bbox'][:3]) - origin) / tileside
+        index = np.round(position)
+        if not np.allclose(position, index, atol=1e-6):
+            print("The tiles are not aligned to the grid! Use the same",
+                  "--gridorigin as the conversion")
+            exit()
+        nodes[tuple(int(val) for val in index)] = tile_path(
+            entry['filename'], dirname)
+
+    outdir = os.path.join(dirname, "overviews")
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    overviews = []
+    level = 1
+    while len(nodes) > 1:
+        parents = {}
+        for index, filename in nodes.items():
+            parent = tuple(val // 4 for val in index)
+            parents.setdefault(parent, []).append((index, filename))
+        # the grid may stop merging nodes across its origin
+        if level > 1 and len(parents) == len(nodes):
+            break
+
+        tileside *= 4
+        nodes = {}
+        for parent, children in sorted(parents.items()):
+            filename = os.path.join(outdir, "overview{}_{}_{}_{}.vol".format(
+                level, *parent))
+            tilemin = origin + np.array(parent) * tileside
+            bbox = [tilemin.tolist(), (tilemin + tileside).tolist()]
+            build_overview(filename, parent, children, bbox, vola)
+            nodes[parent] = filename
+
+        print("overview level", level, "has", len(nodes), "volumes")
+        overviews.append({
+            'level': level,
+            'files': [datasetparser.read_entry(name, os.stat(name))
+                      for _, name in sorted(nodes.items())]})
+        level += 1
+
+    vola['overviews'] = overviews
+    volafile = open(args.vola, 'w')
+    volafile.write(json.dumps(vola, sort_keys=True, indent=2))
+    volafile.close()
+    bu.timer(start_time)
+
+
+def tile_path(filename, dirname):
+    """Find a tile relative to the .vola file if it has moved."""
+    if os.path.isfile(filename):
+        return filename
+    return os.path.join(dirname, os.path.basename(filename))
+
+
+def build_overview(filename, parent, children, bbox, vola):
+    """
+    Join the top levels of up to 64 child volumes into an overview.
+
+    children is a list of (grid index, filename) pairs inside the parent
+    grid cell. The blocks one level above the voxels of the children
+    become the voxels of the overview. With nbits the children are read
+    down to their voxels to combine the payloads, see mean_payloads.
+    """
+    depth = vola['depth']
+    nbits = vola['nbits']
+    levels = [[] for _ in range(depth)]
+    data = [[] for _ in range(depth)]
+    word = 0
+    toppayloads = []
+
+    # children in bit order so their blocks follow the first level
+    byindex = []
+    for index, childname in children:
+        x, y, z = [val - 4 * pval for val, pval in zip(index, parent)]
+        byindex.append((x + 4 * y + 16 * z, childname))
+
+    for bit, childname in sorted(byindex):
+        readdepth = depth if nbits > 0 else max(depth - 1, 1)
+        _, clevels, cdata = vr.open_file(childname, readdepth)
+        if len(clevels[0]) == 0 or clevels[0][0] == 0:
+            continue
+        word |= 1 << bit
+        for i in range(1, depth):
+            levels[i].append(clevels[i - 1])
+        if nbits > 0:
+            # combine from the voxels up, the voxel level is not kept
+            payloads = cdata[depth - 1]
+            for i in range(depth - 2, -1, -1):
+                payloads = mean_payloads(clevels[i], payloads)
+                data[i + 1].append(payloads)
+            toppayloads.append(cdata[0] if depth == 1 else payloads)
+
+    levels[0] = [np.array([word], dtype=np.uint64)]
+    if nbits > 0:
+        data[0] = [mean_payloads(levels[0][0], np.concatenate(
+            toppayloads or [np.zeros(0, dtype=np.uint64)]))]
+
+    volatree = VolaTree(depth, bbox, vola['crs'], False, nbits)
+    empty = np.zeros(0, dtype=np.uint64)
+    volatree.set_levels(
+        [np.concatenate(level or [empty]) for level in levels],
+        [np.concatenate(words or [empty]) for words in data]
+        if nbits > 0 else None)
+    volatree.writebin(filename)
+
+
+def mean_payloads(level, below):
+    """
+    The payload of each block of a level from the payloads below it.
+
+    below holds a payload for every set bit of the level, in order. Each
+    byte of a block payload is the rounded mean of that byte of the
+    nonzero payloads under the block, blocks with none have payload 0.
+    """
+    level = np.asarray(level, dtype=np.uint64)
+    below = np.asarray(below, dtype=np.uint64)
+    owner = np.repeat(np.arange(len(level)), bu.count_bits_np(level))
+    used = below != 0
+    owner, below = owner[used], below[used]
+    shifts = np.arange(0, 64, 8, dtype=np.uint64)
+    values = (below[:, np.newaxis] >> shifts) & np.uint64(255)
+    sums = np.zeros((len(level), 8), dtype=np.int64)
+    np.add.at(sums, owner, values.astype(np.int64))
+    counts = np.maximum(np.bincount(owner, minlength=len(level)), 1)
+    means = (sums + counts[:, np.newaxis] // 2) // counts[:, np.newaxis]
+    # a block with payloads keeps a nonzero one, 0 means no payload
+    lost = ~np.any(means, axis=1) & np.any(sums, axis=1)
+    means[lost] = np.minimum(sums[lost], 1)
+    return bu.pack_payloads(means)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+VOLA container for whole datasets.
+
+Packs the tiles of a .vola dataset (and its overviews) into one .volapack
+file so a dataset can be copied and opened as a single file. The file
+starts with a table holding the offset, size and header of every tile,
+followed by the tile names and the .vola index, then the tiles themselves
+unchanged and 8 byte aligned. The container is memory mapped and a tile
+is read from its slice, so opening a tile costs one seek. Tiles are named
+container.volapack#tilename, which open_file accepts anywhere a .vol
+filename is used.
+
+Layout (little endian): the magic bytes VOLAPAK1, the tile count and the
+size of the names as uint32, the size of the .vola json as uint64, the
+tile table (uint64 offset, uint64 size, 80 byte .vol header), the tile
+names separated by newlines, the .vola json, then the tiles.
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import argparse
+import copy
+import json
+import mmap
+import os
+import numpy as np
+import binutils as bu
+import volaindex
+import volareader as vr
+
+MAGIC = b'VOLAPAK1'
+
+PACK_HEADER = np.dtype([('magic', 'S8'), ('ntiles', '<u4'),
+                        ('namesize', '<u4'), ('volasize', '<u8')])
+
+TABLE_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u8'),
+                        ('header', bu.HEADER_DTYPE)])
+
+
+class TileReader(object):
+    """File like reader over the slice of one tile in the container."""
+
+    def __init__(self, buf, start, size):
+        """Read from buf[start:start + size]."""
+        self.buf = buf
+        self.start = start
+        self.end = start + size
+        self.pos = start
+
+    def read(self, count):
+        """Read up to count bytes."""
+        data = self.buf[self.pos:min(self.pos + count, self.end)]
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos):
+        """Move to pos bytes from the start of the tile."""
+        self.pos = self.start + pos
+
+
+class VolaPack(object):
+    """A memory mapped .volapack container."""
+
+    def __init__(self, filename):
+        """Map the file and read the tile table."""
+        self.filename = filename
+        with open(filename, 'rb') as packfile:
+            self.buf = mmap.mmap(packfile.fileno(), 0, access=mmap.ACCESS_READ)
+        # copies so the map can be closed while the table is in use
+        hdr = np.frombuffer(self.buf, dtype=PACK_HEADER, count=1).copy()[0]
+        if hdr['magic'] != MAGIC:
+            raise ValueError(filename + " is not a vola container")
+        start = PACK_HEADER.itemsize
+        self.table = np.frombuffer(self.buf, dtype=TABLE_DTYPE,
+                                   count=int(hdr['ntiles']),
+                                   offset=start).copy()
+        start += self.table.nbytes
+        names = self.buf[start:start + int(hdr['namesize'])]
+        self.names = names.decode('utf-8').split('\n') if names else []
+        start += int(hdr['namesize'])
+        self.vola = json.loads(
+            self.buf[start:start + int(hdr['volasize'])].decode('utf-8'))
+        self.lookup = dict((name, idx) for idx, name in enumerate(self.names))
+
+    def reader(self, name):
+        """File like reader for a tile."""
+        entry = self.table[self.lookup[name]]
+        return TileReader(self.buf, int(entry['offset']), int(entry['size']))
+
+    def close(self):
+        """Unmap the file."""
+        self.buf.close()
+
+
+OPEN_PACKS = {}
+
+
+def open_pack(filename):
+    """The VolaPack for a file, reopened if the file has changed."""
+    stat = os.stat(filename)
+    key = os.path.abspath(filename)
+    identity = (stat.st_size, stat.st_mtime_ns)
+    if key not in OPEN_PACKS or OPEN_PACKS[key][0] != identity:
+        OPEN_PACKS[key] = (identity, VolaPack(filename))
+    return OPEN_PACKS[key][1]
+
+
+def open_tile(filename, depth=None):
+    """open_file for a container.volapack#tilename filename."""
+    packname, name = filename.rsplit(vr.PACK_SEPARATOR, 1)
+    reader = open_pack(packname).reader(name)
+    return vr.parse_vol(reader, filename, depth)
+
+
+def load_vola(filename):
+    """
+    Read a .vola index, or the one stored in a .volapack container.
+
+    The tile filenames of a container index name the tiles inside it.
+    """
+    if not filename.endswith(".volapack"):
+        with open(filename) as volafile:
+            return json.load(volafile)
+    vola = copy.deepcopy(open_pack(filename).vola)
+    for entry in all_entries(vola):
+        entry['filename'] = filename + vr.PACK_SEPARATOR + entry['filename']
+    return vola
+
+
+def all_entries(vola):
+    """The tile entries of a .vola index followed by its overviews."""
+    entries = list(vola['files'])
+    for overview in vola.get('overviews', []):
+        entries.extend(overview['files'])
+    return entries
+
+
+def pack(volaname, packname):
+    """Write the tiles of a .vola dataset into a container."""
+    dirname = os.path.dirname(volaname)
+    with open(volaname) as volafile:
+        vola = json.load(volafile)
+
+    paths = []
+    for entry in all_entries(vola):
+        path = entry['filename']
+        if not os.path.isfile(path):
+            path = os.path.join(dirname, os.path.basename(path))
+        paths.append(path)
+        # tiles are named by their path relative to the .vola file
+        entry['filename'] = os.path.relpath(path, dirname or '.')
+    names = [entry['filename'] for entry in all_entries(vola)]
+    if len(set(names)) != len(names):
+        raise ValueError("tile names in " + volaname + " are not unique")
+    for name in names:
+        # open_tile splits container#tilename at the separator
+        if vr.PACK_SEPARATOR in name:
+            raise ValueError("tile name " + name + " holds " +
+                             vr.PACK_SEPARATOR + ", it can not be opened " +
+                             "from a container")
+    namebytes = '\n'.join(names).encode('utf-8')
+    volabytes = json.dumps(vola, sort_keys=True).encode('utf-8')
+
+    table = np.zeros(len(paths), dtype=TABLE_DTYPE)
+    offset = PACK_HEADER.itemsize + table.nbytes + len(namebytes) + \
+        len(volabytes)
+    for idx, path in enumerate(paths):
+        offset += -offset % 8
+        size = os.path.getsize(path)
+        with open(path, 'rb') as tilefile:
+            table['header'][idx] = np.frombuffer(
+                tilefile.read(bu.HEADER_DTYPE.itemsize),
+                dtype=bu.HEADER_DTYPE)[0]
+        table['offset'][idx] = offset
+        table['size'][idx] = size
+        offset += size
+
+    hdr = np.zeros(1, dtype=PACK_HEADER)
+    hdr['magic'] = MAGIC
+    hdr['ntiles'] = len(paths)
+    hdr['namesize'] = len(namebytes)
+    hdr['volasize'] = len(volabytes)
+
+    print("writing file:", packname)
+    with open(packname, 'wb') as packfile:
+        packfile.write(hdr.tobytes())
+        packfile.write(table.tobytes())
+        packfile.write(namebytes)
+        packfile.write(volabytes)
+        for path, entry in zip(paths, table):
+            packfile.write(b'\0' * (int(entry['offset']) - packfile.tell()))
+            with open(path, 'rb') as tilefile:
+                packfile.write(tilefile.read())
+    print("packed", len(paths), "tiles")
+
+
+def unpack(packname, outdir):
+    """Write the tiles of a container back out as a .vola dataset."""
+    volapack = open_pack(packname)
+    vola = copy.deepcopy(volapack.vola)
+    # tile names are relative paths, they must not lead out of outdir
+    root = os.path.abspath(outdir)
+    for name in volapack.names:
+        path = os.path.abspath(os.path.join(outdir, name))
+        if os.path.isabs(name) or os.path.commonpath([root, path]) != root:
+            raise ValueError("tile " + name + " in " + packname +
+                             " is outside " + outdir)
+    for name, entry in zip(volapack.names, volapack.table):
+        path = os.path.join(outdir, name)
+        if os.path.dirname(path) and not os.path.exists(
+                os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        start = int(entry['offset'])
+        with open(path, 'wb') as tilefile:
+            tilefile.write(volapack.buf[start:start + int(entry['size'])])
+    for entry in all_entries(vola):
+        entry['filename'] = os.path.join(outdir, entry['filename'])
+
+    base = os.path.join(outdir, os.path.splitext(
+        os.path.basename(packname))[0])
+    indexname = base + ".volaidx"
+    volaindex.build_index([entry['bbox'] for entry in vola['files']]).write(
+        indexname)
+    vola['index'] = os.path.basename(indexname)
+    print("writing file:", base + ".vola")
+    with open(base + ".vola", 'w') as volafile:
+        volafile.write(json.dumps(vola, sort_keys=True, indent=2))
+    print("unpacked", len(volapack.names), "tiles")
+
+
+def main():
+    """Pack a .vola dataset or unpack a .volapack container."""
+    start_time = bu.timer()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "input",
+        help="a .vola dataset to pack or a .volapack container to unpack",
+        type=str)
+    parser.add_argument(
+        "-o", "--output",
+        help="the container to write, or the folder to unpack into",
+        type=str)
+    parser.add_argument(
+        "-l", "--list",
+        help="list the tiles in a container",
+        action='store_true')
+    args = parser.parse_args()
+
+    if args.input.endswith(".volapack"):
+        if args.list:
+            volapack = open_pack(args.input)
+            for name, entry in zip(volapack.names, volapack.table):
+                print(name, int(entry['size']))
+        else:
+            unpack(args.input,
+                   args.output or os.path.splitext(args.input)[0])
+    elif args.input.endswith(".vola"):
+        pack(args.input, args.output or bu.sub(args.input, "volapack"))
+    else:
+        print("It needs to be a .vola or a .volapack file!")
+    bu.timer(start_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+VOLA triangle rasterizer.
+
+Finds the voxels that triangle meshes pass through, and optionally the
+voxels inside closed meshes, so that STL and PLY models convert to solid
+voxel surfaces instead of only their vertices. The triangles are given in
+voxel units (see VolaTree.gridcoords), where voxel (i, j, k) is the unit
+cube from (i, j, k) to (i + 1, j + 1, k + 1). All the work is done with
+numpy arrays: the triangles are expanded into (triangle, column) pairs a
+batch of pairs at a time, so a single large triangle is split over
+several batches.
+@author Jonathan Byrne & Anton Shmatov
+@copyright 2018 Intel Ltd (see LICENSE file).
+"""
+from __future__ import print_function
+import numpy as np
+
+# the fill rays are moved off the voxel centres by a small odd amount so
+# they do not pass exactly through the shared edges of triangles
+RAY_OFFSET = np.array([1.2345678e-6, 2.3456789e-6])
+
+
+def expand(counts):
+    """
+    Expand items into counts[i] entries each.
+
+    Returns the item of each entry and its position within the item.
+    """
+    items = np.repeat(np.arange(len(counts)), counts)
+    within = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+    return items, within
+
+
+def expand_batches(counts, batchsize):
+    """
+    expand(counts) a range of at most batchsize entries at a time.
+
+    Yields the item and position within the item of each entry. The
+    entries of an item with more than batchsize of them are split over
+    several batches.
+    """
+    ends = np.cumsum(counts)
+    total = int(ends[-1]) if len(ends) else 0
+    for start in range(0, total, batchsize):
+        entry = np.arange(start, min(start + batchsize, total))
+        items = np.searchsorted(ends, entry, side='right')
+        yield items, entry - (ends[items] - counts[items])
+
+
+def batches(counts, batchsize):
+    """
+    Split sorted counts into runs adding up to about batchsize.
+
+    Yields (start, stop) pairs, a single count larger than batchsize is a
+    batch of its own.
+    """
+    total = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        done = total[start - 1] if start > 0 else 0
+        stop = int(np.searchsorted(total, done + batchsize, side='right'))
+        stop = max(stop, start + 1)
+        yield start, stop
+        start = stop
+
+
+def triangle_voxels(triangles, sidelen, batchsize=1024 * 1024):
+    """
+    Find the voxels the surface of each triangle passes through.
+
+    triangles is an (n, 3, 3) array of corners in voxel units. Each
+    triangle is projected along the axis its normal is closest to, the
+    voxel columns its projection overlaps are found with a separating axis
+    test and the height of the triangle plane over each column gives the
+    voxels in that column (at most three), which are checked against the
+    remaining axes of the test. Voxels outside the sidelen grid are left
+    out. Yields (voxels, triangle index) array pairs for at most
+    batchsize columns at a time; the same voxel can be given by several
+    triangles.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    normals = np.cross(triangles[:, 1] - triangles[:, 0],
+                       triangles[:, 2] - triangles[:, 0])
+    dominant = np.argmax(np.abs(normals), axis=1)
+    degenerate = ~np.any(normals, axis=1)
+
+    # triangles without an area only cover their corners
+    if np.any(degenerate):
+        corners = np.floor(triangles[degenerate]).astype(np.int64)
+        voxels = corners.reshape(-1, 3)
+        inside = np.all((voxels >= 0) & (voxels < sidelen), axis=1)
+        tris = np.repeat(np.nonzero(degenerate)[0], 3)
+        yield voxels[inside], tris[inside]
+
+    for axis in range(3):
+        # project along axis, u and v are the other two axes
+        order = [(axis + 1) % 3, (axis + 2) % 3, axis]
+        tris = np.nonzero((dominant == axis) & ~degenerate)[0]
+        if len(tris) == 0:
+            continue
+        corners = triangles[tris][:, :, order]
+        tnormals = normals[tris][:, order]
+        low = np.maximum(np.floor(corners[:, :, :2].min(axis=1)), 0)
+        high = np.minimum(np.floor(corners[:, :, :2].max(axis=1)),
+                          sidelen - 1)
+        counts = np.prod(np.maximum(high - low + 1, 0), axis=1)
+        counts = counts.astype(np.int64)
+
+        for tri, within in expand_batches(counts, batchsize):
+            voxels, tri = surface_columns(corners, tnormals, low, high,
+                                          tri, within)
+            inside = (voxels[:, 2] >= 0) & (voxels[:, 2] < sidelen)
+            found = np.empty((np.count_nonzero(inside), 3), dtype=np.int64)
+            found[:, order] = voxels[inside]
+            yield found, tris[tri[inside]]
+
+
+def surface_columns(corners, normals, low, high, tri, within):
+    """
+    Voxels of triangles projected along their last axis.
+
+    corners and normals are in (u, v, w) order with w the projection axis,
+    low and high are the first and last (u, v) columns of each triangle.
+    tri and within are the triangle of each column to test and its
+    position among the columns of the triangle, see expand_batches.
+    Returns the (u, v, w) voxels and the triangle each came from.
+    """
+    span = (high[:, 0] - low[:, 0] + 1).astype(np.int64)[tri]
+    ucol = low[tri, 0] + within % span
+    vcol = low[tri, 1] + within // span
+
+    # separating axis test of the column square against the edge normals
+    keep = np.ones(len(tri), dtype=bool)
+    ucentre = ucol + 0.5
+    vcentre = vcol + 0.5
+    for edge in range(3):
+        first = corners[:, edge, :2]
+        second = corners[:, (edge + 1) % 3, :2]
+        third = corners[:, (edge + 2) % 3, :2]
+        uaxis = first[:, 1] - second[:, 1]
+        vaxis = second[:, 0] - first[:, 0]
+        edgedist = uaxis * first[:, 0] + vaxis * first[:, 1]
+        thirddist = uaxis * third[:, 0] + vaxis * third[:, 1]
+        tmin = np.minimum(edgedist, thirddist)[tri]
+        tmax = np.maximum(edgedist, thirddist)[tri]
+        boxdist = uaxis[tri] * ucentre + vaxis[tri] * vcentre
+        radius = 0.5 * (np.abs(uaxis) + np.abs(vaxis))[tri]
+        keep &= (boxdist - radius <= tmax) & (boxdist + radius >= tmin)
+    tri, ucol, vcol = tri[keep], ucol[keep], vcol[keep]
+
+    # height of the plane over the part of the column inside the triangle
+    tmin = corners.min(axis=1)[tri]
+    tmax = corners.max(axis=1)[tri]
+    ulow = np.maximum(ucol, tmin[:, 0])
+    uhigh = np.minimum(ucol + 1, tmax[:, 0])
+    vlow = np.maximum(vcol, tmin[:, 1])
+    vhigh = np.minimum(vcol + 1, tmax[:, 1])
+    offset = np.sum(normals * corners[:, 0], axis=1)[tri]
+    unormal, vnormal, wnormal = normals[tri].T
+    heights = [(offset - unormal * upos - vnormal * vpos) / wnormal
+               for upos in (ulow, uhigh) for vpos in (vlow, vhigh)]
+    lowest = np.minimum(np.minimum(heights[0], heights[1]),
+                        np.minimum(heights[2], heights[3]))
+    highest = np.maximum(np.maximum(heights[0], heights[1]),
+                         np.maximum(heights[2], heights[3]))
+    wlow = np.floor(np.maximum(lowest, tmin[:, 2]))
+    whigh = np.floor(np.minimum(highest, tmax[:, 2]))
+    depths = (whigh - wlow + 1).astype(np.int64)
+
+    entry, within = expand(depths)
+    voxels = np.empty((len(entry), 3), dtype=np.int64)
+    voxels[:, 0] = ucol[entry]
+    voxels[:, 1] = vcol[entry]
+    voxels[:, 2] = wlow[entry].astype(np.int64) + within
+
+    # the rest of the separating axis test, the edges seen along u and v,
+    # with the corners relative to the voxel centre
+    tri = tri[entry]
+    relative = [[corners[tri, corner, axis] - (voxels[:, axis] + 0.5)
+                 for axis in range(3)] for corner in range(3)]
+    keep = np.ones(len(tri), dtype=bool)
+    for edge in range(3):
+        start, end = relative[edge], relative[(edge + 1) % 3]
+        direction = [end[axis] - start[axis] for axis in range(3)]
+        for first, second in ((1, 2), (2, 0)):
+            firstaxis = -direction[second]
+            secondaxis = direction[first]
+            dists = [point[first] * firstaxis + point[second] * secondaxis
+                     for point in relative]
+            radius = 0.5 * (np.abs(firstaxis) + np.abs(secondaxis))
+            keep &= (np.minimum(np.minimum(dists[0], dists[1]),
+                                dists[2]) <= radius) & \
+                (np.maximum(np.maximum(dists[0], dists[1]),
+                            dists[2]) >= -radius)
+    return voxels[keep], tri[keep]
+
+
+def fill_voxels(triangles, sidelen, batchsize=1024 * 1024):
+    """
+    Find the voxels inside a closed mesh.
+
+    A ray is cast up the z axis through the centre of every voxel column
+    and the voxels between the first and second, third and fourth ...
+    crossings of the mesh surface are inside (the parity rule). A column
+    with an odd number of crossings, from a mesh that is not closed, has
+    the last one left out. Yields arrays of voxels a batch at a time.
+    """
+    triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+    columns, heights = [], []
+    flat = triangles[:, :, :2]
+    low = np.maximum(np.ceil(flat.min(axis=1) - 0.5 - RAY_OFFSET), 0)
+    high = np.minimum(np.floor(flat.max(axis=1) - 0.5 - RAY_OFFSET),
+                      sidelen - 1)
+    counts = np.prod(np.maximum(high - low + 1, 0), axis=1).astype(np.int64)
+
+    for tri, within in expand_batches(counts, batchsize):
+        column, height = ray_crossings(triangles, low, high, tri, within)
+        columns.append(column[:, 0] + sidelen * column[:, 1])
+        heights.append(height)
+    if not columns:
+        return
+    columns = np.concatenate(columns)
+    heights = np.concatenate(heights)
+
+    # pair up the crossings of each column in height order
+    order = np.lexsort((heights, columns))
+    columns, heights = columns[order], heights[order]
+    first = np.concatenate(([True], columns[1:] != columns[:-1]))
+    rank = np.arange(len(columns)) - np.maximum.accumulate(
+        np.where(first, np.arange(len(columns)), 0))
+    enter = np.nonzero((rank % 2 == 0)[:-1] &
+                       (columns[1:] == columns[:-1]))[0]
+    column = columns[enter]
+    zlow = np.maximum(np.ceil(heights[enter] - 0.5), 0).astype(np.int64)
+    zhigh = np.minimum(np.floor(heights[enter + 1] - 0.5),
+                       sidelen - 1).astype(np.int64)
+    depths = np.maximum(zhigh - zlow + 1, 0)
+
+    for start, stop in batches(depths, batchsize):
+        entry, within = expand(depths[start:stop])
+        entry += start
+        voxels = np.empty((len(entry), 3), dtype=np.int64)
+        voxels[:, 0] = column[entry] % sidelen
+        voxels[:, 1] = column[entry] // sidelen
+        voxels[:, 2] = zlow[entry] + within
+        yield voxels
+
+
+def ray_crossings(triangles, low, high, tri, within):
+    """
+    Columns whose ray crosses each triangle and the height of the crossing.
+
+    low and high are the first and last (x, y) columns whose centre may be
+    inside each triangle, tri and within the triangle of each column to
+    test and its position among them, see expand_batches.
+    """
+    span = (high - low + 1).astype(np.int64)[tri]
+    column = low[tri] + np.stack((within % span[:, 0],
+                                  within // span[:, 0]), axis=1)
+    ray = column + 0.5 + RAY_OFFSET
+
+    # the ray is inside if it is on the same side of all three edges
+    sides = []
+    corners = triangles[tri]
+    for edge in range(3):
+        first = corners[:, edge, :2]
+        second = corners[:, (edge + 1) % 3, :2]
+        sides.append((second[:, 0] - first[:, 0]) * (ray[:, 1] - first[:, 1]) -
+                     (second[:, 1] - first[:, 1]) * (ray[:, 0] - first[:, 0]))
+    sides = np.stack(sides, axis=1)
+    inside = np.all(sides > 0, axis=1) | np.all(sides < 0, axis=1)
+    normal = np.cross(corners[:, 1] - corners[:, 0],
+                      corners[:, 2] - corners[:, 0])
+    # triangles seen edge on are never crossed
+    inside &= normal[:, 2] != 0
+    column, ray, corners = column[inside], ray[inside], corners[inside]
+    normal = normal[inside]
+    offset = np.sum(normal * corners[:, 0], axis=1)
+    height = (offset - normal[:, 0] * ray[:, 0] -
+              normal[:, 1] * ray[:, 1]) / normal[:, 2]
+    return column.astype(np.int64), height
@@ -11,11 +11,15 @@ from __future__ import print_function
 import struct
 import argparse
 import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
 import binutils as bu
-import random
 from volatree import VolaTree
 
+# separates a .volapack container from the name of a tile inside it
+PACK_SEPARATOR = '#'
+
 
 def main():
     """Pull the xyz coordinates of the voxels from the bit array."""
@@ -63,6 +67,24 @@ def main():
         help="output image planes for each depth",
         action='store_true')
 
+    parser.add_argument(
+        "--imageformat",
+        help="image format for the image planes",
+        choices=['pgm', 'png'],
+        default='pgm')
+
+    parser.add_argument(
+        "--slicedepth",
+        help="only output the image planes for this depth",
+        type=int)
+
+    parser.add_argument(
+        "--zrange",
+        nargs=2,
+        help="only output image planes between these z values (inclusive)\
+              at the depth being sliced. uses the format: --zrange zmin zmax",
+        type=int)
+
     parser.add_argument(
         "-m",
         "--map",
@@ -76,9 +98,35 @@ def main():
         help="output the occupancy grid to a numpy array",
         action='store_true')
 
+    parser.add_argument(
+        "--gridtype",
+        help="element type of the numpy occupancy grid. packed uses\
+              np.packbits along the z axis (8 voxels per byte)",
+        choices=['bool', 'uint8', 'packed'],
+        default='uint8')
+
+    parser.add_argument(
+        "--gridchunk",
+        help="write the numpy grid in slabs of this many x planes to a\
+              memory mapped .npy instead of building it in memory",
+        type=int,
+        default=0)
+
+    parser.add_argument(
+        "--cachedir",
+        help="keep the decoded voxels in this directory and reuse them while\
+              the .vol file is unchanged",
+        type=str)
+
     args = parser.parse_args()
-    header, levels, data = open_file(args.vol)
-    voxels, voxel_data = get_voxels(header, levels, data)
+    if args.cachedir:
+        from volacache import TileCache
+        header, voxels, voxel_data = TileCache(args.cachedir).load(args.vol)
+        voxels = [tuple(vox) for vox in voxels.tolist()]
+        voxel_data = list(voxel_data)
+    else:
+        header, levels, data = open_file(args.vol)
+        voxels, voxel_data = get_voxels(header, levels, data)
     argUsed = False
 
     if args.voxels:
@@ -95,7 +143,11 @@ def main():
     if args.images:
         argUsed = True
         print("writing slices to image folder")
-        slice_layers(voxels, header)
+        if args.slicedepth:
+            depths = [args.slicedepth]
+        else:
+            depths = None
+        slice_layers(voxels, header, depths, args.zrange, args.imageformat)
 
     if args.map > 0:
         argUsed = True
@@ -105,7 +157,7 @@ def main():
     if args.numpy:
         argUsed = True
         print("generating Numpy Grid")
-        numpy_grid(voxels, header)
+        numpy_grid(voxels, header, args.gridtype, args.gridchunk)
 
     if args.bincoords:
         argUsed = True
@@ -115,6 +167,8 @@ def main():
 
     if args.get:
         argUsed = True
+        if args.cachedir:
+            header, levels, data = open_file(args.vol)
         get_voxel(args.get, header, levels)
 
     if args.header:
@@ -124,58 +178,65 @@ def main():
     if not argUsed:
         parser.print_help()
 
-def open_file(filename):
+def open_file(filename, depth=None):
     """
     Given a filename, read the header and data.
 
-    Returns header dictionary and two lists.
+    Returns header dictionary and two lists of uint64 arrays, one per level.
+    If depth is given only the levels down to that depth are read and the
+    header describes the volume at that (coarser) resolution, with the depth
+    stored in the file kept as filedepth. A tile inside a .volapack
+    container is opened with a container.volapack#tilename filename.
     """
-    header = {}
+    if PACK_SEPARATOR in filename and not os.path.isfile(filename):
+        import volapack
+        return volapack.open_tile(filename, depth)
     with open(filename, "rb") as f:
-        header['filename'] = filename
-        header['headersize'] = struct.unpack('I', f.read(4))[0]
-        header['version'] = struct.unpack('H', f.read(2))[0]
-        header['mode'] = struct.unpack('B', f.read(1))[0]
-        header['depth'] = struct.unpack('B', f.read(1))[0]
-        header['nbits'] = struct.unpack('I', f.read(4))[0]
-        header['crs'] = struct.unpack('I', f.read(4))[0]
-        header['lat'] = struct.unpack('d', f.read(8))[0]
-        header['lon'] = struct.unpack('d', f.read(8))[0]
-        header['minx'] = struct.unpack('d', f.read(8))[0]
-        header['miny'] = struct.unpack('d', f.read(8))[0]
-        header['minz'] = struct.unpack('d', f.read(8))[0]
-        header['maxx'] = struct.unpack('d', f.read(8))[0]
-        header['maxy'] = struct.unpack('d', f.read(8))[0]
-        header['maxz'] = struct.unpack('d', f.read(8))[0]
-        header['offset'] = [header['minx'], header['miny'], header['minz']]
-        header['sidelength'] = pow(4, header['depth'])
-        header['diff'] = [header['maxx'] - header['minx'],
-                          header['maxy'] - header['miny'],
-                          header['maxz'] - header['minz']]
-        header['cubesize'] = max(header['diff']) / header['sidelength']
-        # initialise lists for storing levels related data
-        levels = []
-        data = []
-        bitcnt = 1
-        # pull in the 64 bit chunks and assign to a level.
-        # If using nbits then extract that too!
-        for d in range(header['depth']):
-            levels.append([])
-            newcnt = 0
-            for i in range(bitcnt):
-                chunk = np.uint64(get_chunk(f))
-                newcnt += bu.count_bits(chunk)
-                levels[d].append(chunk)
-            if header['nbits'] > 0:
-                data.append([])
-                for i in range(bitcnt):
-                    chunk = np.uint64(get_chunk(f))
-                    data[d].append(chunk)
-            bitcnt = newcnt
+        return parse_vol(f, filename, depth)
+
+
+def parse_vol(f, filename, depth=None):
+    """Read a .vol from a file like object, see open_file."""
+    header = bu.read_header(f)
+    header['filename'] = filename
+    header['filedepth'] = header['depth']
+    if depth is not None:
+        header['depth'] = min(depth, header['filedepth'])
+    header['offset'] = [header['minx'], header['miny'], header['minz']]
+    header['sidelength'] = pow(4, header['depth'])
+    header['diff'] = [header['maxx'] - header['minx'],
+                      header['maxy'] - header['miny'],
+                      header['maxz'] - header['minz']]
+    header['cubesize'] = max(header['diff']) / header['sidelength']
+    f.seek(header['headersize'])
+    # initialise lists for storing levels related data
+    levels = []
+    data = []
+    bitcnt = 1
+    # an empty tree is written as the header alone
+    if not f.read(1):
+        bitcnt = 0
+    f.seek(header['headersize'])
+    # pull in the 64 bit chunks and assign to a level. The number of
+    # chunks in a level is the number of bits set in the level above.
+    # If using nbits then extract that too!
+    for _ in range(header['depth']):
+        chunks = get_chunks(f, bitcnt)
+        levels.append(chunks)
+        if header['nbits'] > 0:
+            data.append(get_chunks(f, bitcnt))
+        bitcnt = int(bu.count_bits_np(chunks).sum())
 
     return header, levels, data
 
 
+def disk_file(filename):
+    """The file on disk holding a .vol, the container for packed tiles."""
+    if PACK_SEPARATOR in filename and not os.path.isfile(filename):
+        return filename.rsplit(PACK_SEPARATOR, 1)[0]
+    return filename
+
+
 def print_header(header):
     """Print the data contained in the header."""
     print("headersize", header['headersize'])
@@ -190,22 +251,66 @@ def print_header(header):
 
 def get_voxels(header, levels, data):
     """Generate a set of xyz position in the bounding box of the VOLA data."""
-    depth = header['depth']
-    indexes = get_all_indexes(levels, depth)
-    indexes, dataindexes = traverse_indexes(
-        [], indexes, depth - 1, [0] * depth)
+    voxels, voxel_data = get_voxels_np(header, levels, data)
+    voxels = [tuple(vox) for vox in voxels.tolist()]
+    return voxels, list(voxel_data)
+
 
-    voxels = []
-    voxel_data = []
-    for index in indexes:
-        voxels.append(bu.xyz_from_sparse_index(index))
+def get_voxels_np(header, levels, data, box=None):
+    """
+    Vectorised version of get_voxels returning numpy arrays.
+
+    The levels are expanded breadth first: every set bit of a level
+    becomes the origin of the next level's chunk at four times the
+    resolution, which keeps the same depth first ordering as
+    traverse_indexes. If a box [[minx, miny, minz], [maxx, maxy, maxz]] of
+    voxel positions is given (inclusive), branches outside it are pruned
+    as the levels are expanded. Returns an (n, 3) int64 array of voxel
+    positions and the uint64 data of each voxel (empty if there is no
+    nbits data).
+    """
+    depth = header['depth']
+    origins = np.zeros((1, 3), dtype=np.int64)
+    # an empty tree has no top chunk
+    chunks = np.zeros(1 if depth and len(levels[0]) else 0, dtype=np.int64)
+    origins = origins[:len(chunks)]
+    leafchunks = chunks
+    for d in range(depth):
+        level = np.asarray(levels[d], dtype=np.uint64)
+        bits = bu.unpack_bits_np(level[chunks])
+        rows, bitidx = np.nonzero(bits)
+        offsets = np.stack((bitidx % 4, bitidx % 16 // 4, bitidx // 16),
+                           axis=1)
+        origins = origins[rows] * 4 + offsets
+        leafchunks = chunks[rows]
+
+        # the n-th set bit of a level points to the n-th chunk below it
+        if d < depth - 1:
+            counts = bu.count_bits_np(level)
+            starts = np.cumsum(counts) - counts
+            # nonzero is row major so the rank within a row is the
+            # distance from the first bit of the row
+            rowcounts = np.count_nonzero(bits, axis=1)
+            rowstarts = np.cumsum(rowcounts) - rowcounts
+            within = np.arange(len(rows)) - rowstarts[rows]
+            chunks = starts[leafchunks] + within
+
+        if box is not None:
+            scale = pow(4, depth - d - 1)
+            keep = np.all((origins * scale <= box[1]) &
+                          ((origins + 1) * scale > box[0]), axis=1)
+            origins, leafchunks = origins[keep], leafchunks[keep]
+            if d < depth - 1:
+                chunks = chunks[keep]
 
     if header['nbits'] > 0:
         # we could do this for each level but only care about the bottom
-        for dindex in dataindexes:
-            voxel_data.append(data[depth - 1][dindex[-1]])
+        voxel_data = np.asarray(data[depth - 1],
+                                dtype=np.uint64)[leafchunks]
+    else:
+        voxel_data = np.zeros(0, dtype=np.uint64)
 
-    return voxels, voxel_data
+    return origins, voxel_data
 
 
 def get_coords(header, voxels):
@@ -224,6 +329,45 @@ def get_coords(header, voxels):
         return coordinates
 
 
+def get_coords_np(header, voxels):
+    """Vectorised version of get_coords returning an (n, 3) float array."""
+    voxels = np.asarray(voxels, dtype=np.float64).reshape(-1, 3)
+    if header['crs'] == 2000:
+        return voxels
+    scale = max(header['diff']) / header['sidelength']
+    return voxels * scale + np.asarray(header['offset'])
+
+
+def get_positions_np(header, coords, gridded=False):
+    """
+    The voxel position holding each coordinate of the bounding box frame.
+
+    This maps coordinates as VolaTree.getkeys did when the tile was made,
+    it always uses the header bbox, also when the crs is not set. Without
+    a global grid getkeys rounds (sidelength - 1) * the normalised
+    coordinate. With gridded, for tiles made with --cubesize, the voxels
+    are cubesize cells from the lower corner and coordinates on the far
+    side of the bbox are put in the last voxel. Returns an (n, 3) int64
+    array, positions lie outside the volume if the coordinates do.
+    """
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    offset = np.asarray(header['offset'])
+    maxvals = np.asarray([header['maxx'], header['maxy'], header['maxz']])
+    sidelength = header['sidelength']
+    if not gridded:
+        # getkeys normalises to the cube of the longest side
+        norms = (coords - offset) / max(header['diff'])
+        positions = np.around((sidelength - 1) * norms)
+        positions[norms < 0] = -1
+        positions[norms > 1] = sidelength
+        return positions.astype(np.int64)
+    scale = max(header['diff']) / sidelength
+    positions = np.floor((coords - offset) / scale)
+    inside = coords <= maxvals
+    last = np.minimum(positions, sidelength - 1)
+    return np.where(inside, last, positions).astype(np.int64)
+
+
 def get_voxel(coord, header, levels):
     """Check if a voxel exists and return the block index value."""
     depth = header['depth']
@@ -315,6 +459,15 @@ def traverse_indexes(prev, levels, depth, levelcnt):
     return traversed, dataindexes
 
 
+def get_chunks(filereader, count):
+    """Utility function for reading count 64 bit chunks into an array."""
+    data = filereader.read(8 * count)
+    if len(data) < 8 * count:
+        print("prematurely hit end of file")
+        exit()
+    return np.frombuffer(data, dtype='<u8').astype(np.uint64)
+
+
 def get_chunk(filereader):
     """Utility function for reading 64 bit chunks."""
     data = filereader.read(8)
@@ -360,63 +513,153 @@ def generate_map(coordinates, header, start_height):
     write_pgm(filename, bitmap)
 
 
-def numpy_grid(coordinates, header):
-    """For a given starting height, compress the maps to a plane."""
-    basename = os.path.basename(
+def numpy_grid(coordinates, header, gridtype='uint8', chunk=0):
+    """
+    Write the occupancy grid of the volume to a numpy (.npy) file.
+
+    The grid can be stored as bool, uint8 or packed, where packed uses
+    np.packbits along the z axis. If chunk is set, slabs of that many x
+    planes are filled and written into a memory mapped .npy in turn so the
+    full grid never has to be held in memory.
+    """
+    filename = os.path.basename(
         header['filename']).replace(
         '.vol',
         '.npy')
-    filename = basename
-    
-    depth = header['depth']
-    sidelen = pow(4, depth)
-    level = np.zeros((sidelen, sidelen, sidelen))
-    sumlevel = np.zeros((sidelen, sidelen, sidelen))
 
-    for coord in coordinates:
-        sumlevel[coord] = 1
+    sidelen = header['sidelength']
+    coords = np.asarray(coordinates, dtype=np.intp).reshape(-1, 3)
+
+    if chunk <= 0:
+        grid = occupancy_block(coords, sidelen, sidelen, gridtype)
+        np.save(filename, grid)
+        return filename
+
+    # sort on x once so each slab is a contiguous run of coordinates
+    coords = coords[np.argsort(coords[:, 0], kind='mergesort')]
+    first = occupancy_block(coords[:0], 1, sidelen, gridtype)
+    grid = np.lib.format.open_memmap(
+        filename, mode='w+', dtype=first.dtype,
+        shape=(sidelen,) + first.shape[1:])
+
+    for start in range(0, sidelen, chunk):
+        end = min(start + chunk, sidelen)
+        low, high = np.searchsorted(coords[:, 0], [start, end])
+        slab = coords[low:high] - [start, 0, 0]
+        grid[start:end] = occupancy_block(slab, end - start, sidelen,
+                                          gridtype)
+    grid.flush()
+    del grid
+    return filename
+
+
+def occupancy_block(coords, xlen, sidelen, gridtype='uint8'):
+    """
+    Fill a (xlen, sidelen, sidelen) occupancy block from voxel coordinates.
+
+    Coordinates are set by fancy indexing. For the packed grid type the z
+    axis is compressed with np.packbits.
+    """
+    if gridtype == 'bool':
+        block = np.zeros((xlen, sidelen, sidelen), dtype=np.bool_)
+    else:
+        block = np.zeros((xlen, sidelen, sidelen), dtype=np.uint8)
 
-    bitmap = np.sum(sumlevel, axis=2)
+    block[coords[:, 0], coords[:, 1], coords[:, 2]] = 1
+
+    if gridtype == 'packed':
+        block = np.packbits(block, axis=2)
+    return block
 
-    for coord in coordinates:
-        # Randomly deleting voxels, bias for height
-        # x, y, z = coord
-        # zfactor = z / 10
-        # if zfactor < 1:
-        #     zfactor = 1
-        #
-        # likelihood = 0.0001 + ((0.1 * bitmap[x][y]) / zfactor)
-        #
-        # if random.random() > likelihood:
-        level[coord] = 1
-    np.save(filename, level)
 
+def slice_layers(coordinates, header, depths=None, zrange=None,
+                 imageformat='pgm', workers=None):
+    """
+    Slice the 3D model into image planes.
 
-def slice_layers(coordinates, header):
-    """Slice the 3D model into image planes."""
+    For each depth the voxels are shifted to that resolution and sorted by
+    plane so only one image is built at a time. Files are written as binary
+    PGM or 1 bit PNG images by a pool of threads. depths restricts the
+    depths sliced and zrange the (inclusive) planes written at each depth.
+    """
     imagedir = "./images/"
     if not os.path.exists(imagedir):
         os.makedirs(imagedir)
 
-    for depth in range(1, header['depth'] + 1):
+    if depths is None:
+        depths = range(1, header['depth'] + 1)
+    if imageformat == 'png':
+        writer = write_png
+    else:
+        writer = write_pgm
+
+    coords = np.asarray(coordinates, dtype=np.int64).reshape(-1, 3)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = set()
+
+    for depth in depths:
         bitshift = 2 * (header['depth'] - depth)
         sidelen = pow(4, depth)
-        level = np.zeros((sidelen, sidelen, sidelen))
+        planesize = sidelen * sidelen
+
+        # z major plane keys, sorting them groups the voxels by plane
+        shifted = coords >> bitshift
+        keys = np.unique(shifted[:, 2] * planesize +
+                         shifted[:, 0] * sidelen + shifted[:, 1])
+
+        zmin, zmax = 0, sidelen - 1
+        if zrange is not None:
+            zmin, zmax = max(zrange[0], 0), min(zrange[1], sidelen - 1)
+        bounds = np.searchsorted(keys, np.arange(zmin, zmax + 2) * planesize)
+
+        for z in range(zmin, zmax + 1):
+            plane = np.zeros(planesize, dtype=np.uint8)
+            low, high = bounds[z - zmin], bounds[z - zmin + 1]
+            plane[keys[low:high] - z * planesize] = 1
 
-        for coord in coordinates:
-            coord = tuple([x >> bitshift for x in coord])
-            level[coord] = 1
+            # keep the number of queued images bounded
+            if len(pending) >= 2 * workers:
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
+            fname = imagedir + "depth{}-{:03d}.{}".format(depth, z,
+                                                          imageformat)
+            pending.add(pool.submit(writer, fname,
+                                    plane.reshape(sidelen, sidelen)))
 
-        for z in range(level.shape[2]):
-            fname = imagedir + "depth{}-{:03d}.pgm".format(depth, z)
-            write_pgm(fname, level[:, :, z])
+    for future in pending:
+        future.result()
+    pool.shutdown()
 
 
 def write_pgm(fname, data):
-    """Output the data as ascii PGM images."""
-    sidelen = data.shape[0]
-    hdr = "P2\n" + str(sidelen) + " " + str(sidelen) + " 1\n"
-    np.savetxt(fname, data, fmt='%i', delimiter=' ', header=hdr, comments='')
+    """Output the data as binary (P5) PGM images."""
+    data = np.asarray(data, dtype=np.uint8)
+    maxval = max(int(data.max()), 1)
+    hdr = "P5\n{} {}\n{}\n".format(data.shape[1], data.shape[0], maxval)
+    with open(fname, 'wb') as imagefile:
+        imagefile.write(hdr.encode('ascii'))
+        imagefile.write(data.tobytes())
+
+
+def write_png(fname, data):
+    """Output the data as 1 bit greyscale PNG images."""
+    height, width = data.shape
+    rows = np.packbits(np.asarray(data) > 0, axis=1)
+    # every scanline is prefixed with filter type 0 (none)
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rows])
+    ihdr = struct.pack('>IIBBBBB', width, height, 1, 0, 0, 0, 0)
+    with open(fname, 'wb') as imagefile:
+        imagefile.write(b'\x89PNG\r\n\x1a\n')
+        imagefile.write(png_chunk(b'IHDR', ihdr))
+        imagefile.write(png_chunk(b'IDAT', zlib.compress(raw.tobytes())))
+        imagefile.write(png_chunk(b'IEND', b''))
+
+
+def png_chunk(tag, body):
+    """Wrap a PNG chunk with its length and crc."""
+    crc = zlib.crc32(tag + body) & 0xffffffff
+    return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', crc)
 
 
 if __name__ == '__main__':
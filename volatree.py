@@ -10,13 +10,23 @@ from __future__ import print_function
 import pyproj
 import numpy as np
 import binutils as bu
+import volaraster
 
 
 class VolaTree(object):
     """VOLA tree representation."""
 
-    def __init__(self, max_depth, bbox, crs, dense, nbits):
-        """Create levels, set bounding box, etc."""
+    def __init__(self, max_depth, bbox, crs, dense, nbits, gridorigin=None,
+                 cubesize=None):
+        """
+        Set bounding box, etc. The levels are made by build().
+
+        If a cubesize is given the voxels are snapped to a global grid of
+        that size starting at gridorigin (0, 0, 0 by default). The bbox is
+        then replaced by the grid tile of side cubesize * 4^depth holding
+        the lower corner of the points, so the voxels of all the volumes
+        made on the same grid line up.
+        """
         self.version = 1
         self.headersize = 80
         self.max_depth = max_depth
@@ -24,78 +34,246 @@ class VolaTree(object):
         self.crs = crs
         self.sparse = not dense
         self.nbits = nbits
-        self.difference = [i - j for i, j in zip(self.bbox[1], self.bbox[0])]
         self.sidedivisions = pow(4, max_depth)
+        self.cubesize = cubesize
+        if cubesize is not None:
+            self.align(bbox, gridorigin)
+        self.difference = [i - j for i, j in zip(self.bbox[1], self.bbox[0])]
+        # one uint64 array per level, followed by the payload words if nbits
         self.levels = []
-        # assign vol arrays for each level. L5 slow at 1073741824 subdivisions
-        # and side length of 1024
-        for i in range(max_depth):
-            if self.nbits > 0:
-                level = [np.uint64(0)] * (pow(64, i) * 2)
-                self.levels.append(level)
-            else:
-                level = [np.uint64(0)] * (pow(64, i))
-                self.levels.append(level)
+        # morton codes and payloads added since the last build
+        self.codes = []
+        self.payloads = []
+        self.dirty = True
 
     def cubify(self, points, pointsdata=None):
         """Split the point cloud into integer voxel coordinates."""
-        uniquecubes = {}
+        self.addpoints(points, pointsdata)
+        self.build()
+
+    def align(self, bbox, gridorigin=None):
+        """Snap the bounding box to a tile of the global grid."""
+        if gridorigin is None:
+            gridorigin = [0, 0, 0]
+        self.gridorigin = np.array(gridorigin, dtype=np.float64)
+        tileside = self.cubesize * self.sidedivisions
+        voxels = np.floor((np.array(bbox) - self.gridorigin) / self.cubesize)
+        # integer tile position so neighbouring tiles share exact edges
+        self.tileindex = np.int64(voxels[0]) // self.sidedivisions
+        lastindex = np.int64(voxels[1]) // self.sidedivisions
+        if np.any(lastindex != self.tileindex):
+            print("Warning: the points span more than one grid tile of side",
+                  tileside, "and the points outside it are dropped, use a",
+                  "larger depth")
+        tilemin = self.gridorigin + self.tileindex * tileside
+        self.bbox = [tilemin.tolist(), (tilemin + tileside).tolist()]
+
+    def getkeys(self, points):
+        """
+        Integer voxel coordinates of points inside the bounding box.
+
+        On a global grid the keys of points outside the grid tile are
+        outside 0 to sidedivisions - 1, addvoxels leaves them out.
+        """
+        if self.cubesize is not None:
+            voxels = np.floor((np.asarray(points) - self.gridorigin) /
+                              self.cubesize)
+            return np.int64(voxels) - self.tileindex * self.sidedivisions
         maxlen = max(self.difference)
         bmin = np.array(self.bbox[0])
+        norms = bu.normalize_np(np.asarray(points), bmin, bmin + maxlen)
+        return np.int64(np.around((self.sidedivisions - 1) * norms))
 
-        norms = bu.normalize_np(points, bmin, bmin + maxlen)
-        keys = np.int_(np.around((self.sidedivisions - 1) * norms))
-
-        # use idx to not conflict with inbuilt id()
-        for idx, key in enumerate(map(tuple, keys)):
+    def addpoints(self, points, pointsdata=None):
+        """Add the voxels of a chunk of points, see addvoxels."""
+        payloads = None
+        if self.nbits > 0:
             if isinstance(pointsdata, np.ndarray):
-                uniquecubes[key] = pointsdata[idx]
+                payloads = bu.pack_payloads(pointsdata)
             else:
-                uniquecubes[key] = [255, 255, 255, 255, 255, 255, 255]
+                payloads = bu.pack_payloads([[255] * 7] * len(points))
+        self.addvoxels(self.getkeys(points), payloads)
 
-        print("Computed number of occupied voxels:", len(uniquecubes))
-        print("Now building vola tree")
-        for key in sorted(uniquecubes.keys()):
-            self.setvoxel(key, uniquecubes[key])
+    def gridcoords(self, points):
+        """
+        Voxel coordinates of points as floats, getkeys is their floor.
+
+        Voxel (i, j, k) covers the unit cube from (i, j, k) to (i + 1,
+        j + 1, k + 1).
+        """
+        points = np.asarray(points, dtype=np.float64)
+        if self.cubesize is not None:
+            return (points - self.gridorigin) / self.cubesize - \
+                self.tileindex * self.sidedivisions
+        maxlen = max(self.difference)
+        bmin = np.array(self.bbox[0])
+        # getkeys rounds here, so move by half a voxel to make it a floor
+        return (self.sidedivisions - 1) * (points - bmin) / maxlen + 0.5
+
+    def addtriangles(self, triangles, payloads=None, fill=False):
+        """
+        Add the voxels the surface of (n, 3, 3) triangles passes through.
+
+        payloads are packed uint64 payloads for each triangle. With fill
+        set the voxels inside the mesh are added too, the mesh has to be
+        closed for that, see volaraster.fill_voxels.
+        """
+        triangles = np.asarray(triangles, dtype=np.float64).reshape(-1, 3, 3)
+        corners = self.gridcoords(triangles)
+        # the inside goes first so the surface voxels keep their payloads
+        if fill:
+            for voxels in volaraster.fill_voxels(corners, self.sidedivisions):
+                self.addvoxels(voxels)
+        for voxels, tris in volaraster.triangle_voxels(corners,
+                                                       self.sidedivisions):
+            self.addvoxels(voxels, None if payloads is None
+                           else payloads[tris])
+
+    def addvoxels(self, keys, payloads=None):
+        """
+        Add integer voxel coordinates and their packed uint64 payloads.
+
+        Voxels can be added in several chunks before calling build(). If
+        a voxel is added more than once the last payload is kept. Voxels
+        outside the tree are left out with their payloads.
+        """
+        keys = np.asarray(keys, dtype=np.int64).reshape(-1, 3)
+        inside = np.all((keys >= 0) & (keys < self.sidedivisions), axis=1)
+        if not np.all(inside):
+            keys = keys[inside]
+            if payloads is not None:
+                payloads = np.asarray(payloads)[inside]
+        self.addcodes(bu.morton_codes(keys, self.max_depth), payloads)
+
+    def addcodes(self, codes, payloads=None):
+        """Add voxels by their morton codes, see bu.morton_codes."""
+        if payloads is None:
+            payloads = np.zeros(len(codes), dtype=np.uint64)
+        codes, payloads = last_unique(codes, payloads)
+        self.codes.append(codes)
+        self.payloads.append(payloads)
+        self.dirty = True
+        # merge the chunks now and then so repeated voxels are dropped
+        if len(self.codes) >= 16:
+            self.compact()
+
+    def compact(self):
+        """Merge the voxels added so far into one sorted array."""
+        codes, payloads = last_unique(np.concatenate(self.codes),
+                                      np.concatenate(self.payloads))
+        self.codes, self.payloads = [codes], [payloads]
 
     def setvoxel(self, coords, vals):
-        """Set bit to 1 for different levels."""
-        x, y, z = coords[0], coords[1], coords[2]
-        payload = 0
+        """Set a single voxel, bytes vals are packed into the payload."""
+        payload = None
         if self.nbits > 0:
-            for offset, elem in enumerate(vals):
-                if elem > 255:
-                    raise ValueError("byte payload must be less than 255")
-                payload += int(elem) << (offset * 8)
-            payload = np.uint64(payload)
+            payload = bu.pack_payloads([vals])
+        self.addvoxels([coords], payload)
 
+    def build(self):
+        """
+        Build the levels from all the voxels added so far.
+
+        Sparse levels hold one word for every occupied block in depth first
+        order. The payload of a block comes from its last voxel in (x, y, z)
+        order with a nonzero payload.
+        """
+        if not self.codes:
+            self.codes = [np.zeros(0, dtype=np.uint64)]
+            self.payloads = [np.zeros(0, dtype=np.uint64)]
+        self.compact()
+        codes, payloads = self.codes[0], self.payloads[0]
+        print("Computed number of occupied voxels:", len(codes))
+        print("Now building vola tree")
+
+        keys = bu.morton_keys(codes, self.max_depth)
+        side = self.sidedivisions
+        order = keys[:, 2] + side * (keys[:, 1] + side * keys[:, 0])
+        # voxels without a payload never overwrite the one of their block
+        order[payloads == 0] = -1
+        lexorder = np.argsort(order)
+        sortedorder = order[lexorder]
+
+        self.levels = []
+        sortedpayloads = payloads[lexorder]
+        for i in range(self.max_depth):
+            if self.sparse:
+                shift = np.uint64(6 * (self.max_depth - i - 1))
+                prefix = codes >> shift >> np.uint64(6)
+                bits = np.uint64(1) << ((codes >> shift) & np.uint64(63))
+                if len(codes) == 0:
+                    words, last = bits, order
+                else:
+                    # the codes are sorted so every block is one run
+                    first = np.flatnonzero(np.concatenate(
+                        ([True], prefix[1:] != prefix[:-1])))
+                    words = np.bitwise_or.reduceat(bits, first)
+                    last = np.maximum.reduceat(order, first)
+            else:
+                sidelength = pow(4, i + 1)
+                divisor = pow(4, self.max_depth - (i + 1))
+                index = keys // divisor
+                index = index[:, 0] + sidelength * (
+                    index[:, 1] + sidelength * index[:, 2])
+                offsets = index // 64
+                words = np.zeros(pow(64, i), dtype=np.uint64)
+                np.bitwise_or.at(words, offsets,
+                                 np.uint64(1) << (index % 64).astype(np.uint64))
+                last = np.full(len(words), -1, dtype=np.int64)
+                np.maximum.at(last, offsets, order)
+
+            if self.nbits > 0:
+                found = np.minimum(np.searchsorted(sortedorder, last),
+                                   max(len(codes) - 1, 0))
+                blockdata = np.zeros(len(last), dtype=np.uint64)
+                blockdata[last >= 0] = sortedpayloads[found[last >= 0]]
+                words = np.concatenate((words, blockdata))
+            self.levels.append(words)
+        self.dirty = False
+
+    def set_grid(self, grid, maxside=256):
+        """
+        Make the levels from a dense occupancy grid indexed [x, y, z].
+
+        Nonzero cells are occupied. The grid is padded with empty cells to
+        a side that is a power of 4, its lower corner is the lower corner
+        of the tree. A grid finer than the tree is reduced, a coarse voxel
+        is set if any of its cells are. Sparse trees are made cube by cube
+        in depth first order, with cubes of side maxside, so only one cube
+        of a large (e.g. memory mapped) grid is read at a time.
+        """
+        gridsides = max(max(grid.shape), 1)
+        depth = max(self.max_depth, int(np.ceil(np.log(gridsides) /
+                                                np.log(4) - 1e-9)))
         if self.sparse:
-            self.set_sparse(x, y, z, payload)
+            cubedepth = min(depth, max(int(round(np.log(maxside) /
+                                                 np.log(4))), 1))
+            levels = grid_levels(grid, depth, cubedepth)
         else:
-            for i in range(len(self.levels)):
-                self.setlevel(i, (x, y, z), payload)
-
-    def set_sparse(self, x, y, z, nbits):
-        """Sparse structure for vola tree."""
-        indexes = bu.sparse_indexes((x, y, z), self.max_depth)
-
-        for i, idx in enumerate(indexes):
-            # Level 0: all values mapped to one vol
-            if i == 0:
-                self.levels[i][0] = bu.set_bit(self.levels[i][0], idx)
-                if nbits > 0:
-                    self.levels[i][1] = nbits
-            else:
-                # Level N: all values mapped to offset vol
-                prev = indexes[:i]
-                off = 0
-                for lev, elem in enumerate(reversed(prev)):
-                    off += elem * (pow(64, lev))
+            levels = dense_levels(grid, depth)
+        levels = levels[:self.max_depth]
+        print("Computed number of occupied voxels:",
+              int(bu.count_bits_np(levels[-1]).sum()))
+        data = None
+        if self.nbits > 0:
+            data = [np.zeros(len(level), dtype=np.uint64) for level in levels]
+        self.set_levels(levels, data)
 
-                self.levels[i][off] = bu.set_bit(self.levels[i][off], idx)
-                if nbits > 0:
-                    nbitsoffset = pow(64, (i)) + off
-                    self.levels[i][nbitsoffset] = nbits
+    def set_levels(self, levels, data=None):
+        """
+        Use prebuilt sparse levels, e.g. combined from other trees.
+
+        levels and data hold one uint64 array per level, data only if
+        nbits are set.
+        """
+        if data is None or self.nbits == 0:
+            self.levels = [np.asarray(level, dtype=np.uint64)
+                           for level in levels]
+        else:
+            self.levels = [np.concatenate((level, words)).astype(np.uint64)
+                           for level, words in zip(levels, data)]
+        self.codes, self.payloads = [], []
+        self.dirty = False
 
     def wgs84_position(self):
         """The lat/ lon coordinates of the centroid of the volume."""
@@ -108,25 +286,6 @@ class VolaTree(object):
         print("Lat:", lat, "lon:", lon)
         return lat, lon
 
-    def setlevel(self, i, coord, twobits):
-        """
-        Setting occupancy bit and secondary data (twobits) on a given level.
-
-        It implements the dense tree and uses a global linear mapping.
-        """
-        sidelength = pow(4, (i + 1))
-        divisor = pow(4, self.max_depth - (i + 1))
-        x = coord[0] // divisor
-        y = coord[1] // divisor
-        z = coord[2] // divisor
-        index = x + (y * sidelength) + (z * pow(sidelength, 2))
-        offset = index // 64
-        bit = index % 64
-        self.levels[i][offset] = bu.set_bit(self.levels[i][offset], bit)
-        if twobits:
-            twobitsoffset = pow(64, (i)) + offset
-            self.levels[i][twobitsoffset] = twobits
-
     def countlevels(self):
         """Measure all the pixels in the tree."""
         for idx, level in enumerate(self.levels):
@@ -189,17 +348,142 @@ class VolaTree(object):
         for elem in self.bbox:
             outfile.write(np.float64(elem))
 
+        if self.dirty:
+            self.build()
         # then write all the points
         for lval, level in enumerate(self.levels):
-            volcount = 0
-            for vol in level:
-                if self.sparse:
-                    if vol != 0:
-                        volcount += 1
-                        outfile.write(vol)
-                else:
-                    volcount += 1
-                    outfile.write(vol)
-
-            print("level:", lval, "output:", volcount)
+            outfile.write(level.astype('<u8').tobytes())
+            print("level:", lval, "output:", len(level))
         outfile.close()
+
+
+def last_unique(codes, payloads):
+    """Sort and drop duplicate codes, keeping the last payload of each."""
+    codes = np.asarray(codes, dtype=np.uint64)
+    payloads = np.asarray(payloads, dtype=np.uint64)
+    # np.unique returns the first index so search the reversed arrays
+    codes, first = np.unique(codes[::-1], return_index=True)
+    return codes, payloads[::-1][first]
+
+
+def cube_of(grid, corner, side):
+    """Occupancy of a cube of a grid, padded with empty cells."""
+    cube = np.zeros((side, side, side), dtype=np.bool_)
+    part = grid[corner[0]:corner[0] + side, corner[1]:corner[1] + side,
+                corner[2]:corner[2] + side]
+    cube[:part.shape[0], :part.shape[1], :part.shape[2]] = part != 0
+    return cube
+
+
+def pack_blocks(cube):
+    """
+    Pack the 4 x 4 x 4 blocks of an occupancy cube into uint64 words.
+
+    Returns a cube a quarter of the side holding the word of each block,
+    with bit x%4 + 4*(y%4) + 16*(z%4) set for its occupied cells.
+    """
+    side = cube.shape[0] // 4
+    blocks = cube.reshape(side, 4, side, 4, side, 4)
+    bits = blocks.transpose(0, 2, 4, 5, 3, 1).reshape(-1, 8, 8)
+    # packbits puts the first bit highest, the words want it lowest
+    packed = np.packbits(bits[:, :, ::-1], axis=-1).reshape(-1, 8)
+    return packed.view('<u8').reshape(side, side, side).astype(np.uint64)
+
+
+def cube_levels(cube):
+    """
+    Sparse levels of an occupancy cube of side 4^depth, top first.
+
+    Each level is the level below reshaped into blocks and packed, a block
+    is occupied if its word is not 0. The words of the occupied blocks of
+    each level are put in depth first order, the top level always has its
+    one word.
+    """
+    levels = []
+    while cube.shape[0] > 1:
+        words = pack_blocks(cube)
+        cube = words != 0
+        if words.shape[0] == 1:
+            levels.append(words.reshape(1))
+            break
+        keys = np.argwhere(cube)
+        depth = int(round(np.log(words.shape[0]) / np.log(4)))
+        order = np.argsort(bu.morton_codes(keys, depth))
+        levels.append(words[tuple(keys[order].T)])
+    levels.reverse()
+    return levels
+
+
+def grid_levels(grid, depth, cubedepth):
+    """
+    Sparse levels of a grid padded to side 4^depth.
+
+    The grid is cut into cubes of side 4^cubedepth, each made into levels
+    on its own. The cubes are visited in depth first order so the lower
+    levels of the tree are their levels joined, and the top levels come
+    from the occupancy of the cubes.
+    """
+    cubeside = pow(4, cubedepth)
+    topdepth = depth - cubedepth
+    # only the cubes holding part of the grid, in depth first order
+    counts = [-(-size // cubeside) for size in grid.shape]
+    keys = np.stack(np.meshgrid(*[np.arange(count) for count in counts],
+                                indexing='ij'), axis=-1).reshape(-1, 3)
+    keys = keys[np.argsort(bu.morton_codes(keys, topdepth))]
+    occupied = np.zeros((pow(4, topdepth),) * 3, dtype=np.bool_)
+    lower = [[] for _ in range(cubedepth)]
+    for key in keys:
+        levels = cube_levels(cube_of(grid, key * cubeside, cubeside))
+        if levels[0][0] == 0:
+            continue
+        occupied[tuple(key)] = True
+        for level, words in zip(lower, levels):
+            level.append(words)
+    if not occupied.any():
+        # as from build, an empty tree has empty levels
+        return [np.zeros(0, dtype=np.uint64) for _ in range(depth)]
+    return cube_levels(occupied) + [np.concatenate(level)
+                                    for level in lower]
+
+
+def pack_cells(cube):
+    """Pack the cells of an occupancy array in z, y, x order into words."""
+    bits = cube.transpose(2, 1, 0).reshape(-1, 8, 8)
+    packed = np.packbits(bits[:, :, ::-1], axis=-1).reshape(-1, 8)
+    return packed.view('<u8').reshape(-1).astype(np.uint64)
+
+
+def dense_levels(grid, depth):
+    """
+    Dense levels of a grid padded to side 4^depth.
+
+    Level i holds the occupancy of the grid at side 4^(i+1), 64 cells to a
+    word in x, then y, then z order. Coarse cells are occupied if any of
+    their 4 x 4 x 4 cells are.
+    """
+    cube = np.asarray(grid) != 0
+    levels = []
+    for i in reversed(range(depth)):
+        side = pow(4, i + 1)
+        if side >= 64:
+            # only the words of the rows holding the grid are packed
+            rowwords = -(-cube.shape[0] // 64)
+            part = np.zeros((64 * rowwords,) + cube.shape[1:], dtype=np.bool_)
+            part[:cube.shape[0]] = cube
+            words = np.zeros((side, side, side // 64), dtype=np.uint64)
+            words[:cube.shape[2], :cube.shape[1], :rowwords] = pack_cells(
+                part).reshape(cube.shape[2], cube.shape[1], rowwords)
+        else:
+            part = np.zeros((side, side, side), dtype=np.bool_)
+            part[:cube.shape[0], :cube.shape[1], :cube.shape[2]] = cube
+            words = pack_cells(part)
+        levels.append(words.reshape(-1))
+
+        # a cell of the level above is set if any of its 4 x 4 x 4 are
+        blocks = [-(-size // 4) for size in cube.shape]
+        part = np.zeros([4 * size for size in blocks], dtype=np.bool_)
+        part[:cube.shape[0], :cube.shape[1], :cube.shape[2]] = cube
+        cube = part.reshape(blocks[0], 4, blocks[1], 4, blocks[2],
+                            4).any(axis=(1, 3, 5))
+    levels.reverse()
+    return levels
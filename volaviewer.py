@@ -2,15 +2,20 @@
 VOLA viewer.
 
 VTK and python 3 based viewer for showing the voxel data for either single or
-multiple tiles. Uses the VOLA reader and the .vola format for multiple tiles
+multiple tiles. Uses the VOLA reader and the .vola format for multiple tiles,
+which can also be packed into a single .volapack container
 @author Jonathan Byrne & Anton Shmatov
 @copyright 2018 Intel Ltd (see LICENSE file).
 """
 from __future__ import print_function
-import json
-import struct
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import vtk
+from vtk.util import numpy_support
 import volareader as vr
+import volamesh as vm
+import volacache
+import volapack
 
 
 def main():
@@ -20,30 +25,59 @@ def main():
     parser.add_argument(
         "fname", help="the name of the file you want to open", type=str)
     parser.add_argument("--ply", help="output a ply file", action='store_true')
+    parser.add_argument(
+        "--nocull",
+        help="draw the hidden interior voxels as well",
+        action='store_true')
+    parser.add_argument(
+        "--coarse",
+        help="depth the tiles of a .vola dataset are first drawn at before\
+              being refined to full depth",
+        type=int, default=2)
+    parser.add_argument(
+        "--workers",
+        help="number of processes decoding the tiles of a .vola dataset",
+        type=int)
+    parser.add_argument(
+        "--cachesize",
+        help="megabytes of decoded tiles kept in memory for a .vola dataset,\
+              the worker processes only use the --cachedir files",
+        type=int, default=1024)
+    parser.add_argument(
+        "--cachedir",
+        help="keep decoded tiles in this directory and reuse them while the\
+              .vol files are unchanged",
+        type=str)
     args = parser.parse_args()
     # set up the renderer to add the points to
     renderer = vtk.vtkRenderer()
     if args.ply:
-        polyappend = vtk.vtkAppendPolyData()
+        meshes = []
         print("generating output file for the mesh: out.ply")
     else:
-        polyappend = None
+        meshes = None
 
-    if args.fname.endswith(".vola"):
-        read_vola(args.fname, renderer, polyappend)
-    elif args.fname.endswith(".vol"):
-        read_vol(args.fname, renderer, polyappend)
+    loader = None
+    dataset = args.fname.endswith((".vola", ".volapack"))
+    if dataset and meshes is None:
+        loader = TileLoader(args.fname, renderer, args.coarse,
+                            not args.nocull, args.workers,
+                            args.cachesize * 1024 * 1024, args.cachedir)
+    elif dataset:
+        read_vola(args.fname, renderer, meshes, not args.nocull,
+                  args.cachedir)
+    elif args.fname.endswith(".vol") or vr.PACK_SEPARATOR in args.fname:
+        read_vol(args.fname, renderer, meshes, not args.nocull,
+                 args.cachedir)
     else:
-        print("It needs to be a vol file or a vola json file!")
+        print("It needs to be a vol file, a vola json file or a volapack!")
         exit()
 
     # now render everything
-    print("finished reading files.")
-    if polyappend is not None:
-        plyWriter = vtk.vtkPLYWriter()
-        plyWriter.SetFileName("out.ply")
-        plyWriter.SetInputConnection(polyappend.GetOutputPort())
-        plyWriter.Write()
+    if loader is None:
+        print("finished reading files.")
+    if meshes:
+        vm.write_ply("out.ply", *vm.merge_meshes(meshes))
     renwin = vtk.vtkRenderWindow()
     renwin.SetSize(1000, 1000)
     renwin.AddRenderer(renderer)
@@ -51,66 +85,301 @@ def main():
     iren.SetRenderWindow(renwin)
     renwin.Render()
     iren.Initialize()
+    if loader is not None:
+        # tiles are added from the render thread as they are decoded
+        iren.AddObserver('TimerEvent', loader.poll)
+        iren.CreateRepeatingTimer(100)
     iren.Start()
 
 
-def read_vola(filename, renderer, polyappend):
+def read_vola(filename, renderer, meshes, cull=True, cachedir=None):
     """# read the contents of all files listed in the .vola json file."""
-    with open(filename) as vola_file:
-        vola_data = json.load(vola_file)
+    vola_data = volapack.load_vola(filename)
 
     for vola in vola_data['files']:
-        header, levels, data = vr.open_file(vola['filename'])
-        voxels, voxel_data = vr.get_voxels(header, levels, data)
-        coords = vr.get_coords(header, voxels)
-        colors = []
-        if header['nbits'] > 0:
-            for datum in voxel_data:
-                bytestr = struct.pack('<Q', datum)
-                bytevals = [b for b in bytestr]
-                colors.append([bytevals[0], bytevals[1], bytevals[2]])
-        else:
-            for _ in coords:
-                colors.append([200, 200, 200])
-        add_voxels(coords, colors, renderer, polyappend, header['cubesize'])
+        header, voxels, voxel_data = decode_tile(vola['filename'],
+                                                 cachedir=cachedir)
+        colors = get_colors(header, voxel_data, len(voxels))
+        if meshes is not None:
+            lattice, quads, quadcolors = vm.mesh_from_voxels(
+                voxels, header['sidelength'], colors)
+            # cubes are drawn centred on the voxel coordinate
+            vertices = vr.get_coords_np(header, lattice - 0.5)
+            meshes.append((vertices, quads, quadcolors))
+        if cull:
+            voxels, colors = cull_voxels(header, voxels, colors)
+        coords = vr.get_coords_np(header, voxels)
+        add_voxels(coords, colors, renderer, header['cubesize'])
 
 
-def read_vol(filename, renderer, polyappend):
+def read_vol(filename, renderer, meshes, cull=True, cachedir=None):
     """Read individual vola file."""
-    header, levels, data = vr.open_file(filename)
-    coords, coord_data = vr.get_voxels(header, levels, data)
-    colors = []
+    header, coords, coord_data = decode_tile(filename, cachedir=cachedir)
+    colors = get_colors(header, coord_data, len(coords))
+    if meshes is not None:
+        lattice, quads, quadcolors = vm.mesh_from_voxels(
+            coords, header['sidelength'], colors)
+        meshes.append((lattice - 0.5, quads, quadcolors))
+    if cull:
+        coords, colors = cull_voxels(header, coords, colors)
+    add_voxels(coords, colors, renderer, 1)
+
+
+def decode_tile(filename, depth=None, cachedir=None):
+    """
+    Decode a tile, going through the tile cache if cachedir is set.
+
+    Only the cache directory is used, not the memory tier: each tile is
+    decoded once here and the TileLoader keeps the decoded tiles within
+    --cachesize, which a memory tier in every worker would go over.
+    """
+    if cachedir is not None:
+        return volacache.shared_cache(cachedir, 0).load(filename, depth)
+    header, levels, data = vr.open_file(filename, depth)
+    voxels, voxel_data = vr.get_voxels_np(header, levels, data)
+    return header, voxels, voxel_data
+
+
+def load_tile(filename, depth=None, cull=True, cachedir=None):
+    """
+    Decode a tile down to the given depth, ready to be drawn.
+
+    Runs in the worker processes of the TileLoader so only numpy arrays
+    are returned: the voxel coordinates, colors and the cube size.
+    """
+    header, voxels, voxel_data = decode_tile(filename, depth, cachedir)
+    colors = get_colors(header, voxel_data, len(voxels))
+    if cull:
+        voxels, colors = cull_voxels(header, voxels, colors)
+    colors = np.ascontiguousarray(colors)
+    if header['crs'] == 2000:
+        # no coordinate system, draw in voxel units of the full depth
+        scale = pow(4, header['filedepth'] - header['depth'])
+        return voxels * scale, colors, scale
+    return vr.get_coords_np(header, voxels), colors, header['cubesize']
+
+
+class TileLoader(object):
+    """
+    View dependent loading of the tiles of a .vola dataset.
+
+    Whenever the camera changes the tiles outside the view frustum are
+    hidden and every visible tile is given a depth from its size on the
+    screen. Tiles are decoded by a pool of worker processes, coarse
+    versions first, and decoded tiles are kept in a cache bounded by bytes
+    with the least recently used tiles dropped first. The render thread
+    polls the loader from a VTK timer and swaps in the actor of each tile
+    as it completes, so the window stays responsive while loading.
+    """
+
+    def __init__(self, filename, renderer, coarse=2, cull=True,
+                 workers=None, cachesize=1024 * 1024 * 1024, cachedir=None,
+                 pixels=2):
+        """Read the dataset index and set up the decoding pool."""
+        vola_data = volapack.load_vola(filename)
+
+        self.renderer = renderer
+        self.coarse = min(coarse, vola_data['depth'])
+        self.cull = cull
+        self.cachedir = cachedir
+        self.pixels = pixels
+        self.maxdepth = vola_data['depth']
+        self.filenames = [vola['filename'] for vola in vola_data['files']]
+        self.bounds = np.array([tile_bounds(vola, vola_data['depth'])
+                                for vola in vola_data['files']])
+        self.bounds = self.bounds.reshape(-1, 6)
+
+        self.actors = {}
+        self.shown = {}
+        self.wanted = {}
+        self.pending = {}
+        self.requested = set()
+        self.failed = set()
+        self.cache = volacache.LRUCache(cachesize)
+        self.viewstate = None
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+
+        if len(self.bounds) > 0:
+            low, high = self.bounds[:, :3].min(0), self.bounds[:, 3:].max(0)
+            renderer.ResetCamera(low[0], high[0], low[1], high[1],
+                                 low[2], high[2])
+        print("dataset has", len(self.filenames), "tiles")
 
+    def poll(self, interactor, _event=None):
+        """Follow the camera and add tiles that have finished decoding."""
+        renwin = interactor.GetRenderWindow()
+        camera = self.renderer.GetActiveCamera()
+        viewstate = (camera.GetMTime(), tuple(renwin.GetSize()))
+        changed = viewstate != self.viewstate
+        if changed:
+            self.viewstate = viewstate
+            self.update_view()
+
+        done = [future for future in self.pending if future.done()]
+        for future in done:
+            key = self.pending.pop(future)
+            self.requested.discard(key)
+            if future.cancelled():
+                continue
+            try:
+                result = future.result()
+            except (Exception, SystemExit) as err:
+                # the reader exits on truncated files, a bad tile is
+                # reported and not requested again
+                print("could not load", self.filenames[key[0]], "at depth",
+                      key[1], ":", err)
+                self.failed.add(key)
+                continue
+            self.add_cache(key, result)
+            self.show_best(key[0])
+
+        if done or changed:
+            renwin.Render()
+
+    def update_view(self):
+        """Work out which tiles are visible and the depth they need."""
+        visible, depths = self.view_depths()
+        self.wanted = {}
+        for idx in np.nonzero(visible)[0]:
+            self.wanted[int(idx)] = int(depths[idx])
+
+        for idx in list(self.actors):
+            if idx not in self.wanted:
+                self.renderer.RemoveActor(self.actors.pop(idx))
+                del self.shown[idx]
+
+        # drop queued work for tiles that are no longer needed
+        for future, (idx, depth) in list(self.pending.items()):
+            if idx in self.wanted and depth in (self.wanted[idx],
+                                                self.coarse):
+                continue
+            if future.cancel():
+                del self.pending[future]
+                self.requested.discard((idx, depth))
+
+        # coarse versions first, then the tiles largest on screen
+        coarse, fine = [], []
+        for idx in sorted(self.wanted, key=lambda i: -self.wanted[i]):
+            depth = self.wanted[idx]
+            self.show_best(idx)
+            if (idx, depth) in self.cache:
+                continue
+            if idx not in self.shown and self.coarse < depth:
+                coarse.append((idx, self.coarse))
+            fine.append((idx, depth))
+
+        for key in coarse + fine:
+            if key not in self.requested and key not in self.failed:
+                future = self.pool.submit(load_tile, self.filenames[key[0]],
+                                          key[1], self.cull, self.cachedir)
+                self.pending[future] = key
+                self.requested.add(key)
+
+    def view_depths(self):
+        """Frustum test and screen space depth for every tile."""
+        renwin = self.renderer.GetRenderWindow()
+        width, height = renwin.GetSize() if renwin else (1000, 1000)
+        camera = self.renderer.GetActiveCamera()
+        planes = [0.0] * 24
+        camera.GetFrustumPlanes(float(width) / max(height, 1), planes)
+        planes = np.array(planes).reshape(6, 4)
+
+        # a box is outside if its corner furthest along the inward
+        # normal of any frustum plane is behind that plane
+        low, high = self.bounds[:, None, :3], self.bounds[:, None, 3:]
+        corner = np.where(planes[None, :, :3] > 0, high, low)
+        dist = (corner * planes[None, :, :3]).sum(axis=2) + planes[:, 3]
+        visible = np.all(dist >= 0, axis=1)
+
+        # projected size of the tile in pixels
+        centre = (self.bounds[:, :3] + self.bounds[:, 3:]) / 2
+        radius = np.linalg.norm(self.bounds[:, 3:] - self.bounds[:, :3],
+                                axis=1) / 2
+        if camera.GetParallelProjection():
+            pixels = radius * height / camera.GetParallelScale()
+        else:
+            eye = np.array(camera.GetPosition())
+            distance = np.linalg.norm(centre - eye, axis=1) - radius
+            distance = np.maximum(distance, 1e-6 * (radius + 1))
+            halfangle = np.radians(camera.GetViewAngle()) / 2
+            pixels = radius * height / (distance * np.tan(halfangle))
+
+        # enough depth for a voxel to cover self.pixels on screen
+        voxels = np.maximum(pixels / self.pixels, 1)
+        depths = np.ceil(np.log(voxels) / np.log(4)).astype(np.int64)
+        return visible, np.clip(depths, 1, self.maxdepth)
+
+    def show_best(self, idx):
+        """Show the cached depth of a visible tile closest to the one wanted."""
+        if idx not in self.wanted:
+            return
+        cached = [depth for depth in range(1, self.maxdepth + 1)
+                  if (idx, depth) in self.cache]
+        if not cached:
+            return
+        wanted = self.wanted[idx]
+        best = min(cached, key=lambda depth: (abs(depth - wanted), -depth))
+        coords, colors, cubesize = self.cache.get((idx, best))
+        if self.shown.get(idx) == best:
+            return
+
+        actor = add_voxels(coords, colors, self.renderer, cubesize)
+        if idx in self.actors:
+            self.renderer.RemoveActor(self.actors[idx])
+        self.actors[idx] = actor
+        self.shown[idx] = best
+
+    def add_cache(self, key, tile):
+        """Cache a decoded tile, dropping the least recently used ones."""
+        self.cache.put(key, tile, tile[0].nbytes + tile[1].nbytes)
+
+
+def tile_bounds(vola, depth):
+    """World bounds (minx, miny, minz, maxx, maxy, maxz) a tile is drawn in."""
+    if vola['crs'] == 2000:
+        sidelength = pow(4, depth)
+        return [0, 0, 0, sidelength, sidelength, sidelength]
+    # voxels are drawn on a cube with the longest side of the bbox
+    bbox = vola['bbox']
+    side = max(vola['sides'])
+    return bbox[:3] + [bbox[0] + side, bbox[1] + side, bbox[2] + side]
+
+
+def cull_voxels(header, voxels, colors):
+    """Drop the voxels that are hidden on all six sides by neighbours."""
+    visible = vm.surface_voxels(voxels, header['sidelength'])
+    print("drawing", np.count_nonzero(visible), "of", len(voxels), "voxels")
+    return voxels[visible], colors[visible]
+
+
+def get_colors(header, voxel_data, count):
+    """Take the rgb bytes from the nbits data or use grey for occupancy."""
     if header['nbits'] > 0:
-        for datum in coord_data:
-            bytestr = struct.pack('<Q', datum)
-            bytevals = [b for b in bytestr]
-            colors.append([bytevals[0], bytevals[1], bytevals[2]])
-    else:
-        for _ in coords:
-            colors.append([200, 200, 200])
-    add_voxels(coords, colors, renderer, polyappend, 1)
+        bytevals = np.ascontiguousarray(voxel_data, dtype='<u8')
+        return bytevals.view(np.uint8).reshape(-1, 8)[:, :3]
+    return np.full((count, 3), 200, dtype=np.uint8)
 
 
-def add_voxels(positions, colors, renderer, polyappend, cubesize=1):
+def add_voxels(positions, colors, renderer, cubesize=1):
     """
     VTK based viewer for sparse VOLA files (.vol).
 
     Maps VOLA and draws opengl cubes for voxels and their color information.
+    The numpy position and color arrays are shared with VTK without copying
+    and the cubes are instanced on the GPU by a glyph mapper.
     """
     # Point array for holding voxel positions
+    positions = np.ascontiguousarray(positions, dtype=np.float64)
     points = vtk.vtkPoints()
-    for pos in positions:
-        points.InsertNextPoint(*pos)
+    points.SetData(numpy_support.numpy_to_vtk(positions, deep=False))
     polydata = vtk.vtkPolyData()
     polydata.SetPoints(points)
 
-    # List for holding the color information
-    color_def = vtk.vtkUnsignedCharArray()
-    color_def.SetNumberOfComponents(3)
-    color_def.SetNumberOfTuples(polydata.GetNumberOfPoints())
-    for idx, color in enumerate(colors):
-        color_def.InsertTuple3(idx, *colors[idx])
+    # Array for holding the color information
+    colors = np.ascontiguousarray(colors, dtype=np.uint8)
+    color_def = numpy_support.numpy_to_vtk(
+        colors, deep=False, array_type=vtk.VTK_UNSIGNED_CHAR)
+    color_def.SetName("colors")
     polydata.GetPointData().SetScalars(color_def)
 
     # Use a cube glyph to quickly render the data
@@ -120,27 +389,22 @@ def add_voxels(positions, colors, renderer, polyappend, cubesize=1):
     cube_source.SetZLength(cubesize)
     cube_source.Update()
 
-    glyph = vtk.vtkGlyph3D()
+    # VTK Model: Mapper -> Actor -> Render
+    mapper = vtk.vtkGlyph3DMapper()
     # silly vtk change
     if vtk.VTK_MAJOR_VERSION < 6:
-        glyph.SetInput(polydata)
+        mapper.SetInput(polydata)
     else:
-        glyph.SetInputData(polydata)
-
-    glyph.SetSourceConnection(cube_source.GetOutputPort())
-    glyph.SetColorModeToColorByScalar()
-    glyph.SetVectorModeToUseNormal()
-    glyph.ScalingOff()
+        mapper.SetInputData(polydata)
+    mapper.SetSourceConnection(cube_source.GetOutputPort())
+    mapper.SetScalarModeToUsePointData()
+    mapper.ScalingOff()
+    mapper.OrientOff()
 
-    # VTK Model: Mapper -> Actor -> Render
-    mapper = vtk.vtkPolyDataMapper()
-    mapper.SetInputConnection(glyph.GetOutputPort())
-    if polyappend is not None:
-        polyappend.AddInputConnection(glyph.GetOutputPort())
-        polyappend.Update()
     actor = vtk.vtkActor()
     actor.SetMapper(mapper)
     renderer.AddActor(actor)
+    return actor
 
 
 if __name__ == "__main__":
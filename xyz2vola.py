@@ -20,7 +20,9 @@ def main():
     start_time = bu.timer()
     parser = bu.parser_args("*.asc / *.xyz / *.txt")
     parser = bu.add_reverse(parser)
+    parser = bu.add_grid(parser)
     args = parser.parse_args()
+    bu.check_grid(parser, args)
 
     # Parse directories or filenames, whichever you want!
     if os.path.isdir(args.input):
@@ -41,69 +43,59 @@ def main():
             continue
 
         print("converting", filename, "to", outfilename)
-        bbox, points, pointsdata = parse_xyz(filename, args.nbits)
-
-        if args.reverse_zy:
-            points = np.array([points[:, 0], points[:, 2], points[:, 1]]).transpose()
-
-        # work out how many chunks are required for the data
-        if args.nbits:
-            print("nbits set, adding metadata to occupancy grid")
-            div, mod = divmod(len(pointsdata[0]), 8)
-            if mod > 0:
-                nbits = div + 1
-            else:
-                nbits = div
-        else:
-            print("Only occupancy data being set! Use -n flag to add metadata")
-            nbits = 0
-
-        if len(points) > 0:
-            volatree = VolaTree(args.depth, bbox, args.crs,
-                                args.dense, nbits)
-            volatree.cubify(points, pointsdata)
-            volatree.countlevels()
-            volatree.writebin(outfilename)
-
+        if convert_xyz(filename, outfilename, args):
             bu.print_ratio(filename, outfilename)
         else:
             print("The points file is empty!")
     bu.timer(start_time)
 
 
-def parse_xyz(filename, nbits):
-    """Read xyz format point data and return header, points and points data."""
-    pointstrings = []
-    with open(filename) as points_file:
-        for line in points_file:
-            if not line.startswith('#'):
-                if not line.isspace():
-                    line = line.replace(',', ' ')
-                    line = line.split()
-                    pointstrings.append(line)
-
-    points = np.zeros((len(pointstrings), 3), dtype=np.float)
-    if nbits > 0:
-        datalen = len(pointstrings[0][3:])
-        pointsdata = np.zeros((len(pointstrings), datalen), dtype=np.int)
-
-    for idx, line in enumerate(pointstrings):
-        coords = line[: 3]
-        coords = [float(i) for i in coords]
-        points[idx] = coords
-        if nbits > 0:
-            data = line[3:]
-            data = [int(i) for i in data]
-            pointsdata[idx] = data
-
-    minvals = points.min(axis=0).tolist()
-    maxvals = points.max(axis=0).tolist()
-    bbox = [minvals, maxvals]
-
-    if nbits > 0:
-        return bbox, points, pointsdata
+def convert_xyz(filename, outfilename, args):
+    """
+    Stream the points into a VolaTree chunk by chunk and write it.
+
+    The file is read twice, once for the bounding box and once for the
+    voxels, so only a chunk of it is held in memory. Returns False if the
+    file is empty.
+    """
+    bbox, ncols = bu.text_bbox(filename)
+    if bbox is None:
+        return False
+    if args.reverse_zy:
+        bbox = [[low[0], low[2], low[1]] for low in bbox]
+
+    # work out how many chunks are required for the data
+    if args.nbits:
+        print("nbits set, adding metadata to occupancy grid")
+        div, mod = divmod(ncols - 3, 8)
+        if mod > 0:
+            nbits = div + 1
+        else:
+            nbits = div
     else:
-        return bbox, points, None
+        print("Only occupancy data being set! Use -n flag to add metadata")
+        nbits = 0
+
+    volatree = VolaTree(args.depth, bbox, args.crs, args.dense, nbits,
+                        args.gridorigin, args.cubesize)
+    for points, pointsdata in parse_xyz(filename, nbits, args.reverse_zy):
+        volatree.addpoints(points, pointsdata)
+    volatree.build()
+    volatree.countlevels()
+    volatree.writebin(outfilename)
+    return True
+
+
+def parse_xyz(filename, nbits, reverse_zy=False):
+    """Read xyz format point data, yielding chunks of points and data."""
+    for rows in bu.read_text(filename):
+        points = rows[:, :3]
+        if reverse_zy:
+            points = points[:, [0, 2, 1]]
+        if nbits > 0:
+            yield points, rows[:, 3:].astype(np.int64)
+        else:
+            yield points, None
 
 
 if __name__ == '__main__':